@@ -0,0 +1,467 @@
+import os
+import time
+import asyncio
+import random
+import json
+import signal
+import resource
+from client import Commands
+from player import Player, PlayerStore, Info
+from lobby import SoloLobby, LobbyIndex, DEFAULT_TOLERANCE, UNCONSTRAINED
+from leaderboard import Leaderboard
+from storage import Storage, hash_password
+from protocol import AsyncConnection, MessageType, ProtocolError, FramingError, SharedFrame, FrameCache
+from metrics import Metrics, MetricsDump, RATING_BUCKETS
+from server import QueueTicket, SERVER_COMMANDS
+from profiler import Profiler, ProfilingMode
+from history import MatchHistory
+
+
+# Coroutine counterpart of ClientThread, serving one connection on the event loop.
+class ClientSession:
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.connection = AsyncConnection(reader, writer)
+        self.player = None
+        self.ticket = None
+
+    async def sign_up(self):
+        account = {Info.USERNAME.value: None, Info.PASSWORD.value: None}
+        await self.connection.send_data(account)
+        account = await self.connection.recv_data()
+        username = account[Info.USERNAME.value]
+        password = account[Info.PASSWORD.value]
+        if not isinstance(password, str) or self.server.players.get(username):
+            await self.connection.send_data(False)
+            return
+        # Only a salted hash of the password is kept, computed off the event loop.
+        password_hash = await asyncio.get_running_loop().run_in_executor(None, hash_password, password)
+        player = self.server.register(username, password_hash)
+        if player is None:
+            await self.connection.send_data(False)
+        else:
+            await self.connection.send_data(True)
+            self.player = player
+            self.player.online()
+            print("{} has connected.".format(username))
+
+    async def sign_in(self):
+        account = {Info.USERNAME.value: None, Info.PASSWORD.value: None}
+        await self.connection.send_data(account)
+        account = await self.connection.recv_data()
+        username = account[Info.USERNAME.value]
+        password = account[Info.PASSWORD.value]
+        player = self.server.players.get(username)
+        if player and await asyncio.get_running_loop().run_in_executor(None, self.server.storage.check_password, player,
+                                                                       self.server.accounts[username], password):
+            await self.connection.send_data(True)
+            self.player = self.server.players[username]
+            self.player.online()
+            print("{} has connected.".format(username))
+        else:
+            await self.connection.send_data(False)
+
+    async def profile(self):
+        leaderboard = self.server.competitive_matchmaking.leaderboard
+        self.player.rank = leaderboard.rank(self.player)
+        await self.connection.send_frame(self.server.profile_frame(self.player, self.connection.codec))
+
+    async def leaderboard(self):
+        request = await self.connection.recv_data()
+        leaderboard = self.server.competitive_matchmaking.leaderboard
+        await self.connection.send_data(leaderboard.read(request, self.server.players))
+
+    async def stats(self):
+        await self.connection.send_data(self.server.stats())
+
+    # Coroutines interleave on the same thread, which spans can't tell apart, so only the sampling mode is offered. The
+    # profiler writes files on the server, so only its admins can start and stop it.
+    async def profiler(self):
+        await self.connection.recv_data()
+        if self.player is None or self.player.username not in self.server.admins:
+            await self.connection.send_data({"ERROR": "Only the admins of the server can profile it."})
+            return
+        await self.connection.send_data(self.server.profiler.toggle(ProfilingMode.SAMPLING))
+
+    def queued(self):
+        return self.ticket is not None and not self.ticket.finished
+
+    def matchmaking_system(self, queue):
+        if queue == Commands.CASUAL.value:
+            return self.server.casual_matchmaking
+        return self.server.competitive_matchmaking
+
+    # Queue the player up and acknowledge it right away. The result of the match is pushed once it is over.
+    async def queue_up(self, queue):
+        if self.queued():
+            await self.connection.send_data({"QUEUED": False, "QUEUE": self.ticket.queue})
+            return
+        self.ticket = QueueTicket(self, queue)
+        self.player.in_queue()
+        self.matchmaking_system(queue).enqueue(self.ticket)
+        await self.connection.send_data({"QUEUED": True, "QUEUE": self.ticket.queue})
+
+    async def competitive(self):
+        await self.queue_up(Commands.COMPETITIVE.value)
+
+    async def casual(self):
+        await self.queue_up(Commands.CASUAL.value)
+
+    def leave_queue(self):
+        if not self.queued() or not self.matchmaking_system(self.ticket.queue).cancel(self.ticket):
+            return False
+        self.ticket = None
+        self.player.online()
+        return True
+
+    async def cancel(self):
+        await self.connection.send_data(self.leave_queue())
+
+    async def queue_status(self):
+        status = {"STATUS": self.player.status, "QUEUE": None, "WAIT": None}
+        if self.queued():
+            status["QUEUE"] = self.ticket.queue
+            status["WAIT"] = round(time.monotonic() - self.ticket.queued_at, 4)
+        await self.connection.send_data(status)
+
+    async def run(self):
+        handlers = {Commands.SIGN_UP.value: self.sign_up,
+                    Commands.SIGN_IN.value: self.sign_in,
+                    Commands.PROFILE.value: self.profile,
+                    Commands.LEADERBOARD.value: self.leaderboard,
+                    Commands.COMPETITIVE.value: self.competitive,
+                    Commands.CASUAL.value: self.casual,
+                    Commands.CANCEL.value: self.cancel,
+                    Commands.QUEUE_STATUS.value: self.queue_status,
+                    Commands.STATS.value: self.stats,
+                    Commands.PROFILER.value: self.profiler}
+        try:
+            await self.connection.accept()
+        except (ProtocolError, json.JSONDecodeError, ConnectionError, OSError) as e:
+            print(e)
+            self.connection.close()
+            return
+        self.server.connections.inc()
+        try:
+            while True:
+                frame = await self.connection.recv()
+                if not frame:
+                    break
+                message_type, command = frame
+                if message_type != MessageType.COMMAND:
+                    continue
+                handler = handlers.get(command) if isinstance(command, str) else None
+                if handler is None:
+                    self.server.unknown_commands.inc()
+                    continue
+                self.server.commands_counts[command].inc()
+                try:
+                    await handler()
+                except FramingError:
+                    raise
+                except (ProtocolError, json.JSONDecodeError) as e:
+                    # The frames of the command were read whole, so the session can go on.
+                    await self.connection.send_data({"ERROR": str(e)})
+        except (ProtocolError, json.JSONDecodeError, ConnectionError, OSError) as e:
+            print(e)
+        except Exception as e:
+            # Any other error leaves the session in an unknown state: close it rather than leak the connection.
+            print("Closing the connection after an unexpected error: {!r}".format(e))
+        finally:
+            self.server.connections.dec()
+            if self.player:
+                self.leave_queue()
+                self.player.offline()
+                print("{} has disconnected.".format(self.player.username))
+            self.connection.close()
+
+
+# Coroutine counterpart of ScheduledLobby, played as a task once the lobby is full.
+class SoloLobbyTask:
+    def __init__(self, matchmaking_system, capacity):
+        self.matchmaking_system = matchmaking_system
+        self.lobby = SoloLobby(capacity, matchmaking_system.tolerance)
+        self.tickets = set()
+        self.created_at = time.monotonic()
+
+    def fill(self, entry):
+        found_lobby = self.lobby.fill(entry.player, entry.queued_at)
+        if found_lobby:
+            entry.lobby = self
+            self.tickets.add(entry)
+            if self.ready():
+                for ticket in self.tickets:
+                    ticket.matched = True
+                self.matchmaking_system.lobby_fill_time.observe(time.monotonic() - self.created_at)
+        return found_lobby
+
+    # Take a player who cancelled out of the open lobby, and return the number of players left.
+    def remove(self, entry):
+        self.lobby.remove(entry.player)
+        self.tickets.discard(entry)
+        entry.lobby = None
+        return len(self.lobby.players)
+
+    def ready(self):
+        return self.lobby.ready()
+
+    def average_rating(self):
+        return self.lobby.average_rating()
+
+    async def run(self):
+        started_at = time.monotonic()
+        self.matchmaking_system.record_match(self.lobby.players,
+                                             [started_at - ticket.queued_at for ticket in self.tickets])
+        predictions = None
+        if self.matchmaking_system.rated:
+            self.lobby.predict_outcome()
+            predictions = self.lobby.display_predictions()
+        else:
+            self.lobby.predict_scores()
+        before = self.lobby.display_players()
+        ratings = {player.user_id: player.rating for player in self.lobby.players}
+        for ticket in self.tickets:
+            ticket.player.in_game()
+        self.lobby.simulate_match(self.matchmaking_system.rated)
+        if self.matchmaking_system.rated:
+            players = self.lobby.players
+            self.matchmaking_system.server.storage.record_results(players)
+            self.matchmaking_system.server.history.record([player.user_id for player in players],
+                                                          [ratings[player.user_id] for player in players],
+                                                          [player.rating for player in players])
+        await asyncio.sleep(random.randint(2, 5))
+        after = self.lobby.display_players()
+        # Seconds each player waited in the queue before the match started.
+        queue_times = {ticket.player.username: round(started_at - ticket.queued_at, 4) for ticket in self.tickets}
+        result = {"BEFORE": before}
+        if predictions is not None:
+            result["PREDICTIONS"] = predictions
+        result["AFTER"] = after
+        result["QUEUE TIMES"] = queue_times
+        result = SharedFrame(MessageType.EVENT, result)
+        for ticket in self.tickets:
+            ticket.connection.write_frame(result.frame(ticket.connection.codec))
+            ticket.finished = True
+            ticket.player.leave_game()
+        await asyncio.gather(*[ticket.connection.writer.drain() for ticket in self.tickets],
+                             return_exceptions=True)
+        if self.matchmaking_system.rated:
+            self.matchmaking_system.update_leaderboard(self.lobby.players)
+
+
+# Coroutine counterpart of MatchmakingSystem. Everything runs on the event loop, so a single matchmaking task is
+# enough and no locks are needed.
+class AsyncMatchmakingSystem:
+    metrics_prefix = ""
+
+    def __init__(self, server, capacity, rated, tolerance=DEFAULT_TOLERANCE):
+        self.server = server
+        self.capacity = capacity
+        self.rated = rated
+        self.tolerance = tolerance
+        self.leaderboard = Leaderboard() if rated else None  # Unrated matches don't move anyone on a leaderboard.
+        self.queue = asyncio.Queue()
+        self.depth = 0  # Number of players in the queue who haven't cancelled nor been placed in a lobby yet.
+        self.open_lobbies = LobbyIndex(capacity, tolerance)
+        self.matches = set()
+
+        metrics = server.metrics
+        self.queue_depth = metrics.gauge(self.metrics_prefix + "QUEUE DEPTH")
+        self.open_lobbies_count = metrics.gauge(self.metrics_prefix + "OPEN LOBBIES")
+        self.queue_wait_time = metrics.histogram(self.metrics_prefix + "QUEUE WAIT TIME")
+        self.lobby_fill_time = metrics.histogram(self.metrics_prefix + "LOBBY FILL TIME")
+        self.rating_spread = metrics.histogram(self.metrics_prefix + "LOBBY RATING SPREAD", RATING_BUCKETS)
+        self.matches_count = metrics.counter(self.metrics_prefix + "MATCHES")
+        self.leaderboard_time = None
+        if rated:
+            self.leaderboard_time = metrics.histogram(self.metrics_prefix + "LEADERBOARD UPDATE TIME")
+
+    def enqueue(self, entry):
+        self.queue.put_nowait(entry)
+        self.depth += 1
+        self.queue_depth.set(self.depth)
+
+    # Take a player out of the matchmaking, unless their lobby is already full. A player still in the queue is left
+    # there as a tombstone, and a player waiting in an open lobby is removed from it.
+    def cancel(self, entry):
+        if entry.matched or entry.cancelled:
+            return False
+        entry.cancelled = True
+        if entry.lobby is None:
+            self.depth -= 1
+            self.queue_depth.set(self.depth)
+        else:
+            self.leave_lobby(entry.lobby, entry)
+        return True
+
+    # Remove a player from their open lobby, which moves according to its new average rating or closes if it is empty.
+    def leave_lobby(self, lobby, entry):
+        if lobby.remove(entry):
+            self.open_lobbies.update(lobby)
+        else:
+            self.open_lobbies.remove(lobby)
+        self.open_lobbies_count.set(len(self.open_lobbies))
+
+    def update_leaderboard(self, players):
+        start = time.perf_counter()
+        for player in players:
+            self.leaderboard.update(player)
+        for player in players:
+            player.rank = self.leaderboard.rank(player)
+        self.leaderboard_time.observe(time.perf_counter() - start)
+
+    # Record the start of a match, with the time each of its players spent in the queue.
+    def record_match(self, players, queue_times):
+        ratings = [player.rating for player in players]
+        self.matches_count.inc()
+        self.rating_spread.observe(max(ratings) - min(ratings))
+        for queue_time in queue_times:
+            self.queue_wait_time.observe(queue_time)
+
+    def start_match(self, lobby):
+        match = asyncio.create_task(lobby.run())
+        self.matches.add(match)
+        match.add_done_callback(self.matches.discard)
+
+    def place(self, player):
+        # Search for an available lobby among those with a close enough average rating.
+        found_lobby = None
+        for lobby in self.open_lobbies.candidates(player.player.rating):
+            if lobby.fill(player):
+                found_lobby = lobby
+                break
+
+        # Create a new lobby if none of the existing lobbies can accept the player.
+        if not found_lobby:
+            found_lobby = SoloLobbyTask(self, self.capacity)
+            found_lobby.fill(player)
+            self.open_lobbies.add(found_lobby)
+
+        # Full lobbies are played right away, the others move according to their new average rating.
+        if found_lobby.ready():
+            self.open_lobbies.remove(found_lobby)
+            self.start_match(found_lobby)
+        else:
+            self.open_lobbies.update(found_lobby)
+        self.open_lobbies_count.set(len(self.open_lobbies))
+
+    async def run(self):
+        while True:
+            player = await self.queue.get()
+            if player.cancelled:
+                continue
+            self.depth -= 1
+            self.queue_depth.set(self.depth)
+            self.place(player)
+
+
+# Coroutine counterpart of CasualMatchmakingSystem: any player can join any lobby, and each player joins the fullest
+# open lobby.
+class AsyncCasualMatchmakingSystem(AsyncMatchmakingSystem):
+    metrics_prefix = "CASUAL "
+
+    def __init__(self, server, capacity):
+        AsyncMatchmakingSystem.__init__(self, server, capacity, False, UNCONSTRAINED)
+        # open_lobbies[k] holds the open lobbies with k players, as the keys of a dict so that any can be removed.
+        self.open_lobbies = [{} for _ in range(capacity)]
+
+    def place(self, player):
+        count = next((k for k in range(self.capacity - 1, 0, -1) if self.open_lobbies[k]), 0)
+        lobby = self.open_lobbies[count].popitem()[0] if count else SoloLobbyTask(self, self.capacity)
+        lobby.fill(player)
+        if lobby.ready():
+            self.start_match(lobby)
+        else:
+            self.open_lobbies[count + 1][lobby] = None
+        self.open_lobbies_count.set(sum(len(lobbies) for lobbies in self.open_lobbies))
+
+    def leave_lobby(self, lobby, entry):
+        count = len(lobby.lobby.players)
+        del self.open_lobbies[count][lobby]
+        if lobby.remove(entry):
+            self.open_lobbies[count - 1][lobby] = None
+        self.open_lobbies_count.set(sum(len(lobbies) for lobbies in self.open_lobbies))
+
+
+# Single-threaded server mode serving every connection, the matchmaking and the lobbies on one event loop. It speaks
+# the same protocol as Server.
+class AsyncServer:
+    def __init__(self, host="127.0.0.1", port=1233, data_path="data", admins=()):
+        self.host = host
+        self.port = port
+        self.store = PlayerStore()
+        self.storage = Storage(data_path)
+        self.accounts, self.players = self.storage.load(self.store)
+        self.metrics = Metrics()
+        self.metrics_dump = MetricsDump(self.metrics, os.path.join(data_path, "metrics.json"))
+        self.connections = self.metrics.gauge("CONNECTIONS")
+        # The commands are counted by metrics made up front, and any other command by a single one, so that clients
+        # can't add metrics of their own.
+        self.commands_counts = {command.value: self.metrics.counter("{} COMMANDS".format(command.value))
+                                for command in SERVER_COMMANDS}
+        self.unknown_commands = self.metrics.counter("UNKNOWN COMMANDS")
+        self.profiles = FrameCache()  # Encoded profiles of the players, sent as-is until they change.
+        self.profiler = Profiler(data_path)
+        self.admins = set(admins)  # Usernames allowed to start and stop the profiler.
+        self.history = MatchHistory(os.path.join(data_path, "history")).load()
+        self.competitive_matchmaking = None
+        self.casual_matchmaking = None
+
+    # Register a new account and its player under the next free user id, or return None if the username is taken. The
+    # username is looked up again since other players may have signed up while the password was hashed, and nothing
+    # else runs on the event loop between the lookup and the registration.
+    def register(self, username, password_hash):
+        if self.players.get(username):
+            return None
+        account = {Info.USERNAME.value: username, Info.PASSWORD.value: password_hash}
+        player = Player.create(username, store=self.store)
+        self.players[username] = player
+        self.accounts[username] = account
+        self.storage.record_sign_up(player, account)
+        return player
+
+    def stats(self):
+        stats = self.metrics.snapshot()
+        stats["PLAYERS"] = self.store.stats()
+        return stats
+
+    # Encoded profile of a player along with the sparkline of their last ratings, cached until either changes.
+    def profile_frame(self, player, codec):
+        return self.profiles.frame(codec, MessageType.DATA, player.user_id,
+                                   (player.version, self.history.count(player.user_id)),
+                                   lambda: {**player.info,
+                                            Info.RATING_HISTORY.value: self.history.sparkline(player.user_id)})
+
+    async def handle(self, reader, writer):
+        await ClientSession(self, reader, writer).run()
+
+    async def serve(self):
+        self.competitive_matchmaking = AsyncMatchmakingSystem(self, 2, True)
+        self.casual_matchmaking = AsyncCasualMatchmakingSystem(self, 2)
+        self.competitive_matchmaking.leaderboard.build(player for player in self.players.values() if player.games)
+        self.storage.start()
+        self.metrics_dump.start()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1,
+                                                      lambda: print(self.profiler.toggle(ProfilingMode.SAMPLING)))
+        matchmaking = asyncio.create_task(self.competitive_matchmaking.run())
+        casual_matchmaking = asyncio.create_task(self.casual_matchmaking.run())
+        server = await asyncio.start_server(self.handle, self.host, self.port, reuse_address=True, backlog=4096)
+        print("\nWaiting for a connection...")
+        async with server:
+            await server.serve_forever()
+        matchmaking.cancel()
+        casual_matchmaking.cancel()
+
+    def execute(self):
+        # Allow as many connections as the system does.
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        try:
+            asyncio.run(self.serve())
+        except OSError as e:
+            print(e)
+
+
+if __name__ == "__main__":
+    game_server = AsyncServer()
+    game_server.execute()
@@ -0,0 +1,549 @@
+import sys
+import types
+import math
+import queue
+import time
+import tempfile
+import threading
+import random
+import itertools
+import numpy as np
+import elo
+from player import Player, PlayerStore
+from lobby import SoloLobby, LobbyIndex
+from leaderboard import Leaderboard
+from storage import Storage
+from scheduler import LobbyScheduler
+from simulation import Simulation
+from metrics import Metrics, RATING_BUCKETS
+from sharding import QueueEntry, ShardRouter, band_boundaries, HANDOFF_DELAY
+from server import MatchmakingSystem, QueueTicket
+from rating import ENGINES
+from profiler import Profiler, ProfilingMode
+from history import MatchHistory
+from protocol import CODECS, MessageType, SharedFrame, FrameCache, encode_frame
+
+
+# Time a callable over a number of repetitions and return the average duration in seconds.
+def measure(function, repetitions=1):
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        function()
+    return (time.perf_counter() - start) / repetitions
+
+
+# Create n players with random ratings and the odds of winning between each of them.
+def random_players(n, seed=0):
+    rng = random.Random(seed)
+    store = PlayerStore()
+    players = [Player(i, "Player-{}".format(i), rng.randint(800, 2600), store) for i in range(n)]
+    odds = {player.username: {} for player in players}
+    for player in players:
+        for opponent in players:
+            if player is not opponent:
+                odds[player.username][opponent.username] =\
+                    player.predict_score(opponent)
+    return players, odds
+
+
+# Reference implementation of the placement probabilities that enumerates every combination of beaten opponents.
+def exhaustive_placements(player, odds):
+    n = len(odds)
+    predictions = [0] * n
+    player_username = player.username
+    for i in range(len(predictions)):
+        wins = itertools.combinations(odds[player_username], n - 1 - i)
+        for win_combination in wins:
+            pi = np.prod([odds[player_username][opponent_username] for opponent_username in win_combination])
+            loss_combination = set(odds[player_username]) - set(win_combination)
+            pi *= np.prod([odds[opponent_username][player_username] for opponent_username in loss_combination])
+            predictions[i] += pi
+    return predictions
+
+
+# Compare the exhaustive and the polynomial placement probabilities for lobbies of 2 to 64 players.
+def placements(max_players=64, max_exhaustive_players=16):
+    print("\nPLACEMENTS")
+    print("%-10s%-20s%-20s" % ("PLAYERS", "EXHAUSTIVE (ms)", "POLYNOMIAL (ms)"))
+    for n in range(2, max_players + 1):
+        players, odds = random_players(n, seed=n)
+        player = players[0]
+        predictions = player.predict_placements(odds)
+        polynomial = measure(lambda: player.predict_placements(odds), 10) * 1000
+        exhaustive = "-"
+        if n <= max_exhaustive_players:
+            expected = exhaustive_placements(player, odds)
+            assert all(math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-12) for a, b in zip(predictions, expected)),\
+                "Placement probabilities differ for {} players.".format(n)
+            exhaustive = "%.3f" % (measure(lambda: exhaustive_placements(player, odds)) * 1000)
+        print("%-10s%-20s%-20s" % (n, exhaustive, "%.3f" % polynomial))
+
+
+# Create open lobbies of the given capacity, each partially filled with players of close ratings.
+def random_lobbies(count, capacity, seed=0):
+    rng = random.Random(seed)
+    store = PlayerStore()
+    lobbies = []
+    user_id = 0
+    for _ in range(count):
+        lobby = SoloLobby(capacity)
+        rating = rng.randint(0, 3000)
+        for _ in range(rng.randint(1, capacity - 1)):
+            lobby.fill(Player(user_id, "Player-{}".format(user_id), rating + rng.randint(-50, 50), store))
+            user_id += 1
+        lobbies.append(lobby)
+    return lobbies
+
+
+# Compare the time to find a lobby for a player between a linear scan and the rating index of open lobbies.
+def lobby_search(counts=(10, 100, 1000, 10000), capacity=2, attempts=200):
+    print("\nLOBBY SEARCH")
+    print("%-10s%-20s%-20s" % ("LOBBIES", "LINEAR (us)", "INDEXED (us)"))
+    rng = random.Random(0)
+    for count in counts:
+        lobbies = random_lobbies(count, capacity, seed=count)
+        index = LobbyIndex(capacity)
+        for lobby in lobbies:
+            index.add(lobby)
+        ratings = [rng.randint(0, 4000) for _ in range(attempts)]  # Some players are out of reach of every lobby.
+        for rating in ratings:
+            linear_lobby = next((lobby for lobby in lobbies if lobby.admits(rating)), None)
+            indexed_lobby = next((lobby for lobby in index.candidates(rating) if lobby.admits(rating)), None)
+            assert (linear_lobby is None) == (indexed_lobby is None)
+        linear = measure(lambda: [next((lobby for lobby in lobbies if lobby.admits(rating)), None)
+                                  for rating in ratings]) / attempts * 1e6
+        indexed = measure(lambda: [next((lobby for lobby in index.candidates(rating) if lobby.admits(rating)), None)
+                                   for rating in ratings]) / attempts * 1e6
+        print("%-10s%-20s%-20s" % (count, "%.1f" % linear, "%.1f" % indexed))
+
+
+# Compare the time to update the leaderboard after a match between sorting every player and the skip list.
+def leaderboard(sizes=(1000, 10000, 100000), updates=200):
+    print("\nLEADERBOARD")
+    print("%-10s%-20s%-20s%-20s" % ("PLAYERS", "SORTED (ms)", "SKIP LIST (us)", "PAGE OF 50 (us)"))
+    rng = random.Random(0)
+    for size in sizes:
+        store = PlayerStore()
+        players = [Player(i, "Player-{}".format(i), rng.randint(0, 3000), store) for i in range(size)]
+        ranking = Leaderboard(seed=0)
+        for player in players:
+            ranking.update(player)
+        matches = [rng.sample(players, 2) for _ in range(updates)]
+
+        def sort_leaderboard():
+            players.sort(key=lambda x: x.rating, reverse=True)
+            for i in range(len(players)):
+                players[i].rank = i + 1
+
+        def update_leaderboard():
+            for match in matches:
+                for player in match:
+                    player.set_rating(rng.randint(0, 3000))
+                    ranking.update(player)
+
+        sorted_time = measure(sort_leaderboard, 5) * 1000
+        skip_list_time = measure(update_leaderboard) / updates * 1e6
+        page_time = measure(lambda: ranking.players(rng.randint(1, size), 50), 200) * 1e6
+        print("%-10s%-20s%-20s%-20s" % (size, "%.2f" % sorted_time, "%.1f" % skip_list_time, "%.1f" % page_time))
+
+
+# Measure the time to restart from a snapshot of a million players followed by a log of rating updates.
+def restart(size=1000000, updates=100000):
+    print("\nRESTART")
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as path:
+        storage = Storage(path)
+        store = PlayerStore()
+        storage.load(store)
+        store.reserve(size - 1)
+        store.usernames = ["Player-{}".format(i) for i in range(size)]
+        store.size = size
+        store.ratings[:size] = rng.integers(0, 3000, size)
+        store.games[:size] = rng.integers(1, 100, size)
+        storage.usernames = list(store.usernames)
+        storage.passwords = ["password"] * size
+        start = time.perf_counter()
+        storage.snapshot()
+        print("%-30s%.2f s" % ("SNAPSHOT OF {} PLAYERS".format(size), time.perf_counter() - start))
+        players = [Player.view(store, int(user_id)) for user_id in rng.integers(0, size, updates)]
+        start = time.perf_counter()
+        for i in range(0, updates, 2):
+            storage.record_results(players[i:i + 2])
+        print("%-30s%.2f us" % ("RECORD A MATCH", (time.perf_counter() - start) / (updates // 2) * 1e6))
+        storage.start()
+        storage.stop()
+
+        start = time.perf_counter()
+        restored_store = PlayerStore()
+        accounts, restored_players = Storage(path).load(restored_store)
+        load_time = time.perf_counter() - start
+        assert len(restored_players) == size and (restored_store.ratings[:size] == store.ratings[:size]).all()
+        start = time.perf_counter()
+        Leaderboard().build(restored_players.values())
+        leaderboard_time = time.perf_counter() - start
+        print("%-30s%.2f s" % ("LOAD", load_time))
+        print("%-30s%.2f s" % ("LEADERBOARD", leaderboard_time))
+
+
+# Finish 10k simultaneous matches through the scheduler and report their completion latency and the threads used.
+def scheduler(matches=10000, duration=2):
+    print("\nSCHEDULER")
+    lobby_scheduler = LobbyScheduler(report_interval=3600)
+    lobby_scheduler.start()
+    finished = threading.Semaphore(0)
+    rng = random.Random(0)
+    for _ in range(matches):
+        lobby_scheduler.schedule(duration + rng.random(), finished.release)
+    for _ in range(matches):
+        finished.acquire()
+    time.sleep(0.1)
+    print("%-30s%s" % ("THREADS", threading.active_count()))
+    print("%-30s%s" % ("LATENCY", lobby_scheduler.latency.summary()))
+
+
+# Simulate matches without a server, with lobbies played together and one at a time, for several lobby sizes.
+def simulation(matches=100000, capacities=(2, 4, 8)):
+    print("\nSIMULATION")
+    print("%-12s%-20s%-20s" % ("LOBBY SIZE", "BATCHED", "EXACT"))
+    for capacity in capacities:
+        batched = Simulation(capacity=capacity).run(matches // capacity)
+        exact = Simulation(capacity=capacity, exact=True).run(matches // capacity // 10)
+        print("%-12s%-20s%-20s" % (capacity, "{} /min".format(batched["MATCHES PER MINUTE"]),
+                                   "{} /min".format(exact["MATCHES PER MINUTE"])))
+
+
+# Compare the cost of the metrics with the work they are attached to. The matchmaking thread sets the queue depth and
+# open lobbies gauges for each player it places, and the start of each match of two players counts the match and
+# observes its rating spread, its fill time and the queue time of both players.
+def metrics(players=100000, updates=1000000):
+    print("\nMETRICS")
+    registry = Metrics()
+    counter = registry.counter("MATCHES")
+    gauge = registry.gauge("QUEUE DEPTH")
+    histogram = registry.histogram("QUEUE WAIT TIME")
+    spread = registry.histogram("LOBBY RATING SPREAD", RATING_BUCKETS)
+    values = [random.Random(0).random() for _ in range(1000)]
+    costs = {"COUNTER": measure(lambda: [counter.inc() for _ in range(updates)]) / updates,
+             "GAUGE": measure(lambda: [gauge.set(i) for i in range(updates)]) / updates,
+             "HISTOGRAM": measure(lambda: [histogram.observe(values[i % 1000]) for i in range(updates)]) / updates,
+             "RATING HISTOGRAM": measure(lambda: [spread.observe(i % 1000) for i in range(updates)]) / updates}
+    for name, cost in costs.items():
+        print("%-30s%.0f ns" % (name, cost * 1e9))
+
+    simulation = Simulation(players, exact=True)
+    simulation.enqueue(players)
+    lobbies = []
+    placement = measure(lambda: lobbies.extend(simulation.matchmaking())) / players
+    match = measure(lambda: [simulation.play_lobby(lobby) for lobby in lobbies]) / len(lobbies)
+    placement_metrics = 2 * costs["GAUGE"]
+    match_metrics = costs["COUNTER"] + 3 * costs["HISTOGRAM"] + costs["RATING HISTOGRAM"]
+    print("%-30s%.2f us + %.2f us (%.1f%%)" % ("PLACING A PLAYER", placement * 1e6, placement_metrics * 1e6,
+                                                placement_metrics / placement * 100))
+    print("%-30s%.2f us + %.2f us (%.1f%%)" % ("STARTING A MATCH", match * 1e6, match_metrics * 1e6,
+                                                match_metrics / match * 100))
+
+
+# Place players through 1 to 8 matchmaking shards and report the matches filled per second, the shards being started
+# beforehand so that only the matchmaking is measured.
+def sharding(players=200000, shard_counts=(1, 2, 4, 8), batch_size=256):
+    print("\nSHARDING")
+    rng = np.random.default_rng(0)
+    ratings = rng.normal(1500, 300, players).round().astype(int).tolist()
+    now = time.monotonic()
+    entries = [QueueEntry(user_id, "Player-{}".format(user_id), rating, now) for user_id, rating in enumerate(ratings)]
+    for shards in shard_counts:
+        router = ShardRouter(2, band_boundaries(ratings, shards))
+        router.start()
+        time.sleep(2)  # Let the shards import their modules.
+        start = time.perf_counter()
+        for i in range(0, players, batch_size):
+            router.route(entries[i:i + batch_size])
+        matched = 0
+        end = start
+        try:
+            while True:
+                matched += len(router.receive(timeout=HANDOFF_DELAY))
+                end = time.perf_counter()
+        except queue.Empty:
+            pass
+        elapsed = end - start
+        router.stop()
+        print("%-30s%.0f matches/s" % ("{} SHARDS".format(shards), matched / elapsed))
+
+
+# Compare placing players one at a time with forming lobbies out of the whole queue at every tick, at the same arrival
+# rate, on the CPU time spent per match, the rating spread of the matches and the wait of the players.
+def batching(matches=100000, ticks=(None, 0.01, 0.05, 0.2), capacity=4, arrival_rate=1000):
+    print("\nBATCHING")
+    print("%-12s%-20s%-16s%-16s%-16s" % ("TICK (s)", "MATCHES PER MINUTE", "RATING SPREAD", "P50 WAIT (s)",
+                                         "P99 WAIT (s)"))
+    for tick in ticks:
+        report = Simulation(capacity=capacity, arrival_rate=arrival_rate, rating_deviation=300, tick=tick).run(matches)
+        print("%-12s%-20s%-16s%-16s%-16s" % (tick or "-", report["MATCHES PER MINUTE"], report["AVERAGE RATING SPREAD"],
+                                             report["P50 WAIT (s)"], report["P99 WAIT (s)"]))
+
+
+# Compare looking the strengths of the ratings up in the table of elo.strengths with computing them, when predicting
+# and simulating the matches of single lobbies, when predicting 2048 lobbies at once, and in Player.predict_score.
+def strengths(repetitions=20000, capacities=(2, 8), batch_size=2048, rounds=5):
+    print("\nSTRENGTHS")
+    table_strengths = elo.strengths
+    table_expected_score = elo.expected_score
+
+    def computed_strengths(ratings):
+        return np.power(10, np.asarray(ratings) / 400)
+
+    # The scalar formula the table replaced, which computes both strengths with math.pow for every prediction.
+    def computed_expected_score(player_rating, opponent_rating):
+        player_strength = math.pow(10, player_rating / 400)
+        opponent_strength = math.pow(10, opponent_rating / 400)
+        return player_strength / (player_strength + opponent_strength)
+
+    rng = random.Random(0)
+    benchmarks = []
+    for capacity in capacities:
+        players = random_players(capacity)[0]
+
+        def play(players=players, capacity=capacity):
+            lobby = SoloLobby(capacity)
+            lobby.assign(players)
+            lobby.predict_outcome()
+            lobby.simulate_match(False, rng)
+        benchmarks.append(("LOBBY OF {}".format(capacity), play, repetitions))
+    ratings = np.array([[rng.randint(800, 2600) for _ in range(2)] for _ in range(batch_size)])
+    benchmarks.append(("{} LOBBIES OF 2".format(batch_size),
+                       lambda: elo.predict_placements(elo.expected_scores(ratings)), repetitions // 100))
+    player, opponent = random_players(2)[0]
+    benchmarks.append(("PREDICT SCORE", lambda: player.predict_score(opponent), repetitions * 10))
+
+    # Both variants are measured in turn, keeping the best of a few rounds of each, so that a slow round doesn't pass
+    # for a difference between them.
+    print("%-30s%-16s%-16s%s" % ("", "COMPUTED", "TABLE", "SPEEDUP"))
+    for name, function, count in benchmarks:
+        computed, table = math.inf, math.inf
+        for _ in range(rounds):
+            elo.strengths, elo.expected_score = computed_strengths, computed_expected_score
+            computed = min(computed, measure(function, count))
+            elo.strengths, elo.expected_score = table_strengths, table_expected_score
+            table = min(table, measure(function, count))
+        print("%-30s%-16s%-16s%.2fx" % (name, "%.2f us" % (computed * 1e6), "%.2f us" % (table * 1e6),
+                                         computed / table))
+
+
+# Reference admission check that recomputes the mean and the variance of the ratings of every player of the lobby.
+def recomputed_admits(lobby, player_rating):
+    ratings = [player.rating for player in lobby.players] + [player_rating]
+    average_rating = sum(ratings) / len(ratings)
+    rating_variance = sum([math.pow(rating - average_rating, 2) for rating in ratings]) / (len(ratings) - 1)
+    return rating_variance <= math.pow(lobby.tolerance.base, 2)
+
+
+# Measure the cost of filling a lobby, checking whether a player can join it, predicting the outcome of its match and
+# simulating it, for lobbies of 2 to 100 players. Admission checks are timed against a lobby one player short of full.
+def capacity(capacities=(2, 4, 8, 16, 32, 50, 64, 100), repetitions=200):
+    print("\nCAPACITY")
+    print("%-10s%-16s%-16s%-16s%-16s%-16s" % ("PLAYERS", "FILL (us)", "ADMITS (us)", "RECOMPUTED (us)",
+                                              "PREDICT (ms)", "SIMULATE (ms)"))
+    rng = random.Random(0)
+    for n in capacities:
+        players = random_players(n, seed=n)[0]
+        for player in players:
+            player.set_rating(1500 + rng.randint(-100, 100))
+
+        def fill():
+            lobby = SoloLobby(n)
+            for player in players:
+                lobby.fill(player)
+            return lobby
+        lobby = fill()
+        fill_time = measure(fill, repetitions) / n * 1e6
+        lobby.remove(players[-1])
+        rating = players[-1].rating
+        assert lobby.admits(rating) == recomputed_admits(lobby, rating)
+        admits = measure(lambda: lobby.admits(rating), repetitions * 10) * 1e6
+        recomputed = measure(lambda: recomputed_admits(lobby, rating), repetitions * 10) * 1e6
+        lobby.fill(players[-1])
+        predict = measure(lobby.predict_outcome, repetitions) * 1000
+        simulate = measure(lambda: lobby.simulate_match(True, rng), repetitions) * 1000
+        print("%-10s%-16s%-16s%-16s%-16s%-16s" % (n, "%.2f" % fill_time, "%.2f" % admits, "%.2f" % recomputed,
+                                                  "%.3f" % predict, "%.3f" % simulate))
+
+
+# Stands in for the server of a matchmaking system, with a scheduler that drops the matches of the full lobbies.
+class BenchmarkServer:
+    def __init__(self, players):
+        self.metrics = Metrics()
+        self.profiler = Profiler(tempfile.gettempdir())  # Never started, so that it writes nothing.
+        self.scheduler = self
+        self.players = {player.username: player for player in players}
+
+    def submit(self, function, *args):
+        pass
+
+
+# Measure how many players per second the matchmaking workers place while client threads queue players up, from 1 to
+# 32 workers, with the queue in a single band and split into rating bands.
+def contention(players=20000, worker_counts=(1, 2, 4, 8, 16, 32), band_counts=(1, 8), clients=8):
+    print("\nCONTENTION")
+    print("%-10s" % "WORKERS" + "".join("%-20s" % "{} BAND{}".format(bands, "S" if bands > 1 else "")
+                                        for bands in band_counts))
+    rng = np.random.default_rng(0)
+    store = PlayerStore(players)
+    population = [Player(i, "Player-{}".format(i), rating, store)
+                  for i, rating in enumerate(rng.normal(1500, 300, players).round().astype(int).tolist())]
+    for player in population:
+        player.win()  # Players who have played are used to compute the rating bands.
+    for workers in worker_counts:
+        rates = []
+        for bands in band_counts:
+            server = BenchmarkServer(population)
+            system = MatchmakingSystem(server, 2, True, bands=bands)
+            system.channels_count = workers
+            threads = [threading.Thread(target=system.matchmaking, args=(i % bands,), daemon=True)
+                       for i in range(workers)]
+            for thread in threads:
+                thread.start()
+            tickets = [QueueTicket(types.SimpleNamespace(player=player, connection=None), "COMPETITIVE")
+                       for player in population]
+            start = time.perf_counter()
+            producers = [threading.Thread(target=lambda i=i: [system.enqueue(ticket)
+                                                              for ticket in tickets[i::clients]])
+                         for i in range(clients)]
+            for producer in producers:
+                producer.start()
+            for producer in producers:
+                producer.join()
+            while system.queue_depth.snapshot():
+                time.sleep(0.001)
+            rates.append(players / (time.perf_counter() - start))
+            system.stop()
+            for thread in threads:
+                thread.join()
+        print("%-10s" % workers + "".join("%-20s" % ("%.0f /s" % rate) for rate in rates))
+
+
+# Measure how many player ratings each rating engine updates per second, rating a whole period at once in which every
+# player plays one match, and rating the matches one at a time as they end.
+def rating_engines(sizes=(10000, 100000, 1000000), capacity=2, single_matches=2000):
+    print("\nRATING ENGINES")
+    print("%-12s%-12s%-24s%-24s" % ("ENGINE", "PLAYERS", "RATING PERIOD", "ONE MATCH AT A TIME"))
+    rng = np.random.default_rng(0)
+    for name, engine_class in ENGINES.items():
+        for size in sizes:
+            store = PlayerStore(size)
+            store.ratings[:] = rng.normal(1200, 200, size).round()
+            store.size = size
+            engine = engine_class(store, batched=True)
+            engine.grow()
+            orders = rng.permutation(size).reshape(-1, capacity)
+            engine.record(orders)
+            batched = measure(engine.apply)
+            single = measure(lambda: [engine.rate(match) for match in orders[:single_matches]])
+            print("%-12s%-12s%-24s%-24s" % (name, size, "%.0f /s" % (size / batched),
+                                            "%.0f /s" % (single_matches * capacity / single)))
+
+
+# Compare encoding the result of a match for each of its players with encoding it once, and encoding a profile on every
+# request with sending the frame cached for its version, with each codec.
+def encoding(capacities=(2, 8, 32, 100), repetitions=2000):
+    print("\nENCODING")
+    print("%-20s%-12s%-16s%-16s%s" % ("", "CODEC", "EVERY TIME", "ONCE", "SPEEDUP"))
+    for capacity in capacities:
+        players = random_players(capacity)[0]
+        lobby = SoloLobby(capacity)
+        lobby.assign(players)
+        lobby.predict_outcome()
+        result = {"BEFORE": lobby.display_players(), "PREDICTIONS": lobby.display_predictions(),
+                  "AFTER": lobby.display_players(),
+                  "QUEUE TIMES": {player.username: 0.5 for player in players}}
+
+        def send_once(codec):
+            shared = SharedFrame(MessageType.EVENT, result)
+            return [shared.frame(codec) for _ in players]
+        for codec in CODECS.values():
+            every_time = measure(lambda: [encode_frame(codec, MessageType.EVENT, result) for _ in players],
+                                 repetitions // capacity)
+            once = measure(lambda: send_once(codec), repetitions // capacity)
+            print("%-20s%-12s%-16s%-16s%.2fx" % ("RESULT OF {}".format(capacity), codec.name,
+                                                 "%.2f us" % (every_time * 1e6), "%.2f us" % (once * 1e6),
+                                                 every_time / once))
+    player = random_players(1)[0][0]
+    profiles = FrameCache()
+    for codec in CODECS.values():
+        every_time = measure(lambda: encode_frame(codec, MessageType.DATA, player.info), repetitions * 10)
+        cached = measure(lambda: profiles.frame(codec, MessageType.DATA, player.user_id, player.version,
+                                                lambda: player.info), repetitions * 10)
+        print("%-20s%-12s%-16s%-16s%.2fx" % ("PROFILE", codec.name, "%.2f us" % (every_time * 1e6),
+                                             "%.2f us" % (cached * 1e6), every_time / cached))
+
+
+# Measure the cost of a span around a call, with the profiler stopped, recording spans and sampling the stacks.
+def profiler(repetitions=1000000):
+    print("\nPROFILER")
+    with tempfile.TemporaryDirectory() as path:
+        profiler = Profiler(path)
+
+        def call():
+            pass
+
+        def spanned():
+            with profiler.span("CALL"):
+                call()
+        bare = measure(call, repetitions)
+        print("%-20s%s" % ("NO SPAN", "%.3f us" % (bare * 1e6)))
+        print("%-20s%s" % ("STOPPED", "%.3f us" % (measure(spanned, repetitions) * 1e6)))
+        for mode in ProfilingMode:
+            profiler.start(mode)
+            duration = measure(spanned, repetitions)
+            profiler.stop()
+            print("%-20s%s" % (mode.value, "%.3f us" % (duration * 1e6)))
+
+
+# Measure recording matches in the match history, and reading the last matches of a player through the index of their
+# rows compared with scanning the user ids of every row, as the history grows. The history is then loaded again.
+def history(sizes=(10000, 100000, 1000000), players=10000, capacity=2, queries=1000):
+    print("\nHISTORY")
+    print("%-12s%-20s%-20s%-20s%-16s" % ("MATCHES", "RECORD", "INDEXED SPARKLINE", "SCANNED SPARKLINE", "LOAD"))
+    rng = random.Random(0)
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as path:
+            match_history = MatchHistory(path).load()
+            matches = [rng.sample(range(players), capacity) for _ in range(size)]
+            record = measure(lambda: [match_history.record(user_ids, [1200] * capacity, [1216, 1184])
+                                      for user_ids in matches]) / size
+            user_ids = [rng.randrange(players) for _ in range(queries)]
+            indexed = measure(lambda: [match_history.sparkline(user_id) for user_id in user_ids]) / queries
+
+            def scan(user_id):
+                rows = np.concatenate([np.flatnonzero(chunk["user_id"] == user_id) + number * match_history.chunk_rows
+                                       for number, chunk in enumerate(match_history.chunks)])
+                return match_history.gather(rows[-20:])
+            scanned = measure(lambda: [scan(user_id) for user_id in user_ids[:queries // 10]]) / (queries // 10)
+            match_history.flush()
+            load = measure(lambda: MatchHistory(path).load())
+            print("%-12s%-20s%-20s%-20s%-16s" % (size, "%.2f us" % (record * 1e6), "%.2f us" % (indexed * 1e6),
+                                                 "%.2f us" % (scanned * 1e6), "%.2f s" % load))
+
+
+BENCHMARKS = {"placements": placements,
+              "lobby_search": lobby_search,
+              "leaderboard": leaderboard,
+              "restart": restart,
+              "scheduler": scheduler,
+              "simulation": simulation,
+              "metrics": metrics,
+              "sharding": sharding,
+              "batching": batching,
+              "strengths": strengths,
+              "capacity": capacity,
+              "contention": contention,
+              "rating_engines": rating_engines,
+              "encoding": encoding,
+              "profiler": profiler,
+              "history": history}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
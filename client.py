@@ -7,6 +7,8 @@ import getpass
 from enum import Enum
 from player import Info
 from threading import Thread
+from protocol import Connection, ProtocolError
+from leaderboard import Paging
 
 
 class Commands(Enum):
@@ -16,8 +18,20 @@ class Commands(Enum):
     SIGN_OUT = "SIGN OUT"
     CASUAL = "CASUAL"
     COMPETITIVE = "COMPETITIVE"
+    CANCEL = "CANCEL"
+    QUEUE_STATUS = "QUEUE STATUS"
     PROFILE = "PROFILE"
     LEADERBOARD = "LEADERBOARD"
+    STATS = "STATS"
+    PROFILER = "PROFILER"
+
+
+# The password of an automated account only depends on its username, so that the account can be signed into again
+# after the server restarts with its accounts.
+def automated_password(username):
+    password_generator = random.Random(username)
+    return "".join([password_generator.choice(string.ascii_letters + string.digits + string.punctuation) for
+                    i in range(10)])
 
 
 class AutomatedClient(Thread):
@@ -25,7 +39,7 @@ class AutomatedClient(Thread):
         Thread.__init__(self)
         self.client_id = client_id
         self.pre_credentials_commands = [Commands.SIGN_UP.value, Commands.SIGN_IN.value]
-        self.post_credentials_commands = [Commands.COMPETITIVE.value]
+        self.post_credentials_commands = [Commands.CASUAL.value, Commands.COMPETITIVE.value]
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.host = host
         self.port = port
@@ -35,6 +49,8 @@ class AutomatedClient(Thread):
         while True:
             try:
                 self.socket.connect((self.host, self.port))
+                connection = Connection(self.socket)
+                connection.negotiate()
 
                 # Before signing up/signing in.
                 while True:
@@ -42,31 +58,24 @@ class AutomatedClient(Thread):
                     command = Commands.SIGN_UP.value if len(self.accounts) == 0\
                         else random.choice(self.pre_credentials_commands)
                     if command == Commands.SIGN_UP.value:
-                        self.socket.send(str.encode(command))
-                        credentials = self.socket.recv(2048)
-                        account = json.loads(credentials.decode("utf-8"))
+                        connection.send_command(command)
+                        account = connection.recv_data()
                         username = "Player-{}".format(self.client_id)
-                        password = "".join(
-                            [random.SystemRandom().choice(string.ascii_letters + string.digits + string.punctuation) for
-                             i in range(10)])
                         account[Info.USERNAME.value] = username
-                        account[Info.PASSWORD.value] = password
-                        credentials = json.dumps(account)
-                        self.socket.send(str.encode(credentials))
-                        confirmation = self.socket.recv(2048)
+                        account[Info.PASSWORD.value] = automated_password(username)
+                        connection.send_data(account)
+                        confirmation = connection.recv_data()
+                        self.accounts[username] = account
                         if confirmation:
-                            self.accounts[username] = account
                             break
                     elif command == Commands.SIGN_IN.value:
-                        self.socket.send(str.encode(command))
-                        credentials = self.socket.recv(2048)
-                        account = json.loads(credentials.decode("utf-8"))
-                        username = random.choice(self.accounts)
+                        connection.send_command(command)
+                        account = connection.recv_data()
+                        username = random.choice(list(self.accounts))
                         account[Info.USERNAME.value] = username
                         account[Info.PASSWORD.value] = self.accounts[username][Info.PASSWORD.value]
-                        credentials = json.dumps(account)
-                        self.socket.send(str.encode(credentials))
-                        confirmation = self.socket.recv(2048)
+                        connection.send_data(account)
+                        confirmation = connection.recv_data()
                         if confirmation:
                             break
 
@@ -74,9 +83,13 @@ class AutomatedClient(Thread):
                 while True:
                     time.sleep(random.randint(2, 5))
                     command = random.choice(self.post_credentials_commands)
-                    self.socket.send(str.encode(command))
-                    result = self.socket.recv(2048)
-            except socket.error:
+                    connection.send_command(command)
+                    confirmation = connection.recv_data()
+
+                    # Wait for the result of the match.
+                    if confirmation["QUEUED"]:
+                        result = connection.recv_event()
+            except (socket.error, ProtocolError):
                 self.socket.close()
                 return
 
@@ -84,17 +97,45 @@ class AutomatedClient(Thread):
 class ManualClient:
     def __init__(self, host="127.0.0.1", port=1233):
         self.pre_credentials_commands = [Commands.SIGN_UP.value, Commands.SIGN_IN.value]
-        self.post_credentials_commands = [Commands.COMPETITIVE.value, Commands.PROFILE.value, Commands.LEADERBOARD.value]
+        self.post_credentials_commands = [Commands.CASUAL.value, Commands.COMPETITIVE.value,
+                                          Commands.QUEUE_STATUS.value, Commands.CANCEL.value, Commands.PROFILE.value,
+                                          Commands.LEADERBOARD.value, Commands.STATS.value]
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.host = host
         self.port = port
+        self.connection = None
+        self.username = None
+
+    def print_result(self, result):
+        max_username_length = 0
+        headers = list(result.keys())
+        for player in result[headers[0]]:
+            username_length = len(player[Info.USERNAME.value])
+            if username_length > max_username_length:
+                max_username_length = username_length
+        padding = 5
+        total_padding = max_username_length + padding
+        dash = "-" * total_padding * len(result[headers[0]][0])
+        columns = "%-{}s".format(total_padding) * len(result[headers[0]][0])
+        for header in headers:
+            if not isinstance(result[header], list):
+                continue
+            print("\n" + header)
+            print(dash)
+            print(columns % tuple([key for key in result[header][0]]))
+            print(dash)
+            for player in result[header]:
+                print(columns % tuple([value for value in player.values()]))
+        print("\nQueued for {} s.".format(result["QUEUE TIMES"][self.username]))
 
     def execute(self):
         while True:
             try:
                 # Before signing up/signing in.
                 self.socket.connect((self.host, self.port))
+                self.connection = Connection(self.socket)
+                self.connection.negotiate()
                 while True:
                     client_input = input("\nEnter your command (type 'help' for a list of commands): ")
                     command = client_input.upper()
@@ -103,114 +144,126 @@ class ManualClient:
                         for i in range(len(self.pre_credentials_commands)):
                             print("-{}".format(self.pre_credentials_commands[i]).lower())
                     elif command == Commands.SIGN_UP.value:
-                        self.socket.send(str.encode(command))
-                        credentials = self.socket.recv(2048)
-                        account = json.loads(credentials.decode("utf-8"))
+                        self.connection.send_command(command)
+                        account = self.connection.recv_data()
                         username = input("Enter your username: ")
                         password = getpass.getpass(prompt="Enter your password: ")
                         account[Info.USERNAME.value] = username
                         account[Info.PASSWORD.value] = password
-                        credentials = json.dumps(account)
-                        self.socket.send(str.encode(credentials))
-                        data = self.socket.recv(2048)
-                        confirmation = json.loads(data.decode("utf-8"))
+                        self.connection.send_data(account)
+                        confirmation = self.connection.recv_data()
                         if confirmation:
                             print("\nWelcome, {}!".format(username))
+                            self.username = username
                             break
                         else:
                             print("\nUsername already exists.\n")
                     elif command == Commands.SIGN_IN.value:
-                        self.socket.send(str.encode(command))
-                        credentials = self.socket.recv(2048)
-                        account = json.loads(credentials.decode("utf-8"))
+                        self.connection.send_command(command)
+                        account = self.connection.recv_data()
                         username = input("Enter your username: ")
                         password = getpass.getpass(prompt="Enter your password: ")
                         account[Info.USERNAME.value] = username
                         account[Info.PASSWORD.value] = password
-                        credentials = json.dumps(account)
-                        self.socket.send(str.encode(credentials))
-                        data = self.socket.recv(2048)
-                        confirmation = json.loads(data.decode("utf-8"))
+                        self.connection.send_data(account)
+                        confirmation = self.connection.recv_data()
                         if confirmation:
                             print("\nWelcome, {}!".format(username))
+                            self.username = username
                             break
                         else:
                             print("\nInvalid credentials.")
                     else:
                         print("\n'{}' is an invalid command.".format(client_input))
 
-                # After signing up/signing in.
+                # After signing up/signing in. The results of the matches are shown as they arrive, before each prompt.
                 while True:
+                    for result in self.connection.pending_events():
+                        self.print_result(result)
                     client_input = input("\nEnter your command (type 'help' for a list of commands): ")
                     command = client_input.upper()
                     if command == Commands.HELP.value:
                         print("\nAvailable commands:")
-                        for i in range(len(self.pre_credentials_commands)):
-                            print("-{}".format(self.post_credentials_commands[i]).lower())
-                    elif command == Commands.COMPETITIVE.value:
-                        self.socket.send(str.encode(command))
-                        print("\nSearching for a game...")
-                        data = self.socket.recv(2048)
-                        result = json.loads(data.decode("utf-8"))
-                        max_username_length = 0
-                        headers = list(result.keys())
-                        for player in result[headers[0]]:
-                            username_length = len(player[Info.USERNAME.value])
-                            if username_length > max_username_length:
-                                max_username_length = username_length
-                        padding = 5
-                        total_padding = max_username_length + padding
-                        dash = "-" * total_padding * len(result[headers[0]][0])
-                        columns = "%-{}s".format(total_padding) * len(result[headers[0]][0])
-                        for header in headers:
-                            print("\n" + header)
-                            print(dash)
-                            print(columns % tuple([key for key in result[header][0]]))
-                            print(dash)
-                            for player in result[header]:
-                                print(columns % tuple([value for value in player.values()]))
+                        for post_credentials_command in self.post_credentials_commands:
+                            print("-{}".format(post_credentials_command).lower())
+                    elif command == Commands.CASUAL.value or command == Commands.COMPETITIVE.value:
+                        self.connection.send_command(command)
+                        confirmation = self.connection.recv_data()
+                        if confirmation["QUEUED"]:
+                            print("\nSearching for a game...")
+                        else:
+                            print("\nAlready queued up for a {} game.".format(confirmation["QUEUE"].lower()))
+                    elif command == Commands.CANCEL.value:
+                        self.connection.send_command(command)
+                        if self.connection.recv_data():
+                            print("\nLeft the queue.")
+                        else:
+                            print("\nNot in a queue, or the game has already been found.")
+                    elif command == Commands.QUEUE_STATUS.value:
+                        self.connection.send_command(command)
+                        status = self.connection.recv_data()
+                        if status["QUEUE"]:
+                            print("\n{} in the {} queue for {} s.".format(status["STATUS"], status["QUEUE"].lower(),
+                                                                          status["WAIT"]))
+                        else:
+                            print("\n{}".format(status["STATUS"]))
                     elif command == Commands.PROFILE.value:
-                        self.socket.send(str.encode(command))
-                        data = self.socket.recv(2048)
-                        profile = json.loads(data.decode("utf-8"))
+                        self.connection.send_command(command)
+                        profile = self.connection.recv_data()
                         dash = "-" * (len(profile[Info.USERNAME.value]) + len(Info.USERNAME.value))
                         print("\nPROFILE")
                         print(dash)
                         for key in profile:
                             print("{}: {}".format(key, profile[key]))
                     elif command == Commands.LEADERBOARD.value:
-                        self.socket.send(str.encode(command))
-                        data = self.socket.recv(1024)
-                        count = json.loads(data.decode("utf-8"))  # Receive the total number of players to display.
-                        max_username_length = 0
-                        players = []
-                        while count > 0:
-                            data = self.socket.recv(4096)
-                            leaderboard = json.loads(data.decode("utf-8"))
-                            players += leaderboard
-                            for player in leaderboard:
-                                count -= 1
-                                username = player[Info.USERNAME.value]
-                                username_length = len(username)
-                                if username_length > max_username_length:
-                                    max_username_length = username_length
-                            data = json.dumps(count)
-                            self.socket.send(str.encode(data))  # Send a response to the server before continuing.
-                        padding = 5
-                        total_padding = max_username_length + padding
-                        dash = "-" * total_padding * len(players[0])
-                        print("\nLEADERBOARD")
-                        print(dash)
-                        columns = "%-{}s".format(total_padding) * len(players[0])
-                        print(columns % tuple([key for key in players[0]]))
-                        print(dash)
-                        for player in players:
-                            print(columns % tuple([value for value in player.values()]))
+                        request = {Paging.CURSOR.value: None, Paging.COUNT.value: 50}
+                        while True:
+                            self.connection.send_command(command)
+                            self.connection.send_data(request)
+                            page = self.connection.recv_data()
+                            if page.get(Paging.ERROR.value):
+                                print("\n{}".format(page[Paging.ERROR.value]))
+                                break
+                            players = page[Paging.PLAYERS.value]
+                            if not players:
+                                print("\nThe leaderboard is empty.")
+                                break
+                            max_username_length = max(len(player[Info.USERNAME.value]) for player in players)
+                            padding = 5
+                            total_padding = max_username_length + padding
+                            dash = "-" * total_padding * len(players[0])
+                            print("\nLEADERBOARD ({} players)".format(page[Paging.TOTAL.value]))
+                            print(dash)
+                            columns = "%-{}s".format(total_padding) * len(players[0])
+                            print(columns % tuple([key for key in players[0]]))
+                            print(dash)
+                            for player in players:
+                                print(columns % tuple([value for value in player.values()]))
+
+                            # Fetch the next page, the previous page or the page around the player on request.
+                            client_input = input("\n[n]ext page, [p]revious page, [m]y rank or press enter to stop: ")
+                            option = client_input.lower()
+                            if option == "n" and page[Paging.NEXT.value]:
+                                request = {Paging.CURSOR.value: page[Paging.NEXT.value], Paging.COUNT.value: 50}
+                            elif option == "p" and page[Paging.PREVIOUS.value]:
+                                request = {Paging.CURSOR.value: page[Paging.PREVIOUS.value], Paging.COUNT.value: 50}
+                            elif option == "m":
+                                request = {Paging.AROUND.value: self.username, Paging.COUNT.value: 50}
+                            elif option in ("n", "p"):
+                                print("\nThere is no {} page.".format("next" if option == "n" else "previous"))
+                                break
+                            else:
+                                break
+                    elif command == Commands.STATS.value:
+                        self.connection.send_command(command)
+                        stats = self.connection.recv_data()
+                        print("\nSTATS")
+                        print(json.dumps(stats, indent=2))
                     elif command == Commands.SIGN_OUT.value:
                         pass
                     else:
                         print("\n'{}' is an invalid command.".format(client_input))
-            except json.JSONDecodeError as e:
+            except (ProtocolError, json.JSONDecodeError) as e:
                 print(e)
             except socket.error as e:
                 print(e)
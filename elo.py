@@ -0,0 +1,112 @@
+import math
+import random
+import numpy as np
+
+K_FACTOR = 32
+# Strength of every integer rating below this bound, computed once and then looked up.
+STRENGTH_TABLE_SIZE = 8192
+STRENGTH_TABLE = np.power(10, np.arange(STRENGTH_TABLE_SIZE) / 400)
+STRENGTHS = STRENGTH_TABLE.tolist()
+
+
+# Convert ratings into their strength on the elo scale, 10^(rating/400). Integer ratings, which are never negative,
+# are looked up in the table of strengths unless they are past its end.
+def strengths(ratings):
+    ratings = np.asarray(ratings)
+    if ratings.dtype.kind in "iu":
+        try:
+            return STRENGTH_TABLE[ratings]
+        except IndexError:
+            pass
+    return np.power(10, ratings / 400)
+
+
+# Build the matrix of the chances of each player of winning against each other player, scores[i][j] being the chance
+# of the ith player of winning against the jth player. Given the ratings of several lobbies, one matrix is built for
+# each lobby.
+def expected_scores(ratings):
+    strength = strengths(ratings)
+    return strength[..., :, np.newaxis] / (strength[..., :, np.newaxis] + strength[..., np.newaxis, :])
+
+
+# Predict the chance of a player of winning against an opponent, with plain Python floats: going through NumPy for a
+# single pair costs several times more than the formula itself.
+def expected_score(player_rating, opponent_rating):
+    if (isinstance(player_rating, int) and isinstance(opponent_rating, int) and
+            0 <= player_rating < STRENGTH_TABLE_SIZE and 0 <= opponent_rating < STRENGTH_TABLE_SIZE):
+        player_strength = STRENGTHS[player_rating]
+        opponent_strength = STRENGTHS[opponent_rating]
+    else:
+        player_strength = math.pow(10, player_rating / 400)
+        opponent_strength = math.pow(10, opponent_rating / 400)
+    return player_strength / (player_strength + opponent_strength)
+
+
+# Predict the chance of each player of getting 1st, ..., (m + 1)th place against m opponents, wins[i] and losses[i]
+# being the chances of the ith player of winning and losing against each opponent. The number of opponents beaten
+# follows a Poisson binomial distribution, which is built one opponent at a time.
+def placement_probabilities(wins, losses):
+    wins = np.atleast_2d(wins)
+    losses = np.atleast_2d(losses)
+    opponents = wins.shape[-1]
+    # distribution[i][w] is the chance of beating w opponents.
+    distribution = np.zeros(wins.shape[:-1] + (opponents + 1,))
+    distribution[..., 0] = 1
+    for j in range(opponents):
+        p = wins[..., j, np.newaxis]
+        q = losses[..., j, np.newaxis]
+        distribution[..., 1:] = distribution[..., 1:] * q + distribution[..., :-1] * p
+        distribution[..., :1] *= q
+    return distribution[..., ::-1]  # Getting ith place means beating n - i opponents.
+
+
+# Predict the chance of each player of a lobby of getting 1st, ..., nth place from the matrix of expected scores. Each
+# player is treated as their own opponent with a chance of 0 of winning, which leaves the distribution unchanged.
+def predict_placements(scores):
+    diagonal = np.eye(scores.shape[-1], dtype=bool)
+    wins = np.where(diagonal, 0, scores)
+    losses = np.where(diagonal, 1, np.swapaxes(scores, -1, -2))
+    return placement_probabilities(wins, losses)[..., 1:]
+
+
+# Compute the expected placement of each player from their placement probabilities.
+def expected_placements(predictions):
+    expected = np.zeros(predictions.shape[:-1])
+    for j in range(predictions.shape[-1]):
+        expected += (j + 1) * predictions[..., j]
+    return expected
+
+
+# Simulate the final order of a match: every player is compared with every player behind them, and they switch places
+# whenever the player in front loses. Returns the indices of the players from 1st to nth place.
+def simulate_order(scores, rng=random):
+    scores = np.asarray(scores).tolist()  # Indexing lists is much faster than indexing an array element by element.
+    n = len(scores)
+    order = list(range(n))
+    for i in range(n):
+        for j in range(i + 1, n):
+            if rng.random() >= scores[order[i]][order[j]]:
+                order[i], order[j] = order[j], order[i]
+    return order
+
+
+# Simulate the final order of many matches at once, following the same rules as simulate_order. scores holds one
+# matrix of expected scores per match and rng is a numpy random generator. Returns one row of indices per match.
+def simulate_orders(scores, rng):
+    matches, n = scores.shape[:2]
+    order = np.tile(np.arange(n), (matches, 1))
+    rows = np.arange(matches)
+    for i in range(n):
+        for j in range(i + 1, n):
+            front = order[:, i].copy()
+            back = order[:, j].copy()
+            swap = rng.random(matches) >= scores[rows, front, back]
+            order[swap, i] = back[swap]
+            order[swap, j] = front[swap]
+    return order
+
+
+# Update elo ratings after a match, using the difference between the expected and the final placements.
+def updated_ratings(ratings, k, expected, final):
+    ratings = np.asarray(ratings) + k * (np.asarray(expected) - np.asarray(final))
+    return np.maximum(0, np.trunc(ratings)).astype(int)
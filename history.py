@@ -0,0 +1,139 @@
+import os
+import time
+import numpy as np
+from array import array
+from threading import Lock
+
+# One row per player of each match, in the order the matches were recorded. Match ids start at 1, so that the rows of
+# a chunk that haven't been written yet, left at zero, can be told apart.
+HISTORY_RECORD = np.dtype([("match_id", "<i8"), ("timestamp", "<f8"), ("user_id", "<i4"), ("placement", "<i2"),
+                           ("rating_before", "<i4"), ("rating_after", "<i4")])
+COLUMNS = HISTORY_RECORD.names
+# Number of rows of each chunk file.
+CHUNK_ROWS = 65536
+SPARKS = "▁▂▃▄▅▆▇█"
+
+
+# Append-only history of the matches, kept in chunks of a fixed number of rows. Each column of a chunk is a file of its
+# own mapped in memory, so that recording a match only writes to memory, the operating system writing the pages
+# behind, and reading a column only touches the pages of that column. Each player has an index of the rows
+# of their matches, rebuilt from the chunks on load, so that the history of a player is read without scanning the
+# others. Rows are appended in the order of the matches, so the timestamps of a player's rows only go up.
+class MatchHistory:
+    def __init__(self, path="data/history", chunk_rows=CHUNK_ROWS):
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.lock = Lock()
+        self.chunks = []
+        self.rows = 0
+        self.match_id = 0
+        self.index = {}  # Rows of the matches of each user id.
+
+    def chunk_path(self, number, column):
+        return os.path.join(self.path, "chunk-{}-{}.npy".format(number, column))
+
+    # Map the chunks written so far and index their rows.
+    def load(self):
+        os.makedirs(self.path, exist_ok=True)
+        suffix = "-{}.npy".format(COLUMNS[0])
+        numbers = sorted(int(file_name[len("chunk-"):-len(suffix)]) for file_name in os.listdir(self.path)
+                         if file_name.startswith("chunk-") and file_name.endswith(suffix))
+        for number in numbers:
+            chunk = {column: np.load(self.chunk_path(number, column), mmap_mode="r+") for column in COLUMNS}
+            written = int(np.count_nonzero(chunk["match_id"]))
+            self.chunks.append(chunk)
+            user_ids = chunk["user_id"][:written]
+            order = np.argsort(user_ids, kind="stable")
+            user_ids, starts = np.unique(user_ids[order], return_index=True)
+            rows = (order + number * self.chunk_rows).tolist()
+            bounds = starts.tolist() + [written]
+            for i, user_id in enumerate(user_ids.tolist()):
+                self.index.setdefault(user_id, array("q")).extend(rows[bounds[i]:bounds[i + 1]])
+            if written:
+                self.match_id = int(chunk["match_id"][written - 1])
+            self.rows = number * self.chunk_rows + written
+        return self
+
+    def new_chunk(self):
+        chunk = {column: np.lib.format.open_memmap(self.chunk_path(len(self.chunks), column), mode="w+",
+                                                   dtype=HISTORY_RECORD[column], shape=(self.chunk_rows,))
+                 for column in COLUMNS}
+        self.chunks.append(chunk)
+        return chunk
+
+    # Record a match, its players being given by order of placement along with their ratings before and after it.
+    # Returns the id of the match.
+    def record(self, user_ids, ratings_before, ratings_after, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.lock:
+            self.match_id += 1
+            for placement, (user_id, before, after) in enumerate(zip(user_ids, ratings_before, ratings_after)):
+                number, offset = divmod(self.rows, self.chunk_rows)
+                chunk = self.chunks[number] if number < len(self.chunks) else self.new_chunk()
+                # The match id goes last, since a row counts as written once it has one.
+                for column, value in zip(COLUMNS[1:], (timestamp, user_id, placement + 1, before, after)):
+                    chunk[column][offset] = value
+                chunk["match_id"][offset] = self.match_id
+                self.index.setdefault(user_id, array("q")).append(self.rows)
+                self.rows += 1
+            return self.match_id
+
+    # Number of matches of a player.
+    def count(self, user_id):
+        return len(self.index.get(user_id, ()))
+
+    # Gather the given rows, sorted, from their chunks into records.
+    def gather(self, rows):
+        numbers, offsets = np.divmod(np.asarray(rows, dtype=np.int64), self.chunk_rows)
+        records = np.zeros(len(numbers), dtype=HISTORY_RECORD)
+        for number in np.unique(numbers).tolist():
+            selected = numbers == number
+            for column in COLUMNS:
+                records[column][selected] = self.chunks[number][column][offsets[selected]]
+        return records
+
+    # Rows of the matches of a player played between the given timestamps, the end being excluded, or of their last
+    # matches only.
+    def player(self, user_id, start=None, end=None, last=None):
+        with self.lock:
+            rows = np.frombuffer(self.index.get(user_id, array("q")), dtype=np.int64).copy()
+        if last is not None:
+            rows = rows[-last:] if last else rows[:0]
+        records = self.gather(rows)
+        if start is not None or end is not None:
+            timestamps = records["timestamp"]
+            low = np.searchsorted(timestamps, start, side="left") if start is not None else 0
+            high = np.searchsorted(timestamps, end, side="left") if end is not None else len(records)
+            records = records[low:high]
+        return records
+
+    # Rows of the players of a match, found by binary search since the match ids only go up.
+    def match(self, match_id):
+        with self.lock:
+            rows = self.rows
+            chunks = list(self.chunks)
+        found = []
+        for number, chunk in enumerate(chunks):
+            match_ids = chunk["match_id"][:max(0, min(rows - number * self.chunk_rows, self.chunk_rows))]
+            if len(match_ids) and match_ids[0] <= match_id <= match_ids[-1]:
+                low, high = np.searchsorted(match_ids, [match_id, match_id + 1]).tolist()
+                found += range(number * self.chunk_rows + low, number * self.chunk_rows + high)
+        return self.gather(found)
+
+    # Ratings of the last matches of a player drawn as a line of bars, from their rating before the first of them.
+    def sparkline(self, user_id, count=20):
+        records = self.player(user_id, last=count)
+        if not len(records):
+            return ""
+        ratings = np.concatenate([records["rating_before"][:1], records["rating_after"]])
+        low, high = ratings.min(), ratings.max()
+        if high == low:
+            return SPARKS[len(SPARKS) // 2] * len(ratings)
+        levels = ((ratings - low) * (len(SPARKS) - 1) / (high - low)).round().astype(int)
+        return "".join(SPARKS[level] for level in levels.tolist())
+
+    def flush(self):
+        with self.lock:
+            for chunk in self.chunks:
+                for column in chunk.values():
+                    column.flush()
@@ -0,0 +1,324 @@
+import gc
+import time
+import random
+import numpy as np
+from enum import Enum
+from collections import OrderedDict
+from threading import Thread, Lock
+from player import Info, Classes
+
+MAX_PAGE_SIZE = 100
+SNAPSHOT_INTERVAL = 1  # Minimum number of seconds between two snapshots.
+SNAPSHOT_HISTORY = 4  # Number of snapshots kept around for the cursors of clients in the middle of paging.
+
+
+class Paging(Enum):
+    CURSOR = "CURSOR"
+    AROUND = "AROUND"
+    COUNT = "COUNT"
+    PLAYERS = "PLAYERS"
+    TOTAL = "TOTAL"
+    PREVIOUS = "PREVIOUS"
+    NEXT = "NEXT"
+    ERROR = "ERROR"
+
+
+# Immutable copy of the leaderboard at a given version, from which pages are read without locking: the user ids of the
+# players from the 1st to the last rank along with their ratings. Cursors are strings made of the version of the
+# snapshot and the rank of the first player of the page.
+class LeaderboardSnapshot:
+    def __init__(self, version, user_ids, ratings, usernames):
+        self.version = version
+        self.user_ids = user_ids
+        self.ratings = ratings
+        self.usernames = usernames  # Usernames by user id, which never change once given.
+        self.ranks = None
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def cursor(self, rank):
+        return "{}:{}".format(self.version, rank)
+
+    # Return the rank of a player in the snapshot, or None if they aren't in it.
+    def rank(self, user_id):
+        if self.ranks is None:
+            ranks = np.zeros(int(self.user_ids.max(initial=-1)) + 1, dtype=np.int64)
+            ranks[self.user_ids] = np.arange(1, len(self.user_ids) + 1)
+            self.ranks = ranks
+        rank = int(self.ranks[user_id]) if 0 <= user_id < len(self.ranks) else 0
+        return rank or None
+
+    # Return up to count players starting from the given rank, along with the cursors of the surrounding pages.
+    def page(self, rank, count):
+        total = len(self)
+        rank = min(max(rank, 1), max(total, 1))
+        user_ids = self.user_ids[rank - 1:rank - 1 + count].tolist()
+        ratings = self.ratings[rank - 1:rank - 1 + count].tolist()
+        players = [{Info.RANK.value: rank + i, Info.USERNAME.value: self.usernames[user_id], Info.RATING.value: rating,
+                    Info.CLASS.value: Classes.rating_class(rating)}
+                   for i, (user_id, rating) in enumerate(zip(user_ids, ratings))]
+        return {Paging.PLAYERS.value: players,
+                Paging.TOTAL.value: total,
+                Paging.PREVIOUS.value: self.cursor(max(rank - count, 1)) if rank > 1 else None,
+                Paging.NEXT.value: self.cursor(rank + count) if rank + count <= total else None}
+
+
+class Node:
+    __slots__ = ("key", "player", "next", "span")
+
+    def __init__(self, key, player, level):
+        self.key = key
+        self.player = player
+        self.next = [None] * level
+        self.span = [0] * level  # Number of players between this node and the next one on each level.
+
+
+# Players ordered by descending rating in an indexable skip list, so that a rating change moves a single player in
+# O(log n) and a range of k ranks is read in O(log n + k). Players with the same rating are ordered by user id.
+#
+# The rating of each player on the leaderboard is also kept in an array indexed by user id, -1 for the players who
+# aren't on it, from which the snapshots are built. Copying it is a single call that the other threads can't interleave
+# with, so a snapshot is built from a copy without holding the lock of the leaderboard, and in the background once
+# there is one to serve in the meantime.
+class Leaderboard:
+    MAX_LEVEL = 32
+    P = 0.25
+
+    def __init__(self, seed=None):
+        self.head = Node(None, None, self.MAX_LEVEL)
+        self.level = 1
+        self.size = 0
+        self.keys = {}
+        self.random = random.Random(seed)
+        self.version = 0
+        self.ratings = np.full(0, -1, dtype=np.int64)
+        self.usernames = []
+        self.snapshots = OrderedDict()
+        self.snapshot_time = 0
+        self.snapshot_lock = Lock()
+        self.rebuilding = False
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, player):
+        return player.user_id in self.keys
+
+    def __iter__(self):
+        node = self.head.next[0]
+        while node:
+            yield node.player
+            node = node.next[0]
+
+    def random_level(self):
+        level = 1
+        while level < self.MAX_LEVEL and self.random.random() < self.P:
+            level += 1
+        return level
+
+    # Find the last node before the key on each level, along with its rank.
+    def search(self, key):
+        update = [self.head] * self.MAX_LEVEL
+        ranks = [0] * self.MAX_LEVEL
+        node = self.head
+        rank = 0
+        for i in reversed(range(self.level)):
+            while node.next[i] and node.next[i].key < key:
+                rank += node.span[i]
+                node = node.next[i]
+            update[i] = node
+            ranks[i] = rank
+        return update, ranks
+
+    def insert(self, key, player):
+        update, ranks = self.search(key)
+        level = self.random_level()
+        if level > self.level:
+            for i in range(self.level, level):
+                self.head.span[i] = self.size
+            self.level = level
+        node = Node(key, player, level)
+        for i in range(level):
+            node.next[i] = update[i].next[i]
+            update[i].next[i] = node
+            node.span[i] = update[i].span[i] - (ranks[0] - ranks[i])
+            update[i].span[i] = ranks[0] - ranks[i] + 1
+        for i in range(level, self.level):
+            update[i].span[i] += 1
+        self.size += 1
+
+    def delete(self, key):
+        update, ranks = self.search(key)
+        node = update[0].next[0]
+        for i in range(self.level):
+            if update[i].next[i] is node:
+                update[i].span[i] += node.span[i] - 1
+                update[i].next[i] = node.next[i]
+            else:
+                update[i].span[i] -= 1
+        while self.level > 1 and self.head.next[self.level - 1] is None:
+            self.level -= 1
+        self.size -= 1
+
+    # Replace the content of the leaderboard, linking the players level by level in a single pass once they are sorted.
+    def build(self, players):
+        players = list(players)
+        ratings = np.fromiter((player.rating for player in players), dtype=np.int64, count=len(players))
+        user_ids = np.fromiter((player.user_id for player in players), dtype=np.int64, count=len(players))
+        order = np.lexsort((user_ids, -ratings)).tolist()
+        levels = np.random.default_rng(self.random.getrandbits(64)).geometric(1 - self.P, len(players))
+        levels = np.minimum(levels, self.MAX_LEVEL).tolist()
+        tracked = np.full(int(user_ids.max(initial=-1)) + 1, -1, dtype=np.int64)
+        tracked[user_ids] = ratings
+        self.ratings = tracked
+        if players:
+            self.usernames = players[0].store.usernames
+        ratings = ratings.tolist()
+        user_ids = user_ids.tolist()
+        self.head = Node(None, None, self.MAX_LEVEL)
+        self.level = max(levels, default=1)
+        self.keys = {}
+        last = [self.head] * self.MAX_LEVEL
+        last_ranks = [0] * self.MAX_LEVEL
+        collecting = gc.isenabled()
+        gc.disable()  # The nodes hold no reference cycles, collecting them along the way would only slow this down.
+        try:
+            for rank, i in enumerate(order, 1):
+                key = (-ratings[i], user_ids[i])
+                node = Node(key, players[i], levels[i])
+                for j in range(levels[i]):
+                    last[j].next[j] = node
+                    last[j].span[j] = rank - last_ranks[j]
+                    last[j] = node
+                    last_ranks[j] = rank
+                self.keys[key[1]] = key
+        finally:
+            if collecting:
+                gc.enable()
+        self.size = len(players)
+        for j in range(self.level):
+            last[j].span[j] = self.size - last_ranks[j]
+        self.version += 1
+
+    # Add a player to the leaderboard, or move them after their rating has changed.
+    def update(self, player):
+        user_id = player.user_id
+        key = (-player.rating, user_id)
+        previous_key = self.keys.get(user_id)
+        if previous_key == key:
+            return
+        if previous_key is not None:
+            self.delete(previous_key)
+        self.insert(key, player)
+        self.keys[user_id] = key
+        self.track(user_id, player.rating)
+        self.usernames = player.store.usernames
+        self.version += 1
+
+    def remove(self, player):
+        self.delete(self.keys.pop(player.user_id))
+        self.track(player.user_id, -1)
+        self.version += 1
+
+    # Keep the rating of a player in the array the snapshots are built from, -1 taking them off the leaderboard.
+    def track(self, user_id, rating):
+        if user_id >= len(self.ratings):
+            ratings = np.full(max(2 * len(self.ratings), user_id + 1), -1, dtype=np.int64)
+            ratings[:len(self.ratings)] = self.ratings
+            self.ratings = ratings
+        self.ratings[user_id] = rating
+
+    # Return the rank of a player, starting at 1, or None if they aren't on the leaderboard.
+    def rank(self, player):
+        key = self.keys.get(player.user_id)
+        if key is None:
+            return None
+        update, ranks = self.search(key)
+        return ranks[0] + 1
+
+    # Return up to count players starting from the given rank.
+    def players(self, rank, count):
+        node = self.head
+        traversed = 0
+        for i in reversed(range(self.level)):
+            while node.next[i] and traversed + node.span[i] < rank:
+                traversed += node.span[i]
+                node = node.next[i]
+        players = []
+        node = node.next[0]
+        while node and len(players) < count:
+            players.append(node.player)
+            node = node.next[0]
+        return players
+
+    # Build a snapshot of the leaderboard from a copy of the ratings of its players.
+    def rebuild(self):
+        try:
+            version = self.version
+            ratings = self.ratings.copy()
+            user_ids = np.flatnonzero(ratings >= 0)
+            ratings = ratings[user_ids]
+            order = np.argsort(-ratings, kind="stable")  # The user ids are sorted, so ties stay ordered by user id.
+            latest = LeaderboardSnapshot(version, user_ids[order], ratings[order], self.usernames)
+            with self.snapshot_lock:
+                self.snapshots[latest.version] = latest
+                if len(self.snapshots) > SNAPSHOT_HISTORY:
+                    self.snapshots.popitem(last=False)
+                self.snapshot_time = time.monotonic()
+            return latest
+        finally:
+            self.rebuilding = False
+
+    # Return the latest snapshot of the leaderboard. Once the ratings have changed since, a new one is built in the
+    # background and the latest one is returned in the meantime. Only the very first snapshot is waited for.
+    def snapshot(self):
+        with self.snapshot_lock:
+            latest = next(reversed(self.snapshots.values()), None)
+            rebuild = not self.rebuilding and (latest is None or (
+                latest.version != self.version and time.monotonic() - self.snapshot_time >= SNAPSHOT_INTERVAL))
+            if rebuild:
+                self.rebuilding = True
+        if latest is None:
+            return self.rebuild() if rebuild else self.wait()
+        if rebuild:
+            Thread(target=self.rebuild, daemon=True).start()
+        return latest
+
+    # Wait for the first snapshot being built by another thread.
+    def wait(self):
+        while True:
+            with self.snapshot_lock:
+                latest = next(reversed(self.snapshots.values()), None)
+            if latest is not None:
+                return latest
+            time.sleep(0.001)
+
+    # Read a page of the leaderboard from a request holding either the cursor of the page, or the username of a player
+    # to center the page on, and the number of players to return. Without a cursor, the page starts from the top. The
+    # players are given by username to find the player to center the page on. An invalid request is answered with an
+    # error instead of a page.
+    def read(self, request, players):
+        if not isinstance(request, dict):
+            request = {}
+        try:
+            count = min(max(int(request.get(Paging.COUNT.value) or MAX_PAGE_SIZE), 1), MAX_PAGE_SIZE)
+        except (TypeError, ValueError, OverflowError):
+            return {Paging.ERROR.value: "Invalid count {!r}.".format(request[Paging.COUNT.value])}
+        cursor = request.get(Paging.CURSOR.value)
+        around = request.get(Paging.AROUND.value)
+        snapshot = self.snapshot()
+        rank = 1
+        if cursor:
+            try:
+                version, rank = (int(value) for value in str(cursor).split(":"))
+            except ValueError:
+                return {Paging.ERROR.value: "Invalid cursor {!r}.".format(cursor)}
+            with self.snapshot_lock:
+                snapshot = self.snapshots.get(version, snapshot)
+        elif around:
+            if not isinstance(around, str):
+                return {Paging.ERROR.value: "Invalid username {!r}.".format(around)}
+            player = players.get(around)
+            rank = max(((snapshot.rank(player.user_id) if player else None) or 1) - count // 2, 1)
+        return snapshot.page(rank, count)
@@ -0,0 +1,211 @@
+import time
+import random
+import asyncio
+import argparse
+import resource
+from client import Commands, automated_password
+from player import Info
+from leaderboard import Paging
+from protocol import AsyncConnection, MessageType, ProtocolError
+from metrics import Histogram
+
+# Upper bounds of the latency histogram buckets, in seconds.
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10)
+QUEUE_TO_MATCH = "QUEUE TO MATCH"
+CASUAL_QUEUE_TO_MATCH = "CASUAL QUEUE TO MATCH"
+
+
+# Label of a histogram bucket, from seconds to milliseconds.
+def bucket_label(label):
+    prefix = label.rstrip("0123456789.")
+    return "{}{:g}ms".format(prefix, float(label[len(prefix):]) * 1000)
+
+
+# Percentile of a histogram snapshot in milliseconds: the upper bound of the bucket it falls in, capped by the largest
+# latency measured.
+def percentile(snapshot, key):
+    bound = snapshot[key]
+    maximum = snapshot["MAX"]
+    return round((maximum if isinstance(bound, str) else min(bound, maximum)) * 1000, 2)
+
+
+# One simulated user going through the same commands as AutomatedClient over a single connection: they sign up, or
+# sign in if the account already exists, then send commands picked from the command mix until the end of the test.
+class SimulatedUser:
+    def __init__(self, load_test, user_id):
+        self.load_test = load_test
+        self.username = "Load-{}".format(user_id)
+        self.rng = random.Random(user_id)
+        self.connection = None
+
+    async def command(self, command, *data):
+        start = time.perf_counter()
+        try:
+            await self.connection.send_command(command)
+            for value in data:
+                await self.connection.send_data(value)
+            result = await self.connection.recv_data()
+        except (ProtocolError, ConnectionError, OSError):
+            self.load_test.errors[command] += 1
+            raise
+        self.load_test.histograms[command].observe(time.perf_counter() - start)
+        return result
+
+    # Send the credentials once the server has sent the account form, and return its confirmation.
+    async def authenticate(self, command):
+        start = time.perf_counter()
+        try:
+            await self.connection.send_command(command)
+            account = await self.connection.recv_data()
+            account[Info.USERNAME.value] = self.username
+            account[Info.PASSWORD.value] = automated_password(self.username)
+            await self.connection.send_data(account)
+            confirmation = await self.connection.recv_data()
+        except (ProtocolError, ConnectionError, OSError):
+            self.load_test.errors[command] += 1
+            raise
+        self.load_test.histograms[command].observe(time.perf_counter() - start)
+        return confirmation
+
+    # Wait for the result of the match, pushed by the server. A user still waiting at the end of the test cancels, and
+    # returns None unless their match had already been made.
+    async def match_result(self):
+        if self.connection.events:
+            return self.connection.events.popleft()
+        receive = asyncio.ensure_future(self.connection.recv())
+        done, _ = await asyncio.wait({receive}, timeout=max(self.load_test.deadline - time.monotonic(), 0) + 1)
+        if not done:
+            await self.connection.send_command(Commands.CANCEL.value)
+        while True:
+            frame = await receive
+            if frame is None:
+                raise ConnectionError("Connection closed.")
+            message_type, value = frame
+            if message_type == MessageType.EVENT:
+                return value
+            if value is True:
+                return None
+            receive = asyncio.ensure_future(self.connection.recv())
+
+    async def run(self):
+        try:
+            reader, writer = await asyncio.open_connection(self.load_test.host, self.load_test.port)
+        except OSError:
+            self.load_test.connection_errors += 1
+            return
+        self.connection = AsyncConnection(reader, writer)
+        try:
+            await self.connection.negotiate()
+            if not await self.authenticate(Commands.SIGN_UP.value):
+                if not await self.authenticate(Commands.SIGN_IN.value):
+                    return
+            commands = list(self.load_test.mix)
+            weights = list(self.load_test.mix.values())
+            while time.monotonic() < self.load_test.deadline:
+                await asyncio.sleep(self.rng.expovariate(1 / self.load_test.think_time))
+                command = self.rng.choices(commands, weights)[0]
+                if command == Commands.LEADERBOARD.value:
+                    await self.command(command, {Paging.CURSOR.value: None, Paging.COUNT.value: 50})
+                elif command == Commands.CASUAL.value or command == Commands.COMPETITIVE.value:
+                    confirmation = await self.command(command)
+                    result = await self.match_result() if confirmation["QUEUED"] else None
+                    if result:
+                        queue_to_match = CASUAL_QUEUE_TO_MATCH if command == Commands.CASUAL.value else QUEUE_TO_MATCH
+                        self.load_test.histograms[queue_to_match].observe(result["QUEUE TIMES"][self.username])
+                else:
+                    await self.command(command)
+        except (ProtocolError, ConnectionError, OSError):
+            pass
+        finally:
+            self.connection.close()
+
+
+# Drive thousands of simulated users against a running server from a single event loop. Users arrive following a
+# Poisson process at the given rate, and each command is timed from the moment it is sent to the moment its response
+# is received. CASUAL and COMPETITIVE are acknowledged right away, after which the user waits for the result of the
+# match to be pushed. The time spent in the queue before the match started, as reported by the server, is kept apart.
+class LoadTest:
+    def __init__(self, host="127.0.0.1", port=1233, users=1000, arrival_rate=200, duration=30, think_time=1,
+                 mix=None, seed=0):
+        self.host = host
+        self.port = port
+        self.users = users
+        self.arrival_rate = arrival_rate
+        self.duration = duration
+        self.think_time = think_time
+        self.mix = mix or {Commands.COMPETITIVE.value: 1, Commands.PROFILE.value: 1, Commands.LEADERBOARD.value: 1}
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.deadline = None
+        self.connection_errors = 0
+        self.histograms = {command: Histogram(BUCKETS) for command in
+                           [Commands.SIGN_UP.value, Commands.SIGN_IN.value] + list(self.mix) + [QUEUE_TO_MATCH]}
+        if Commands.CASUAL.value in self.mix:
+            self.histograms[CASUAL_QUEUE_TO_MATCH] = Histogram(BUCKETS)
+        self.errors = {command: 0 for command in self.histograms}
+
+    async def run(self):
+        start = time.monotonic()
+        self.deadline = start + self.duration
+        tasks = []
+        for i in range(self.users):
+            tasks.append(asyncio.create_task(SimulatedUser(self, "{}-{}".format(self.seed, i)).run()))
+            await asyncio.sleep(self.rng.expovariate(self.arrival_rate))
+            if time.monotonic() >= self.deadline:
+                break
+        await asyncio.gather(*tasks)
+        return time.monotonic() - start
+
+    def report(self, elapsed):
+        snapshots = {command: histogram.snapshot() for command, histogram in self.histograms.items()}
+        print("\n%-24s%-8s%-8s%-12s%-12s%-12s%-12s" % ("COMMAND", "COUNT", "ERRORS", "P50 (ms)", "P95 (ms)",
+                                                       "P99 (ms)", "MAX (ms)"))
+        for command, snapshot in snapshots.items():
+            percentiles = [percentile(snapshot, key) if snapshot["COUNT"] else "-" for key in ("P50", "P95", "P99")]
+            maximum = round(snapshot["MAX"] * 1000, 2) if snapshot["COUNT"] else "-"
+            print("%-24s%-8s%-8s%-12s%-12s%-12s%-12s" % (command, snapshot["COUNT"], self.errors[command],
+                                                          *percentiles, maximum))
+        for command, snapshot in snapshots.items():
+            if snapshot["COUNT"]:
+                print("\n{}".format(command))
+                for label, count in snapshot["BUCKETS"].items():
+                    print("%-12s%-8s%s" % (bucket_label(label), count, "#" * max(1, count * 50 // snapshot["COUNT"])))
+        commands = sum(snapshot["COUNT"] for command, snapshot in snapshots.items()
+                       if command not in (QUEUE_TO_MATCH, CASUAL_QUEUE_TO_MATCH))
+        print("\n%-30s%.2f s" % ("DURATION", elapsed))
+        print("%-30s%s" % ("CONNECTION ERRORS", self.connection_errors))
+        print("%-30s%.1f /s" % ("COMMANDS", commands / elapsed))
+        print("%-30s%.1f /s" % ("MATCHES JOINED", snapshots[QUEUE_TO_MATCH]["COUNT"] / elapsed))
+        if CASUAL_QUEUE_TO_MATCH in snapshots:
+            print("%-30s%.1f /s" % ("CASUAL MATCHES JOINED", snapshots[CASUAL_QUEUE_TO_MATCH]["COUNT"] / elapsed))
+
+
+# Parse a command mix such as "COMPETITIVE=2,PROFILE=1", command names being matched case-insensitively.
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        command, _, weight = item.partition("=")
+        command = Commands(command.strip().upper()).value
+        mix[command] = float(weight or 1)
+    return mix
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the latency of a running server under load.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1233)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--arrival-rate", type=float, default=200, help="users connecting per second")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--think-time", type=float, default=1, help="average seconds between two commands")
+    parser.add_argument("--mix", type=parse_mix, default=None,
+                        help="e.g. COMPETITIVE=2,CASUAL=1,PROFILE=1,LEADERBOARD=1")
+    parser.add_argument("--seed", type=int, default=0)
+    arguments = parser.parse_args()
+
+    # Allow as many connections as the system does.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    load_test = LoadTest(arguments.host, arguments.port, arguments.users, arguments.arrival_rate, arguments.duration,
+                         arguments.think_time, arguments.mix, arguments.seed)
+    load_test.report(asyncio.run(load_test.run()))
@@ -1,35 +1,122 @@
 import math
+import time
 import random
+import bisect
+import itertools
+import numpy as np
+import elo
 from player import Info
 
+MAX_RATING_DEVIATION = 200
 
+
+# Maximum rating deviation allowed in a lobby depending on how long its longest waiting player has been in the queue:
+# it starts from the base deviation and widens by growth rating points per second, up to the maximum deviation.
+class ToleranceCurve:
+    def __init__(self, base=MAX_RATING_DEVIATION, growth=20, maximum=3 * MAX_RATING_DEVIATION):
+        self.base = base
+        self.growth = growth
+        self.maximum = max(maximum, base)
+
+    def deviation(self, wait):
+        return min(self.base + self.growth * max(wait, 0), self.maximum)
+
+
+DEFAULT_TOLERANCE = ToleranceCurve()
+# Tolerance of lobbies that admit any player whatever their rating.
+UNCONSTRAINED = ToleranceCurve(math.inf, 0, math.inf)
+
+
+# The lobby keeps the sum of the ratings of its players and the sum of their squares, so that checking whether a player
+# can join, adding a player and removing one take constant time whatever the capacity. The rating of each player is
+# kept as it was when they joined, since it may change while they wait, and it is the one taken out of the sums when
+# they leave.
 class SoloLobby:
-    def __init__(self, capacity):
+    def __init__(self, capacity, tolerance=DEFAULT_TOLERANCE):
         self.players = []
         self.capacity = capacity
-        self.odds = {}
+        self.tolerance = tolerance
+        self.queued_at = math.inf  # Time at which the longest waiting player of the lobby queued up.
+        self.queue_times = []  # Time at which each player queued up, in the order of the players.
+        self.ratings = []  # Rating of each player when they joined, in the order of the players.
+        self.positions = {}  # Index of each player in the list of players.
+        self.rating_sum = 0
+        self.rating_squares = 0
+        self.scores = None
+        self.placements = None
         self.predictions = {}
 
-    def fill(self, entry):
-        if len(self.players) == 0:
-            username = entry.info[Info.USERNAME.value]
-            self.odds[username] = {}
-            self.players.append(entry)
+    def average_rating(self):
+        return self.rating_sum / len(self.players)
+
+    # Check if a player who queued up at the given time can join the lobby without spreading the ratings too far apart
+    # for how long the players have waited. Times are taken from time.monotonic unless the current time is given.
+    def admits(self, player_rating, queued_at=None, now=None):
+        n = len(self.players)
+        if n == 0:
             return True
-        elif len(self.players) < self.capacity:
-            username = entry.info[Info.USERNAME.value]
-            player_rating = entry.info[Info.RATING.value]
-            average_rating = (player_rating + sum([player.info[Info.RATING.value] for player in self.players])) /\
-                             (len(self.players) + 1)
-            rating_variance = (math.pow(player_rating - average_rating, 2) +
-                               sum([math.pow(player.info[Info.RATING.value] - average_rating, 2)
-                                    for player in self.players])) / len(self.players)
-            if rating_variance <= math.pow(200, 2):
-                self.odds[username] = {}
-                self.players.append(entry)
+        elif n < self.capacity:
+            # The variance of the n + 1 ratings is (m * squares - sum^2) / (n * m), with m = n + 1. Both sides of the
+            # comparison are multiplied by n * m, which keeps it exact for integer ratings.
+            m = n + 1
+            rating_sum = self.rating_sum + player_rating
+            spread = m * (self.rating_squares + player_rating * player_rating) - rating_sum * rating_sum
+            if spread <= self.tolerance.base * self.tolerance.base * n * m:
                 return True
+            queued_at = min(self.queued_at, math.inf if queued_at is None else queued_at)
+            if queued_at == math.inf:
+                return False
+            wait = (time.monotonic() if now is None else now) - queued_at
+            return spread <= math.pow(self.tolerance.deviation(wait), 2) * n * m
         return False
 
+    def add(self, entry, queued_at=None, rating=None):
+        rating = entry.rating if rating is None else rating
+        self.positions[entry] = len(self.players)
+        self.players.append(entry)
+        self.queue_times.append(math.inf if queued_at is None else queued_at)
+        self.ratings.append(rating)
+        self.rating_sum += rating
+        self.rating_squares += rating * rating
+        if queued_at is not None:
+            self.queued_at = min(self.queued_at, queued_at)
+
+    def fill(self, entry, queued_at=None, now=None):
+        rating = entry.rating
+        if self.admits(rating, queued_at, now):
+            self.add(entry, queued_at, rating)
+            return True
+        return False
+
+    # Take a player out of the lobby by moving the last player in their place. The time of the longest waiting player
+    # is only searched again when they are the one leaving.
+    def remove(self, entry):
+        i = self.positions.pop(entry)
+        last = self.players.pop()
+        queued_at = self.queue_times.pop()
+        rating = self.ratings.pop()
+        if i < len(self.players):
+            queued_at, self.queue_times[i] = self.queue_times[i], queued_at
+            rating, self.ratings[i] = self.ratings[i], rating
+            self.players[i] = last
+            self.positions[last] = i
+        self.rating_sum -= rating
+        self.rating_squares -= rating * rating
+        if queued_at == self.queued_at:
+            self.queued_at = min(self.queue_times, default=math.inf)
+
+    # Replace the players of the lobby with players matched elsewhere, e.g. by form_lobbies.
+    def assign(self, players, queue_times=None):
+        self.players = []
+        self.queue_times = []
+        self.ratings = []
+        self.positions = {}
+        self.rating_sum = 0
+        self.rating_squares = 0
+        self.queued_at = math.inf
+        for i, player in enumerate(players):
+            self.add(player, None if queue_times is None else queue_times[i])
+
     def ready(self):
         return len(self.players) == self.capacity
 
@@ -37,13 +124,17 @@ class SoloLobby:
         player = self.players[j]
         self.players[j] = self.players[i]
         self.players[i] = player
+        self.queue_times[i], self.queue_times[j] = self.queue_times[j], self.queue_times[i]
+        self.ratings[i], self.ratings[j] = self.ratings[j], self.ratings[i]
+        self.positions[self.players[i]] = i
+        self.positions[self.players[j]] = j
 
     def display_players(self):
         players = []
         for i in range(len(self.players)):
-            username = self.players[i].info[Info.USERNAME.value]
-            rating = self.players[i].info[Info.RATING.value]
-            rating_class = self.players[i].info[Info.CLASS.value]
+            username = self.players[i].username
+            rating = self.players[i].rating
+            rating_class = self.players[i].rating_class
             players.append({Info.RANK.value: i + 1, Info.USERNAME.value: username, Info.RATING.value: rating,
                             Info.CLASS.value: rating_class})
         return players
@@ -51,45 +142,130 @@ class SoloLobby:
     def display_predictions(self):
         players = []
         for player in self.players:
-            username = player.info[Info.USERNAME.value]
-            rating = player.info[Info.RATING.value]
-            rating_class = player.info[Info.CLASS.value]
+            username = player.username
+            rating = player.rating
+            rating_class = player.rating_class
             expected_score = sum((i + 1) * self.predictions[username][i] for i in range(len(self.predictions[username])))
             players.append({Info.RANK.value: round(expected_score, 2), Info.USERNAME.value: username, Info.RATING.value: rating,
                             Info.CLASS.value: rating_class})
         return players
 
-    def predict_outcome(self):
+    # Predict the outcome of the match, unless the chances of each player of getting each place were already computed
+    # elsewhere, e.g. by a matchmaking shard, and are given.
+    def predict_outcome(self, placements=None):
         # Calculate the odds of winning for each player.
-        for i in range(self.capacity):
-            player_username = self.players[i].info[Info.USERNAME.value]
-            for j in range(i + 1, self.capacity):
-                opponent_username = self.players[j].info[Info.USERNAME.value]
-                self.odds[player_username][opponent_username] = self.players[i].predict_score(self.players[j])
-                self.odds[opponent_username][player_username] = self.players[j].predict_score(self.players[i])
+        self.predict_scores()
 
         # Calculate the chance of getting 1st, ..., nth place for each player.
-        for player in self.players:
-            username = player.info[Info.USERNAME.value]
-            self.predictions[username] = player.predict_placements(self.odds)
+        self.placements = elo.predict_placements(self.scores) if placements is None else np.asarray(placements)
+        for i in range(self.capacity):
+            self.predictions[self.players[i].username] = self.placements[i].tolist()
 
-    def simulate_match(self, rated):
+    # Calculate the odds of winning of each player against each other player, which is all an unrated match needs.
+    def predict_scores(self):
+        self.scores = elo.expected_scores([player.rating for player in self.players])
+
+    # Simulate the match from the odds of winning of the players, or from other scores given in the same form, drawing
+    # from the given random number generator. A rated match is rated with the elo formula right away, unless a rating
+    # engine is given, in which case its result is submitted to the engine.
+    def simulate_match(self, rated, rng=random, scores=None, engine=None):
         # Rearrange the order of players in the lobby.
-        for i in range(self.capacity):
-            for j in range(i + 1, self.capacity):
-                ei = self.players[i].predict_score(self.players[j])
-                p = random.random()
-                if p >= ei and j > i:
-                    self.swap(i, j)
+        order = elo.simulate_order(self.scores if scores is None else scores, rng)
+        players = [self.players[i] for i in order]
+        queue_times = [self.queue_times[i] for i in order]
+        self.players = players
 
         # Update the rating and the record of each player.
-        if rated:
+        if rated and engine:
+            engine.submit([player.user_id for player in self.players])
+            self.players[0].win()
+            for player in self.players[1:]:
+                player.lose()
+        elif rated:
+            expected_scores = elo.expected_placements(self.placements)[order]
+            ratings = [player.rating for player in self.players]
+            final_scores = np.arange(1, self.capacity + 1)
+            ratings = elo.updated_ratings(ratings, elo.K_FACTOR, expected_scores, final_scores)
             for i in range(self.capacity):
-                username = self.players[i].info[Info.USERNAME.value]
-                expected_score = sum((j + 1) * self.predictions[username][j] for j in range(len(self.predictions)))
-                final_score = i + 1
-                self.players[i].update_rating(32, expected_score, final_score)
-                if final_score == 1:
+                self.players[i].set_rating(int(ratings[i]))
+                if final_scores[i] == 1:
                     self.players[i].win()
                 else:
                     self.players[i].lose()
+        self.assign(players, queue_times)
+
+
+# Form lobbies out of a batch of queued players in a single sweep over their ratings, players[i] having queued up at
+# queued_at[i]. Each run of capacity players next to each other by rating becomes a lobby if they fit the tolerance,
+# otherwise the lowest rated player of the run is left out. Returns the indices of the players of each lobby, and
+# those of the players left out, to be carried over to the next batch.
+def form_lobbies(players, queued_at, capacity, tolerance=DEFAULT_TOLERANCE, now=None):
+    order = sorted(range(len(players)), key=lambda i: players[i].rating)
+    lobbies = []
+    left_out = []
+    i = 0
+    while i + capacity <= len(order):
+        run = order[i:i + capacity]
+        lobby = SoloLobby(capacity, tolerance)
+        if all(lobby.fill(players[j], queued_at[j], now) for j in run):
+            lobbies.append(run)
+            i += capacity
+        else:
+            left_out.append(order[i])
+            i += 1
+    return lobbies, left_out + order[i:]
+
+
+# Open lobbies sorted by their average rating, so that a player is only matched against the lobbies that could accept
+# them. Adding a player to a lobby with k players keeps the variance under a deviation d only if the player is within
+# d * sqrt(k + 1) of the lobby's average rating, d being at most the maximum deviation of the tolerance curve.
+class LobbyIndex:
+    def __init__(self, capacity, tolerance=DEFAULT_TOLERANCE):
+        self.radius = tolerance.maximum * math.sqrt(capacity)
+        self.keys = []
+        self.lobbies = []
+        self.entries = {}
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.lobbies)
+
+    def __contains__(self, lobby):
+        return lobby in self.entries
+
+    def add(self, lobby):
+        key = (lobby.average_rating(), next(self.counter))
+        i = bisect.bisect_left(self.keys, key)
+        self.keys.insert(i, key)
+        self.lobbies.insert(i, lobby)
+        self.entries[lobby] = key
+
+    def remove(self, lobby):
+        key = self.entries.pop(lobby)
+        i = bisect.bisect_left(self.keys, key)
+        del self.keys[i]
+        del self.lobbies[i]
+
+    # Move a lobby to its new position after its average rating has changed.
+    def update(self, lobby):
+        self.remove(lobby)
+        self.add(lobby)
+
+    # Return the lobbies whose average rating is below low or above high.
+    def outside(self, low, high):
+        return (self.lobbies[:bisect.bisect_left(self.keys, (low,))] +
+                self.lobbies[bisect.bisect_right(self.keys, (high, math.inf)):])
+
+    # Iterate over the lobbies that could accept a player, from the closest average rating to the furthest.
+    def candidates(self, player_rating):
+        low = bisect.bisect_left(self.keys, (player_rating - self.radius,))
+        high = bisect.bisect_right(self.keys, (player_rating + self.radius, math.inf))
+        i = bisect.bisect_left(self.keys, (player_rating,), low, high)
+        j = i - 1
+        while i < high or j >= low:
+            if j < low or (i < high and self.keys[i][0] - player_rating <= player_rating - self.keys[j][0]):
+                yield self.lobbies[i]
+                i += 1
+            else:
+                yield self.lobbies[j]
+                j -= 1
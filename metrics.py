@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import numpy as np
+from collections import deque
+from threading import Thread, Lock
+
+# Upper bounds of the buckets of the histograms measuring durations, in seconds.
+DURATION_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+# Upper bounds of the buckets of the histograms measuring rating differences.
+RATING_BUCKETS = (10, 25, 50, 100, 200, 300, 400, 600, 800)
+# Counters and histograms only append to a buffer on the hot path, which is thread-safe without any lock, and fold it
+# into their totals when it grows past this size or when they are read.
+PENDING_LIMIT = 65536
+
+
+class Counter:
+    def __init__(self):
+        self.lock = Lock()
+        self.pending = deque()
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.pending.append(amount)
+        if len(self.pending) >= PENDING_LIMIT:
+            self.fold()
+
+    def fold(self):
+        with self.lock:
+            pending = self.pending
+            self.value += sum([pending.popleft() for _ in range(len(pending))])
+
+    def snapshot(self):
+        self.fold()
+        return self.value
+
+
+class Gauge:
+    def __init__(self):
+        self.lock = Lock()
+        self.value = 0
+
+    # A single assignment, which needs no lock.
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def snapshot(self):
+        return self.value
+
+
+# Counts of the observed values falling in each of a fixed set of buckets, from which percentiles are estimated as
+# the upper bound of the bucket they fall in, along with the largest value observed.
+class Histogram:
+    def __init__(self, buckets):
+        self.lock = Lock()
+        self.pending = deque()
+        self.buckets = buckets
+        self.counts = np.zeros(len(buckets) + 1, dtype=np.int64)
+        self.count = 0
+        self.sum = 0
+        self.max = None
+
+    def observe(self, value):
+        self.pending.append(value)
+        if len(self.pending) >= PENDING_LIMIT:
+            self.fold()
+
+    def fold(self):
+        with self.lock:
+            pending = self.pending
+            values = np.array([pending.popleft() for _ in range(len(pending))], dtype=np.float64)
+            if len(values):
+                self.counts += np.bincount(np.searchsorted(self.buckets, values), minlength=len(self.counts))
+                self.count += len(values)
+                self.sum += float(values.sum())
+                self.max = float(values.max()) if self.max is None else max(self.max, float(values.max()))
+
+    def percentile(self, counts, count, percentile):
+        rank = count * percentile / 100
+        seen = 0
+        for i, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else ">{}".format(self.buckets[-1])
+        return None
+
+    def snapshot(self):
+        self.fold()
+        with self.lock:
+            counts = self.counts.tolist()
+            count = self.count
+            total = self.sum
+            maximum = self.max
+        labels = ["<={}".format(bound) for bound in self.buckets] + [">{}".format(self.buckets[-1])]
+        snapshot = {"COUNT": count, "MEAN": round(total / count, 6) if count else None}
+        if count:
+            for percentile in (50, 95, 99):
+                snapshot["P{}".format(percentile)] = self.percentile(counts, count, percentile)
+            snapshot["MAX"] = maximum
+        snapshot["BUCKETS"] = {label: bucket_count for label, bucket_count in zip(labels, counts) if bucket_count}
+        return snapshot
+
+
+# Registry of the metrics of a server, created on first use under their name. Updating a metric takes no lock, so that
+# the matchmaking hot path can be instrumented. The rate of each counter is refreshed by the metrics dump.
+class Metrics:
+    def __init__(self):
+        self.lock = Lock()
+        self.start_time = time.monotonic()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.rates = {}
+        self.rates_time = self.start_time
+        self.rates_values = {}
+
+    def counter(self, name):
+        with self.lock:
+            return self.counters.setdefault(name, Counter())
+
+    def gauge(self, name):
+        with self.lock:
+            return self.gauges.setdefault(name, Gauge())
+
+    def histogram(self, name, buckets=DURATION_BUCKETS):
+        with self.lock:
+            return self.histograms.setdefault(name, Histogram(buckets))
+
+    # Compute the rate per second of each counter since the previous call.
+    def refresh_rates(self):
+        now = time.monotonic()
+        with self.lock:
+            elapsed = now - self.rates_time
+            values = {name: counter.snapshot() for name, counter in self.counters.items()}
+            if elapsed > 0:
+                self.rates = {name: round((value - self.rates_values.get(name, 0)) / elapsed, 2)
+                              for name, value in values.items()}
+            self.rates_time = now
+            self.rates_values = values
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = dict(self.histograms)
+            rates = dict(self.rates)
+        return {"UPTIME": round(time.monotonic() - self.start_time, 2),
+                "COUNTERS": {name: counter.snapshot() for name, counter in counters.items()},
+                "RATES": rates,
+                "GAUGES": {name: gauge.snapshot() for name, gauge in gauges.items()},
+                "HISTOGRAMS": {name: histogram.snapshot() for name, histogram in histograms.items()}}
+
+
+# Write the metrics to a local JSON file at a regular interval, replacing the previous dump atomically.
+class MetricsDump(Thread):
+    def __init__(self, metrics, path, interval=10):
+        Thread.__init__(self)
+        self.daemon = True
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+
+    def dump(self):
+        self.metrics.refresh_rates()
+        with open(self.path + ".tmp", "w") as file:
+            json.dump(self.metrics.snapshot(), file, indent=2)
+        os.replace(self.path + ".tmp", self.path)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.dump()
+            except OSError as e:
+                print(e)
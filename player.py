@@ -1,7 +1,8 @@
 import math
-import itertools
+import elo
 import numpy as np
 from enum import Enum
+from threading import Lock
 
 
 class Info(Enum):
@@ -16,6 +17,7 @@ class Info(Enum):
     LOSSES = "LOSSES"
     WIN_RATIO = "WIN RATIO"
     STATUS = "STATUS"
+    RATING_HISTORY = "RATING HISTORY"
 
 
 class Status(Enum):
@@ -56,65 +58,259 @@ class Classes(Enum):
             return Classes.SSS.value
 
 
+# Codes under which the statuses and the classes are kept in the player store, 0 being a player without a class.
+STATUSES = [status.value for status in Status]
+STATUS_CODES = {status: code for code, status in enumerate(STATUSES)}
+CLASSES = [None] + [rating_class.value for rating_class in Classes]
+CLASS_CODES = {rating_class: code for code, rating_class in enumerate(CLASSES)}
+
+
+# Records of every player kept in typed contiguous arrays indexed by user id, which keeps the memory footprint of a
+# player to a few dozen bytes and lets the leaderboards and the statistics scan every player at once. Adding a player
+# may reallocate the arrays, so every write to them holds the lock of the store, lest it land in an array that was just
+# replaced. Reads don't: they may only see a record from just before a write.
+class PlayerStore:
+    def __init__(self, capacity=1024):
+        self.lock = Lock()
+        self.size = 0
+        self.usernames = []
+        self.ratings = np.zeros(capacity, dtype=np.int32)
+        self.games = np.zeros(capacity, dtype=np.int32)
+        self.wins = np.zeros(capacity, dtype=np.int32)
+        self.losses = np.zeros(capacity, dtype=np.int32)
+        self.win_ratios = np.zeros(capacity, dtype=np.float64)
+        self.ranks = np.zeros(capacity, dtype=np.int32)  # 0 for a player who isn't on the leaderboard.
+        self.statuses = np.zeros(capacity, dtype=np.int8)
+        self.classes = np.zeros(capacity, dtype=np.int8)
+        # Bumped whenever a record shown on the profile of a player changes, so that it can be cached once encoded.
+        self.versions = np.zeros(capacity, dtype=np.int64)
+
+    def __len__(self):
+        return self.size
+
+    def arrays(self):
+        return ("ratings", "games", "wins", "losses", "win_ratios", "ranks", "statuses", "classes", "versions")
+
+    # Double the capacity of the arrays until the given user id fits.
+    def reserve(self, user_id):
+        capacity = len(self.ratings)
+        if user_id < capacity:
+            return
+        while capacity <= user_id:
+            capacity *= 2
+        for name in self.arrays():
+            array = getattr(self, name)
+            resized = np.zeros(capacity, dtype=array.dtype)
+            resized[:len(array)] = array
+            setattr(self, name, resized)
+
+    def add(self, user_id, username, rating):
+        with self.lock:
+            self.put(user_id, username, rating)
+
+    # Add a new player under the next free user id, taken while holding the lock so that players added at the same
+    # time get their own rows. Returns the user id.
+    def allocate(self, username, rating):
+        with self.lock:
+            user_id = self.size
+            self.put(user_id, username, rating)
+            return user_id
+
+    # Write the records of a new player. The caller holds the lock.
+    def put(self, user_id, username, rating):
+        self.reserve(user_id)
+        if user_id >= len(self.usernames):
+            self.usernames.extend([None] * (user_id + 1 - len(self.usernames)))
+        self.usernames[user_id] = username
+        for name in self.arrays():
+            getattr(self, name)[user_id] = 0
+        self.ratings[user_id] = rating
+        self.classes[user_id] = CLASS_CODES[Classes.rating_class(rating)]
+        self.statuses[user_id] = STATUS_CODES[Status.OFFLINE.value]
+        self.size = max(self.size, user_id + 1)
+
+    # Recompute the class of every player, or of the given players only, from their rating. The caller holds the lock
+    # while other threads may add players.
+    def refresh_classes(self, user_ids=None):
+        if user_ids is None:
+            user_ids = slice(0, self.size)
+        ratings = self.ratings[user_ids]
+        bounds = [1200, 1400, 1600, 1800, 2000, 2200, 2400]
+        classes = CLASS_CODES[Classes.E.value] - np.digitize(ratings, bounds)
+        self.classes[user_ids] = np.where(ratings == 0, CLASS_CODES[None], classes)
+
+    # Record a game won by each of the winners and lost by each of the losers, the same way as Player.win and
+    # Player.lose. A player can't appear twice in the same call.
+    def record_games(self, winners, losers):
+        with self.lock:
+            self.games[winners] += 1
+            self.wins[winners] += 1
+            self.win_ratios[winners] = self.wins[winners] / self.games[winners]
+            self.games[losers] += 1
+            self.losses[losers] += 1
+            self.win_ratios[losers] = self.wins[losers] / self.games[losers] * 100
+            self.versions[winners] += 1
+            self.versions[losers] += 1
+
+    # Count the players of each class and of each status, and average their ratings.
+    def stats(self):
+        classes = np.bincount(self.classes[:self.size], minlength=len(CLASSES))
+        statuses = np.bincount(self.statuses[:self.size], minlength=len(STATUSES))
+        return {"PLAYERS": self.size,
+                "AVERAGE RATING": float(self.ratings[:self.size].mean()) if self.size else 0,
+                Info.CLASS.value: {CLASSES[code]: int(count) for code, count in enumerate(classes) if code},
+                Info.STATUS.value: {STATUSES[code]: int(count) for code, count in enumerate(statuses)}}
+
+
+DEFAULT_STORE = PlayerStore()
+
+
+# View over the records of a player in a player store.
 class Player:
-    def __init__(self, user_id, username, rating=1200):
-        self.info = {Info.USER_ID.value: user_id,
-                     Info.RANK.value: None,
-                     Info.USERNAME.value: username,
-                     Info.CLASS.value: Classes.rating_class(rating),
-                     Info.RATING.value: rating,
-                     Info.GAMES.value: 0,
-                     Info.WINS.value: 0,
-                     Info.LOSSES.value: 0,
-                     Info.WIN_RATIO.value: 0,
-                     Info.STATUS.value: Status.OFFLINE.value}
+    __slots__ = ("store", "user_id")
+
+    def __init__(self, user_id, username, rating=1200, store=None):
+        self.store = DEFAULT_STORE if store is None else store
+        self.user_id = user_id
+        self.store.add(user_id, username, rating)
+
+    # Create a new player under the next free user id of a store.
+    @classmethod
+    def create(cls, username, rating=1200, store=None):
+        store = DEFAULT_STORE if store is None else store
+        return cls.view(store, store.allocate(username, rating))
+
+    # Create a view over the records of a player already in a store.
+    @classmethod
+    def view(cls, store, user_id):
+        player = cls.__new__(cls)
+        player.store = store
+        player.user_id = user_id
+        return player
+
+    @property
+    def username(self):
+        return self.store.usernames[self.user_id]
+
+    @property
+    def rating(self):
+        return int(self.store.ratings[self.user_id])
+
+    @property
+    def rating_class(self):
+        return CLASSES[self.store.classes[self.user_id]]
+
+    @property
+    def games(self):
+        return int(self.store.games[self.user_id])
+
+    @property
+    def wins(self):
+        return int(self.store.wins[self.user_id])
+
+    @property
+    def losses(self):
+        return int(self.store.losses[self.user_id])
+
+    @property
+    def win_ratio(self):
+        return float(self.store.win_ratios[self.user_id])
+
+    @property
+    def status(self):
+        return STATUSES[self.store.statuses[self.user_id]]
+
+    @property
+    def version(self):
+        return int(self.store.versions[self.user_id])
+
+    @property
+    def rank(self):
+        rank = int(self.store.ranks[self.user_id])
+        return rank if rank else None
+
+    @rank.setter
+    def rank(self, rank):
+        with self.store.lock:
+            if self.store.ranks[self.user_id] != (rank or 0):
+                self.store.ranks[self.user_id] = rank or 0
+                self.store.versions[self.user_id] += 1
+
+    # Serialize the records of the player.
+    @property
+    def info(self):
+        return {Info.USER_ID.value: self.user_id,
+                Info.RANK.value: self.rank,
+                Info.USERNAME.value: self.username,
+                Info.CLASS.value: self.rating_class,
+                Info.RATING.value: self.rating,
+                Info.GAMES.value: self.games,
+                Info.WINS.value: self.wins,
+                Info.LOSSES.value: self.losses,
+                Info.WIN_RATIO.value: self.win_ratio,
+                Info.STATUS.value: self.status}
+
+    def set_status(self, status):
+        with self.store.lock:
+            self.store.statuses[self.user_id] = STATUS_CODES[status.value]
+            self.store.versions[self.user_id] += 1
 
     def online(self):
-        self.info[Info.STATUS.value] = Status.ONLINE.value
+        self.set_status(Status.ONLINE)
 
     def offline(self):
-        self.info[Info.STATUS.value] = Status.OFFLINE.value
+        self.set_status(Status.OFFLINE)
 
     def in_queue(self):
-        self.info[Info.STATUS.value] = Status.IN_QUEUE.value
+        self.set_status(Status.IN_QUEUE)
 
     def in_game(self):
-        self.info[Info.STATUS.value] = Status.IN_GAME.value
+        self.set_status(Status.IN_GAME)
+
+    # Bring the player back online at the end of their match, unless they went offline during it.
+    def leave_game(self):
+        with self.store.lock:
+            if self.store.statuses[self.user_id] == STATUS_CODES[Status.IN_GAME.value]:
+                self.store.statuses[self.user_id] = STATUS_CODES[Status.ONLINE.value]
+                self.store.versions[self.user_id] += 1
 
     # Predict the chance of a player of getting 1st, ..., nth place against other players.
     def predict_placements(self, odds):
-        n = len(odds)
-        predictions = [0] * n
-        player_username = self.info[Info.USERNAME.value]
-        for i in range(len(predictions)):
-            wins = itertools.combinations(odds[player_username], n - 1 - i)
-            for win_combination in wins:
-                pi = np.prod([odds[player_username][opponent_username] for opponent_username in win_combination])
-                loss_combination = set(odds[player_username]) - set(win_combination)
-                pi *= np.prod([odds[opponent_username][player_username] for opponent_username in loss_combination])
-                predictions[i] += pi
+        player_username = self.username
+        wins = [odds[player_username][opponent_username] for opponent_username in odds[player_username]]
+        losses = [odds[opponent_username][player_username] for opponent_username in odds[player_username]]
+        predictions = elo.placement_probabilities(wins, losses)[0].tolist()
         p = sum(predictions)
         assert p == 1 or math.isclose(p, 1), str(p)
         return predictions
 
     # Predict the chance of a player of winning against an opponent using the elo rating formula.
     def predict_score(self, opponent):
-        player_rating = math.pow(10, self.info[Info.RATING.value] / 400)
-        opponent_rating = math.pow(10, opponent.info[Info.RATING.value] / 400)
-        return player_rating / (player_rating + opponent_rating)
+        return elo.expected_score(self.rating, opponent.rating)
+
+    def set_rating(self, rating):
+        with self.store.lock:
+            self.store.ratings[self.user_id] = rating
+            self.store.classes[self.user_id] = CLASS_CODES[Classes.rating_class(rating)]
+            self.store.versions[self.user_id] += 1
 
-    # Update the elo rating of the player after a match.
+    # Update the elo rating of the player after a match. A single player is updated with scalar arithmetic, whole
+    # lobbies go through elo.updated_ratings.
     def update_rating(self, k, expected_score, final_score):
-        rating = self.info[Info.RATING.value] + k * (expected_score - final_score)
-        self.info[Info.RATING.value] = max(0, int(rating))
-        self.info[Info.CLASS.value] = Classes.rating_class(self.info[Info.RATING.value])
+        self.set_rating(max(0, int(self.rating + k * (expected_score - final_score))))
 
     def win(self):
-        self.info[Info.GAMES.value] += 1
-        self.info[Info.WINS.value] += 1
-        self.info[Info.WIN_RATIO.value] = self.info[Info.WINS.value] / self.info[Info.GAMES.value]
+        store = self.store
+        with store.lock:
+            store.games[self.user_id] += 1
+            store.wins[self.user_id] += 1
+            store.win_ratios[self.user_id] = store.wins[self.user_id] / store.games[self.user_id]
+            store.versions[self.user_id] += 1
 
     def lose(self):
-        self.info[Info.GAMES.value] += 1
-        self.info[Info.LOSSES.value] += 1
-        self.info[Info.WIN_RATIO.value] = self.info[Info.WINS.value] / self.info[Info.GAMES.value] * 100
+        store = self.store
+        with store.lock:
+            store.games[self.user_id] += 1
+            store.losses[self.user_id] += 1
+            store.win_ratios[self.user_id] = store.wins[self.user_id] / store.games[self.user_id] * 100
+            store.versions[self.user_id] += 1
@@ -0,0 +1,151 @@
+import os
+import sys
+import time
+import contextlib
+import threading
+from enum import Enum
+from threading import Thread, Lock
+
+# Seconds between two samples of the stacks of every thread.
+SAMPLING_INTERVAL = 0.005
+# Span returned while spans aren't recorded: entering and leaving it does nothing.
+NULL_SPAN = contextlib.nullcontext()
+
+
+class ProfilingMode(Enum):
+    SPANS = "SPANS"
+    SAMPLING = "SAMPLING"
+
+
+# Name of the root of the stacks of a thread: its class, so that the stacks of the threads of a pool add up.
+def thread_name(thread):
+    return type(thread).__name__ if type(thread) is not Thread else thread.name.split("-")[0]
+
+
+# Time spent in a named span of code, nested within the spans entered before it by the same thread. The time of a
+# span is recorded without that of the spans nested in it, as flame graphs add the time of the nested spans up.
+class Span:
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        local = self.profiler.local
+        if not hasattr(local, "stack"):
+            local.stack = [thread_name(threading.current_thread())]
+            local.nested = [0]
+        local.stack.append(self.name)
+        local.nested.append(0)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        local = self.profiler.local
+        self.profiler.add(";".join(local.stack), elapsed - local.nested.pop())
+        local.stack.pop()
+        local.nested[-1] += elapsed
+        return False
+
+
+# Sample the stacks of every other thread at a regular interval and count how many times each stack was seen.
+class Sampler(Thread):
+    def __init__(self, profiler, interval=SAMPLING_INTERVAL):
+        Thread.__init__(self)
+        self.daemon = True
+        self.profiler = profiler
+        self.interval = interval
+        self.stopped = False
+
+    def sample(self):
+        threads = {thread.ident: thread_name(thread) for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == self.ident:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            stack.append(threads.get(ident, "Thread"))
+            self.profiler.add(";".join(reversed(stack)), 1)
+
+    def run(self):
+        while not self.stopped:
+            self.sample()
+            time.sleep(self.interval)
+
+
+# Opt-in profiling of a server, in one of two modes. In the spans mode, named spans around the main code paths record
+# the time spent in them, nested by thread, the collapsed stack of a span adding up the microseconds spent in it. In
+# the sampling mode, a thread samples the Python stacks of every other thread, the collapsed stack of a sample adding
+# up the number of times it was seen. Stopping the profiler writes the collapsed stacks to a file, one "stack value"
+# line each, which flame graph tools read as is. While the spans aren't recorded, span returns a span that does nothing.
+class Profiler:
+    def __init__(self, path="data"):
+        self.path = path
+        self.lock = Lock()
+        self.local = threading.local()
+        self.spans = False
+        self.sampler = None
+        self.mode = None
+        self.started_at = None
+        self.stacks = {}
+
+    def span(self, name):
+        if not self.spans:
+            return NULL_SPAN
+        return Span(self, name)
+
+    def add(self, stack, value):
+        with self.lock:
+            self.stacks[stack] = self.stacks.get(stack, 0) + value
+
+    def running(self):
+        return self.mode is not None
+
+    def start(self, mode=ProfilingMode.SAMPLING):
+        with self.lock:
+            if self.mode is not None:
+                return False
+            self.stacks = {}
+            self.mode = mode
+            self.started_at = time.time()
+        if mode == ProfilingMode.SPANS:
+            self.spans = True
+        else:
+            self.sampler = Sampler(self)
+            self.sampler.start()
+        return True
+
+    # Stop profiling and return the path of the file the collapsed stacks were written to, or None if not profiling.
+    def stop(self):
+        with self.lock:
+            mode, self.mode = self.mode, None
+        if mode is None:
+            return None
+        self.spans = False
+        if self.sampler:
+            self.sampler.stopped = True
+            self.sampler.join()
+            self.sampler = None
+        with self.lock:
+            stacks, self.stacks = self.stacks, {}
+        os.makedirs(self.path, exist_ok=True)
+        path = os.path.join(self.path, "profile-{}-{}.collapsed".format(mode.value.lower(), int(self.started_at)))
+        with open(path, "w") as file:
+            for stack, value in sorted(stacks.items()):
+                if mode == ProfilingMode.SPANS:
+                    value = round(value * 1e6)
+                file.write("{} {}\n".format(stack, value))
+        return path
+
+    # Start profiling in the given mode, or stop if already profiling. Returns the state of the profiler.
+    def toggle(self, mode=ProfilingMode.SAMPLING):
+        if self.running():
+            return {"PROFILING": False, "MODE": None, "PATH": self.stop()}
+        self.start(mode)
+        return {"PROFILING": True, "MODE": mode.value, "PATH": None}
@@ -0,0 +1,395 @@
+import asyncio
+import json
+import select
+import struct
+from enum import Enum
+from threading import Lock
+from collections import deque
+
+# Every message is sent as a frame made of a header, holding the length of the payload and the type of the message,
+# followed by the payload encoded with the codec negotiated when connecting. Besides the responses to its commands, the
+# server pushes events, such as the result of a match, which can arrive between a command and its response.
+HEADER = struct.Struct("!IB")
+MAX_PAYLOAD_SIZE = 16 * 1024 * 1024
+
+
+class MessageType(Enum):
+    HELLO = 0
+    COMMAND = 1
+    DATA = 2
+    EVENT = 3
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# Invalid header, after which the end of the frame, and so the start of the next one, can't be found.
+class FramingError(ProtocolError):
+    pass
+
+
+class JsonCodec:
+    name = "JSON"
+
+    def encode(self, value):
+        return str.encode(json.dumps(value, separators=(",", ":")))
+
+    # Invalid UTF-8 and JSON nested too deeply are invalid payloads like any other malformed JSON.
+    def decode(self, data):
+        try:
+            return json.loads(data.decode("utf-8"))
+        except (ValueError, RecursionError) as e:
+            raise ProtocolError("Invalid JSON payload: {}".format(e))
+
+
+# Compact binary encoding following the msgpack format for the types exchanged between the server and the clients:
+# None, booleans, integers, floats, strings, lists and dicts.
+class BinaryCodec:
+    name = "BINARY"
+    INT8 = struct.Struct("!b")
+    INT64 = struct.Struct("!q")
+    UINT8 = struct.Struct("!B")
+    UINT16 = struct.Struct("!H")
+    UINT32 = struct.Struct("!I")
+    FLOAT64 = struct.Struct("!d")
+
+    def encode(self, value):
+        buffer = bytearray()
+        self.pack(value, buffer)
+        return bytes(buffer)
+
+    def pack(self, value, buffer):
+        if value is None:
+            buffer.append(0xc0)
+        elif value is True:
+            buffer.append(0xc3)
+        elif value is False:
+            buffer.append(0xc2)
+        elif isinstance(value, int):
+            if 0 <= value < 0x80:
+                buffer.append(value)
+            elif -0x20 <= value < 0:
+                buffer += self.INT8.pack(value)
+            else:
+                buffer.append(0xd3)
+                buffer += self.INT64.pack(value)
+        elif isinstance(value, float):
+            buffer.append(0xcb)
+            buffer += self.FLOAT64.pack(value)
+        elif isinstance(value, str):
+            data = str.encode(value)
+            self.pack_length(len(data), buffer, 0xa0, 32, (0xd9, 0xda, 0xdb))
+            buffer += data
+        elif isinstance(value, (list, tuple)):
+            self.pack_length(len(value), buffer, 0x90, 16, (None, 0xdc, 0xdd))
+            for item in value:
+                self.pack(item, buffer)
+        elif isinstance(value, dict):
+            self.pack_length(len(value), buffer, 0x80, 16, (None, 0xde, 0xdf))
+            for key, item in value.items():
+                self.pack(key, buffer)
+                self.pack(item, buffer)
+        else:
+            raise TypeError("Object of type {} cannot be encoded.".format(type(value).__name__))
+
+    def pack_length(self, length, buffer, fixed_type, fixed_limit, types):
+        if length < fixed_limit:
+            buffer.append(fixed_type | length)
+        elif length <= 0xff and types[0] is not None:
+            buffer.append(types[0])
+            buffer += self.UINT8.pack(length)
+        elif length <= 0xffff:
+            buffer.append(types[1])
+            buffer += self.UINT16.pack(length)
+        else:
+            buffer.append(types[2])
+            buffer += self.UINT32.pack(length)
+
+    def decode(self, data):
+        try:
+            value, offset = self.unpack(data, 0)
+        except (IndexError, TypeError, ValueError, RecursionError, struct.error) as e:
+            raise ProtocolError("Invalid binary payload: {}".format(e))
+        if offset != len(data):
+            raise ProtocolError("Invalid binary payload: {} trailing bytes.".format(len(data) - offset))
+        return value
+
+    def unpack(self, data, offset):
+        tag = data[offset]
+        offset += 1
+        if tag < 0x80:
+            return tag, offset
+        elif tag >= 0xe0:
+            return tag - 0x100, offset
+        elif tag == 0xc0:
+            return None, offset
+        elif tag == 0xc2:
+            return False, offset
+        elif tag == 0xc3:
+            return True, offset
+        elif tag == 0xd3:
+            return self.INT64.unpack_from(data, offset)[0], offset + 8
+        elif tag == 0xcb:
+            return self.FLOAT64.unpack_from(data, offset)[0], offset + 8
+        elif 0xa0 <= tag < 0xc0 or tag in (0xd9, 0xda, 0xdb):
+            length, offset = self.unpack_length(tag, data, offset, 0xa0, (0xd9, 0xda, 0xdb))
+            if offset + length > len(data):
+                raise IndexError("string out of range")
+            return data[offset:offset + length].decode("utf-8"), offset + length
+        elif 0x90 <= tag < 0xa0 or tag in (0xdc, 0xdd):
+            length, offset = self.unpack_length(tag, data, offset, 0x90, (None, 0xdc, 0xdd))
+            items = []
+            for _ in range(length):
+                item, offset = self.unpack(data, offset)
+                items.append(item)
+            return items, offset
+        elif 0x80 <= tag < 0x90 or tag in (0xde, 0xdf):
+            length, offset = self.unpack_length(tag, data, offset, 0x80, (None, 0xde, 0xdf))
+            items = {}
+            for _ in range(length):
+                key, offset = self.unpack(data, offset)
+                items[key], offset = self.unpack(data, offset)
+            return items, offset
+        raise ProtocolError("Unknown binary type {:#x}.".format(tag))
+
+    def unpack_length(self, tag, data, offset, fixed_type, types):
+        if tag == types[0]:
+            return self.UINT8.unpack_from(data, offset)[0], offset + 1
+        elif tag == types[1]:
+            return self.UINT16.unpack_from(data, offset)[0], offset + 2
+        elif tag == types[2]:
+            return self.UINT32.unpack_from(data, offset)[0], offset + 4
+        return tag - fixed_type, offset
+
+
+CODECS = {codec.name: codec for codec in (BinaryCodec(), JsonCodec())}
+HELLO_CODEC = CODECS[JsonCodec.name]
+
+
+def encode_frame(codec, message_type, value):
+    payload = codec.encode(value)
+    return HEADER.pack(len(payload), message_type.value) + payload
+
+
+# A value sent as-is to several connections, such as the result of a match, encoded once for each codec in use.
+class SharedFrame:
+    def __init__(self, message_type, value):
+        self.message_type = message_type
+        self.value = value
+        self.frames = {}
+
+    def frame(self, codec):
+        frame = self.frames.get(codec.name)
+        if frame is None:
+            frame = self.frames[codec.name] = encode_frame(codec, self.message_type, self.value)
+        return frame
+
+
+# Frames of values that change now and then, such as the profiles of the players, kept along with the version of the
+# value they were encoded from. A frame is encoded again once the version of its value has moved on.
+class FrameCache:
+    def __init__(self):
+        self.frames = {}
+
+    # Return the frame of the value under the given key, get_value being only called when it must be encoded again.
+    def frame(self, codec, message_type, key, version, get_value):
+        cached = self.frames.get((codec.name, key))
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        frame = encode_frame(codec, message_type, get_value())
+        self.frames[(codec.name, key)] = (version, frame)
+        return frame
+
+
+def decode_header(header):
+    length, message_type = HEADER.unpack(header)
+    if length > MAX_PAYLOAD_SIZE:
+        raise FramingError("Frame of {} bytes exceeds the maximum payload size.".format(length))
+    try:
+        return length, MessageType(message_type)
+    except ValueError:
+        raise FramingError("Unknown message type {}.".format(message_type))
+
+
+# Pick the first codec requested by the client that the server supports.
+def choose_codec(names):
+    for name in names:
+        if name in CODECS:
+            return CODECS[name]
+    raise ProtocolError("No supported codec among {}.".format(names))
+
+
+# Framed connection over a blocking socket. Frames can be sent from several threads, e.g. an event pushed by a worker
+# while the connection's thread responds to a command. Events received while waiting for another frame are kept
+# until they are asked for.
+class Connection:
+    def __init__(self, socket):
+        self.socket = socket
+        self.codec = HELLO_CODEC
+        self.send_lock = Lock()
+        self.events = deque()
+
+    # Client side of the handshake: offer codecs by order of preference and use the one picked by the server.
+    def negotiate(self, codecs=tuple(CODECS)):
+        self.send(MessageType.HELLO, list(codecs))
+        self.codec = CODECS[self.expect(MessageType.HELLO)]
+
+    # Server side of the handshake.
+    def accept(self):
+        codec = choose_codec(self.expect(MessageType.HELLO))
+        self.send(MessageType.HELLO, codec.name)
+        self.codec = codec
+
+    def send(self, message_type, value):
+        frame = encode_frame(self.codec, message_type, value)
+        with self.send_lock:
+            self.socket.sendall(frame)
+
+    # Send a frame already encoded with the codec of the connection.
+    def send_frame(self, frame):
+        with self.send_lock:
+            self.socket.sendall(frame)
+
+    def send_command(self, command):
+        self.send(MessageType.COMMAND, command)
+
+    def send_data(self, value):
+        self.send(MessageType.DATA, value)
+
+    def send_event(self, value):
+        self.send(MessageType.EVENT, value)
+
+    def recv_exactly(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.socket.recv(size - len(data))
+            if not chunk:
+                if data:
+                    raise ConnectionError("Connection closed in the middle of a frame.")
+                return None
+            data += chunk
+        return bytes(data)
+
+    # Receive the next frame as a (message type, value) pair, or None if the connection was closed.
+    def recv(self):
+        header = self.recv_exactly(HEADER.size)
+        if header is None:
+            return None
+        length, message_type = decode_header(header)
+        payload = self.recv_exactly(length) if length else b""
+        if payload is None:
+            raise ConnectionError("Connection closed in the middle of a frame.")
+        return message_type, self.codec.decode(payload)
+
+    # Receive the next frame, which must be of the given type, and return its value. Events are set aside.
+    def expect(self, message_type):
+        while True:
+            frame = self.recv()
+            if frame is None:
+                raise ConnectionError("Connection closed.")
+            if frame[0] == MessageType.EVENT and message_type != MessageType.EVENT:
+                self.events.append(frame[1])
+                continue
+            if frame[0] != message_type:
+                raise ProtocolError("Expected a {} frame, received a {} frame.".format(message_type.name,
+                                                                                      frame[0].name))
+            return frame[1]
+
+    def recv_data(self):
+        return self.expect(MessageType.DATA)
+
+    # Wait for the next event, unless one was already received.
+    def recv_event(self):
+        if self.events:
+            return self.events.popleft()
+        return self.expect(MessageType.EVENT)
+
+    # Return the events received so far without waiting, including those that have arrived but weren't read yet.
+    def pending_events(self):
+        while select.select([self.socket], [], [], 0)[0]:
+            self.events.append(self.expect(MessageType.EVENT))
+        events = list(self.events)
+        self.events.clear()
+        return events
+
+    def close(self):
+        self.socket.close()
+
+
+# Framed connection over asyncio streams.
+class AsyncConnection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.codec = HELLO_CODEC
+        self.events = deque()
+
+    async def negotiate(self, codecs=tuple(CODECS)):
+        await self.send(MessageType.HELLO, list(codecs))
+        self.codec = CODECS[await self.expect(MessageType.HELLO)]
+
+    async def accept(self):
+        codec = choose_codec(await self.expect(MessageType.HELLO))
+        await self.send(MessageType.HELLO, codec.name)
+        self.codec = codec
+
+    # Queue a frame without waiting for it to be flushed.
+    def write(self, message_type, value):
+        self.writer.write(encode_frame(self.codec, message_type, value))
+
+    # Queue a frame already encoded with the codec of the connection.
+    def write_frame(self, frame):
+        self.writer.write(frame)
+
+    async def send_frame(self, frame):
+        self.write_frame(frame)
+        await self.writer.drain()
+
+    async def send(self, message_type, value):
+        self.write(message_type, value)
+        await self.writer.drain()
+
+    async def send_command(self, command):
+        await self.send(MessageType.COMMAND, command)
+
+    async def send_data(self, value):
+        await self.send(MessageType.DATA, value)
+
+    async def recv(self):
+        try:
+            header = await self.reader.readexactly(HEADER.size)
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise ConnectionError("Connection closed in the middle of a frame.")
+            return None
+        length, message_type = decode_header(header)
+        try:
+            payload = await self.reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("Connection closed in the middle of a frame.")
+        return message_type, self.codec.decode(payload)
+
+    async def expect(self, message_type):
+        while True:
+            frame = await self.recv()
+            if frame is None:
+                raise ConnectionError("Connection closed.")
+            if frame[0] == MessageType.EVENT and message_type != MessageType.EVENT:
+                self.events.append(frame[1])
+                continue
+            if frame[0] != message_type:
+                raise ProtocolError("Expected a {} frame, received a {} frame.".format(message_type.name,
+                                                                                      frame[0].name))
+            return frame[1]
+
+    async def recv_data(self):
+        return await self.expect(MessageType.DATA)
+
+    async def recv_event(self):
+        if self.events:
+            return self.events.popleft()
+        return await self.expect(MessageType.EVENT)
+
+    def close(self):
+        self.writer.close()
@@ -0,0 +1,286 @@
+import math
+import time
+import numpy as np
+import elo
+from threading import Thread, Lock
+
+# Rating given to new players, around which the engines keeping their own scale centre it.
+STARTING_RATING = 1200
+# Number of rating points per unit of the Glicko-2 scale.
+GLICKO_SCALE = 400 / math.log(10)
+# Number of iterations after which the search for the new volatility of the Glicko-2 players stops.
+MAX_ITERATIONS = 100
+
+
+# Complementary error function of Numerical Recipes, which keeps a relative error under 1.2e-7 far into the tails.
+def erfc(x):
+    z = np.abs(x)
+    t = 1 / (1 + z / 2)
+    y = t * np.exp(-z * z - 1.26551223 + t * (1.00002368 + t * (0.37409196 + t * (0.09678418 + t * (
+        -0.18628806 + t * (0.27886807 + t * (-1.13520398 + t * (1.48851587 + t * (-0.82215223 + t * 0.17087277)))))))))
+    return np.where(x >= 0, y, 2 - y)
+
+
+# Index of the winner and of the loser of every pair of players of a set of matches of the same size, the user ids of
+# the players of each match being given from the 1st to the last place.
+def pairs(orders):
+    winners, losers = np.triu_indices(orders.shape[1], 1)
+    return orders[:, winners].ravel(), orders[:, losers].ravel()
+
+
+# Turns the results of matches into new ratings. The result of a match is given as the user ids of its players from the
+# 1st to the last place, or as an array of such rows for several matches of the same size. Results are either applied
+# right away, or recorded and applied together over a rating period: every match of the period is then rated from the
+# state of its players at the start of the period, and the whole period goes through NumPy at once, whatever its number
+# of matches. Recording a result only appends it to a list, so that it can be done on the critical path of a lobby.
+#
+# Engines that keep more than a rating per player hold their state in their own arrays indexed by user id, and write
+# the rating to display in the player store. The state of a player is created from their rating the first time they
+# are rated, which is also where a restarted server picks up again.
+class RatingEngine:
+    name = None
+
+    def __init__(self, store, batched=False):
+        self.store = store
+        self.batched = batched
+        self.lock = Lock()  # Held while updating the ratings, so that two updates don't overlap.
+        self.pending_lock = Lock()
+        self.pending = []
+        self.size = 0  # Number of players whose state has been created.
+
+    def submit(self, orders):
+        if self.batched:
+            self.record(orders)
+        else:
+            self.rate(orders)
+
+    def record(self, orders):
+        orders = np.asarray(orders)
+        orders = orders.reshape(-1, orders.shape[-1])
+        with self.pending_lock:
+            self.pending.append(orders)
+
+    # Rate the given matches right away, and return the user ids of their players.
+    def rate(self, orders):
+        orders = np.asarray(orders)
+        with self.lock:
+            return self.update([orders.reshape(-1, orders.shape[-1])])
+
+    # Rate every match recorded since the previous call as a rating period. Returns the matches rated, as arrays of
+    # matches of the same size, along with the user ids of their players, sorted, and their ratings before the period.
+    def apply(self):
+        with self.pending_lock:
+            pending, self.pending = self.pending, []
+        with self.lock:
+            user_ids = np.unique(np.concatenate([matches.ravel() for matches in pending])) if pending else \
+                np.zeros(0, dtype=int)
+            ratings = self.store.ratings[user_ids]
+            self.update(pending)
+            return pending, user_ids, ratings
+
+    def update(self, orders):
+        sizes = {}
+        for matches in orders:
+            sizes.setdefault(matches.shape[1], []).append(matches)
+        if not sizes:
+            return np.zeros(0, dtype=int)
+        self.grow()
+        groups = [np.concatenate(matches) for matches in sizes.values()]
+        user_ids, inverse = np.unique(np.concatenate([matches.ravel() for matches in groups]), return_inverse=True)
+        ratings = self.period(groups, user_ids, inverse)
+        with self.store.lock:
+            self.store.ratings[user_ids] = np.maximum(0, ratings)
+            self.store.refresh_classes(user_ids)
+            self.store.versions[user_ids] += 1
+        return user_ids
+
+    # Create the state of the players added to the store since the previous update.
+    def grow(self):
+        size = self.store.size
+        if size > self.size:
+            self.create(self.size, size)
+            self.size = size
+
+    def create(self, start, end):
+        pass
+
+    # Return the new ratings of the players with the given user ids, sorted, who played the given groups of matches of
+    # the same size. The user ids of the players of the groups, flattened one after the other, are user_ids[inverse].
+    def period(self, groups, user_ids, inverse):
+        raise NotImplementedError
+
+
+# The elo rating formula as SoloLobby.simulate_match applies it: a player wins K times the difference between their
+# expected placement and their final placement. Over a rating period, the differences of a player's matches add up.
+class EloEngine(RatingEngine):
+    name = "elo"
+
+    def __init__(self, store, batched=False, k=elo.K_FACTOR):
+        RatingEngine.__init__(self, store, batched)
+        self.k = k
+
+    def period(self, groups, user_ids, inverse):
+        changes = []
+        for orders in groups:
+            expected = elo.expected_placements(elo.predict_placements(elo.expected_scores(self.store.ratings[orders])))
+            changes.append((self.k * (expected - np.arange(1, orders.shape[1] + 1))).ravel())
+        changes = np.bincount(inverse, np.concatenate(changes), len(user_ids))
+        return np.trunc(self.store.ratings[user_ids] + changes).astype(int)
+
+
+# Glicko-2, where each player also has a rating deviation, which shrinks as they play, and a volatility, which grows
+# when their results are erratic. A match of more than two players counts as a win against each player placed after
+# and as a loss against each player placed before. Only the players who played during a period are updated.
+class Glicko2Engine(RatingEngine):
+    name = "glicko2"
+
+    def __init__(self, store, batched=False, deviation=350, volatility=0.06, tau=0.5):
+        RatingEngine.__init__(self, store, batched)
+        self.deviation = deviation / GLICKO_SCALE
+        self.volatility = volatility
+        self.tau = tau
+        self.mu = np.zeros(0)
+        self.phi = np.zeros(0)
+        self.sigma = np.zeros(0)
+
+    def create(self, start, end):
+        capacity = len(self.store.ratings)
+        for name in ("mu", "phi", "sigma"):
+            array = getattr(self, name)
+            if len(array) < capacity:
+                resized = np.zeros(capacity)
+                resized[:len(array)] = array
+                setattr(self, name, resized)
+        self.mu[start:end] = (self.store.ratings[start:end] - 1500) / GLICKO_SCALE
+        self.phi[start:end] = self.deviation
+        self.sigma[start:end] = self.volatility
+
+    def period(self, groups, user_ids, inverse):
+        winners, losers = zip(*[pairs(orders) for orders in groups])
+        winners, losers = np.concatenate(winners), np.concatenate(losers)
+        players = np.concatenate([winners, losers])
+        opponents = np.concatenate([losers, winners])
+        results = np.concatenate([np.ones(len(winners)), np.zeros(len(losers))])
+        index = np.searchsorted(user_ids, players)
+
+        g = 1 / np.sqrt(1 + 3 * self.phi[opponents] ** 2 / math.pi ** 2)
+        expected = 1 / (1 + np.exp(-g * (self.mu[players] - self.mu[opponents])))
+        v = 1 / np.bincount(index, g * g * expected * (1 - expected), len(user_ids))
+        improvement = np.bincount(index, g * (results - expected), len(user_ids))
+        delta = v * improvement
+
+        mu, phi, sigma = self.mu[user_ids], self.phi[user_ids], self.sigma[user_ids]
+        sigma = self.new_volatility(phi, sigma, v, delta)
+        phi = 1 / np.sqrt(1 / (phi * phi + sigma * sigma) + 1 / v)
+        mu = mu + phi * phi * improvement
+        self.mu[user_ids], self.phi[user_ids], self.sigma[user_ids] = mu, phi, sigma
+        return np.round(1500 + GLICKO_SCALE * mu).astype(int)
+
+    # Solve for the new volatility of every player at once with the Illinois algorithm, each player leaving the
+    # iterations once their bracket is narrow enough.
+    def new_volatility(self, phi, sigma, v, delta, epsilon=1e-6):
+        a = np.log(sigma * sigma)
+
+        def f(x):
+            ex = np.exp(x)
+            return ex * (delta * delta - phi * phi - v - ex) / (2 * (phi * phi + v + ex) ** 2) - (x - a) / self.tau ** 2
+
+        low = a.copy()
+        high = np.log(np.maximum(delta * delta - phi * phi - v, 1e-300))
+        below = delta * delta <= phi * phi + v
+        k = 1
+        high[below] = a[below] - self.tau
+        while k < MAX_ITERATIONS:
+            below &= f(high) < 0
+            if not below.any():
+                break
+            k += 1
+            high[below] = a[below] - k * self.tau
+        f_low, f_high = f(low), f(high)
+        active = np.abs(high - low) > epsilon
+        for _ in range(MAX_ITERATIONS):
+            if not active.any():
+                break
+            with np.errstate(divide="ignore", invalid="ignore"):
+                middle = low + (low - high) * f_low / (f_high - f_low)
+            f_middle = f(middle)
+            crossed = active & (f_middle * f_high < 0)
+            kept = active & ~crossed
+            low[crossed], f_low[crossed] = high[crossed], f_high[crossed]
+            f_low[kept] /= 2
+            high[active], f_high[active] = middle[active], f_middle[active]
+            active &= np.abs(high - low) > epsilon
+        return np.exp(low / 2)
+
+
+# A TrueSkill-like engine: each player has a mean skill and an uncertainty, and each pair of players of a match is
+# rated as a two player TrueSkill game won by the one placed first, rather than through the full factor graph of the
+# match. Over a rating period, the changes of the means add up and the reductions of the variances multiply. The
+# displayed rating is the mean, at the same scale as the elo ratings.
+class TrueSkillEngine(RatingEngine):
+    name = "trueskill"
+
+    def __init__(self, store, batched=False, mu=25, sigma=25 / 3, beta=25 / 6, tau=25 / 300):
+        RatingEngine.__init__(self, store, batched)
+        self.initial_mu = mu
+        self.initial_sigma = sigma
+        self.beta = beta
+        self.tau = tau
+        self.scale = 200 / beta  # Rating points per unit of skill, a difference of beta being worth 200 points.
+        self.mu = np.zeros(0)
+        self.sigma = np.zeros(0)
+
+    def create(self, start, end):
+        capacity = len(self.store.ratings)
+        for name in ("mu", "sigma"):
+            array = getattr(self, name)
+            if len(array) < capacity:
+                resized = np.zeros(capacity)
+                resized[:len(array)] = array
+                setattr(self, name, resized)
+        self.mu[start:end] = self.initial_mu + (self.store.ratings[start:end] - STARTING_RATING) / self.scale
+        self.sigma[start:end] = self.initial_sigma
+
+    def period(self, groups, user_ids, inverse):
+        winners, losers = zip(*[pairs(orders) for orders in groups])
+        winners, losers = np.concatenate(winners), np.concatenate(losers)
+        winner_index, loser_index = np.searchsorted(user_ids, winners), np.searchsorted(user_ids, losers)
+        variances = self.sigma[user_ids] ** 2 + self.tau ** 2
+        winner_variances, loser_variances = variances[winner_index], variances[loser_index]
+
+        c2 = 2 * self.beta ** 2 + winner_variances + loser_variances
+        c = np.sqrt(c2)
+        t = (self.mu[winners] - self.mu[losers]) / c
+        cdf = erfc(-t / math.sqrt(2)) / 2
+        pdf = np.exp(-t * t / 2) / math.sqrt(2 * math.pi)
+        v = np.where(cdf > 1e-300, pdf / np.maximum(cdf, 1e-300), -t)
+        w = v * (v + t)
+
+        index = np.concatenate([winner_index, loser_index])
+        changes = np.concatenate([winner_variances / c * v, -loser_variances / c * v])
+        reductions = np.log(np.concatenate([1 - winner_variances / c2 * w, 1 - loser_variances / c2 * w]))
+        mu = self.mu[user_ids] + np.bincount(index, changes, len(user_ids))
+        sigma = np.sqrt(variances * np.exp(np.bincount(index, reductions, len(user_ids))))
+        self.mu[user_ids], self.sigma[user_ids] = mu, sigma
+        return np.round(STARTING_RATING + (mu - self.initial_mu) * self.scale).astype(int)
+
+
+ENGINES = {engine.name: engine for engine in (EloEngine, Glicko2Engine, TrueSkillEngine)}
+
+
+# Apply the results recorded by a batched engine every interval seconds, passing the matches of the period, the user ids
+# of the players rated and their ratings before the period to the given callback.
+class RatingPeriods(Thread):
+    def __init__(self, engine, interval, callback=None):
+        Thread.__init__(self)
+        self.daemon = True
+        self.engine = engine
+        self.interval = interval
+        self.callback = callback
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            matches, user_ids, ratings = self.engine.apply()
+            if len(user_ids) and self.callback:
+                self.callback(matches, user_ids, ratings)
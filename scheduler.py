@@ -0,0 +1,84 @@
+import time
+import heapq
+import itertools
+import traceback
+import concurrent.futures
+from threading import Thread, Condition, Lock
+
+
+# Latency of the completed matches, from the time they were due to finish to the time their results were sent.
+class LatencyReport:
+    def __init__(self, size=10000):
+        self.lock = Lock()
+        self.size = size
+        self.samples = []
+        self.count = 0
+
+    def add(self, latency):
+        with self.lock:
+            self.count += 1
+            if len(self.samples) < self.size:
+                self.samples.append(latency)
+            else:
+                self.samples[self.count % self.size] = latency  # Keep the most recent samples.
+
+    def summary(self):
+        with self.lock:
+            samples = sorted(self.samples)
+            count = self.count
+        if not samples:
+            return {"MATCHES": count}
+        return {"MATCHES": count,
+                "P50 (ms)": round(samples[len(samples) // 2] * 1000, 2),
+                "P99 (ms)": round(samples[min(len(samples) - 1, len(samples) * 99 // 100)] * 1000, 2),
+                "MAX (ms)": round(samples[-1] * 1000, 2)}
+
+
+# Runs functions on a small fixed pool of worker threads, either right away or once a delay has passed. Delayed
+# functions are kept in a heap ordered by due time and handed to the workers by a single timer thread, so waiting
+# costs no thread at all.
+class LobbyScheduler(Thread):
+    def __init__(self, workers=4, report_interval=60):
+        Thread.__init__(self)
+        self.daemon = True
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.events = []
+        self.counter = itertools.count()
+        self.events_condition = Condition()
+        self.report_interval = report_interval
+        self.latency = LatencyReport()
+
+    def execute(self, function, *args):
+        try:
+            function(*args)
+        except Exception:
+            traceback.print_exc()
+
+    def submit(self, function, *args):
+        return self.executor.submit(self.execute, function, *args)
+
+    def schedule(self, delay, function, *args):
+        with self.events_condition:
+            heapq.heappush(self.events, (time.monotonic() + delay, next(self.counter), function, args))
+            self.events_condition.notify()
+
+    # Hand the function to a worker and record how long after its due time it completed.
+    def dispatch(self, due_time, function, args):
+        def run():
+            self.execute(function, *args)
+            self.latency.add(time.monotonic() - due_time)
+        self.executor.submit(run)
+
+    def run(self):
+        next_report = time.monotonic() + self.report_interval
+        while True:
+            with self.events_condition:
+                now = time.monotonic()
+                while self.events and self.events[0][0] <= now:
+                    due_time, _, function, args = heapq.heappop(self.events)
+                    self.dispatch(due_time, function, args)
+                timeout = min(next_report, self.events[0][0] if self.events else next_report) - now
+                self.events_condition.wait(max(timeout, 0))
+            if time.monotonic() >= next_report:
+                print("Match completion latency: {}".format(self.latency.summary()))
+                next_report = time.monotonic() + self.report_interval
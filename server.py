@@ -1,247 +1,742 @@
-import socket
+import os
 import time
+import signal
+import threading
+import bisect
+import itertools
+import contextlib
+import argparse
+import socket
 import random
 import json
 import concurrent.futures
+import numpy as np
+from collections import deque
 from client import Commands, AutomatedClient
-from threading import Thread, Condition, Event, Lock
-from player import Player, Status, Info
-from lobby import SoloLobby
+from threading import Thread, Condition, Lock
+from player import Player, PlayerStore, Info
+from lobby import SoloLobby, LobbyIndex, ToleranceCurve, DEFAULT_TOLERANCE, UNCONSTRAINED, form_lobbies
+from leaderboard import Leaderboard
+from storage import Storage, hash_password
+from scheduler import LobbyScheduler
+from metrics import Metrics, MetricsDump, RATING_BUCKETS
+from rating import ENGINES, RatingPeriods
+from profiler import Profiler, ProfilingMode
+from history import MatchHistory
+from sharding import QueueEntry, ShardRouter, band_boundaries, EDGE_MARGIN
+from protocol import Connection, MessageType, ProtocolError, FramingError, SharedFrame, FrameCache
+
+# Commands the servers respond to, each counted by a metric of its own.
+SERVER_COMMANDS = (Commands.SIGN_UP, Commands.SIGN_IN, Commands.PROFILE, Commands.LEADERBOARD, Commands.STATS,
+                   Commands.CASUAL, Commands.COMPETITIVE, Commands.CANCEL, Commands.QUEUE_STATUS, Commands.PROFILER)
+# Seconds an idle matchmaking worker waits on its own rating band before looking for players in the other bands.
+STEAL_INTERVAL = 0.01
+
+
+# A player's place in a queue, made anew each time they queue up. A cancelled ticket is left in the queue as a
+# tombstone that the matchmaking skips, so that cancelling takes constant time whatever the length of the queue.
+class QueueTicket:
+    counter = itertools.count()
+
+    def __init__(self, client, queue):
+        self.ticket_id = next(QueueTicket.counter)
+        self.player = client.player
+        self.connection = client.connection
+        self.queue = queue
+        self.queued_at = time.monotonic()
+        self.band = None  # Rating band of the queue the player waits in.
+        self.lobby = None  # Open lobby the player is waiting in.
+        self.matched = False  # Set once the lobby of the player is full, after which the ticket can't be cancelled.
+        self.cancelled = False
+        self.finished = False
 
 
 class ClientThread(Thread):
     def __init__(self, server, connection, host, port):
         Thread.__init__(self)
         self.server = server
-        self.connection = connection
+        self.connection = Connection(connection)
         self.host = host
         self.port = port
-        self.player_condition = Condition()
         self.player = None
-        self.match = None
+        self.ticket = None
+
+    def matchmaking_system(self, queue):
+        if queue == Commands.CASUAL.value:
+            return self.server.casual_matchmaking
+        return self.server.competitive_matchmaking
+
+    def queued(self):
+        return self.ticket is not None and not self.ticket.finished
+
+    # Queue the player up and acknowledge it right away. The result of the match is pushed once it is over.
+    def queue_up(self, queue):
+        if self.queued():
+            return {"QUEUED": False, "QUEUE": self.ticket.queue}
+        self.ticket = QueueTicket(self, queue)
+        self.player.in_queue()
+        self.matchmaking_system(queue).enqueue(self.ticket)
+        return {"QUEUED": True, "QUEUE": queue}
 
-    def player_in_game(self):
-        return self.player.info[Info.STATUS.value] == Status.IN_GAME.value
+    # Take the player out of the queue, unless their match has already been made.
+    def cancel(self):
+        if not self.queued() or not self.matchmaking_system(self.ticket.queue).cancel(self.ticket):
+            return False
+        self.ticket = None
+        self.player.online()
+        return True
+
+    def queue_status(self):
+        status = {"STATUS": self.player.status, "QUEUE": None, "WAIT": None}
+        if self.queued():
+            status["QUEUE"] = self.ticket.queue
+            status["WAIT"] = round(time.monotonic() - self.ticket.queued_at, 4)
+        return status
+
+    def disconnect(self):
+        if self.player:
+            self.cancel()
+            self.player.offline()
+            print("{} has disconnected.".format(self.player.username))
+        self.server.connections.dec()
+        self.connection.close()
 
     def run(self):
+        try:
+            self.connection.accept()
+        except (ProtocolError, json.JSONDecodeError, socket.error) as e:
+            print(e)
+            self.connection.close()
+            return
+        self.server.connections.inc()
         while True:
             try:
-                data = self.connection.recv(2048)
-                if not data:
+                frame = self.connection.recv()
+                if not frame:
+                    self.disconnect()
                     break
-                command = data.decode("utf-8")
-                if command == Commands.SIGN_UP.value:
-                    account = {Info.USERNAME.value: None, Info.PASSWORD.value: None}
-                    credentials = json.dumps(account)
-                    self.connection.send(str.encode(credentials))
-                    data = self.connection.recv(2048)
-                    credentials = data.decode("utf-8")
-                    account = json.loads(credentials)
-                    username = account[Info.USERNAME.value]
-                    if self.server.players.get(username):
-                        confirmation = json.dumps(False)
-                        self.connection.send(str.encode(confirmation))
-                    else:
-                        confirmation = json.dumps(True)
-                        player = Player(len(self.server.players), username)
-                        self.server.players[username] = player
-                        self.server.accounts[username] = account
-                        self.connection.send(str.encode(confirmation))
-                        self.player = player
-                        self.player.online()
-                        print("{} has connected.".format(username))
-                elif command == Commands.SIGN_IN.value:
-                    account = {Info.USERNAME.value: None, Info.PASSWORD.value: None}
-                    credentials = json.dumps(account)
-                    self.connection.send(str.encode(credentials))
-                    data = self.connection.recv(2048)
-                    credentials = data.decode("utf-8")
-                    account = json.loads(credentials)
-                    username = account[Info.USERNAME.value]
-                    password = account[Info.PASSWORD.value]
-                    if self.server.players.get(username):
-                        if password == self.server.accounts[username][Info.PASSWORD.value]:
-                            confirmation = json.dumps(True)
-                            self.connection.send(str.encode(confirmation))
-                            self.player = self.server.players[username]
-                            self.player.info[Info.STATUS.value] = Status.ONLINE.value
-                            self.player.online()
-                            print("{} has connected.".format(username))
-                        else:
-                            confirmation = json.dumps(False)
-                            self.connection.send(str.encode(confirmation))
-                    else:
-                        confirmation = json.dumps(False)
-                        self.connection.send(str.encode(confirmation))
-                elif command == Commands.PROFILE.value:
-                    profile = json.dumps(self.player.info)
-                    self.connection.send(str.encode(profile))
-                elif command == Commands.LEADERBOARD.value:
-                    leaderboard = sorted(self.server.competitive_matchmaking.leaderboard,
-                                         key=lambda x: x.info[Info.RATING.value], reverse=True)
-                    count = len(leaderboard)
-                    data = json.dumps(count)
-                    self.connection.send(str.encode(data))  # Send the total number of players to display.
-                    players = []
-                    for player in leaderboard:
-                        count -= 1
-                        rank = player.info[Info.RANK.value]
-                        username = player.info[Info.USERNAME.value]
-                        rating = player.info[Info.RATING.value]
-                        rating_class = player.info[Info.CLASS.value]
-                        players.append({Info.RANK.value: rank, Info.USERNAME.value: username,
-                                        Info.RATING.value: rating, Info.CLASS.value: rating_class})
-                        if len(players) % 50 == 0 or count == 0:  # Display 50 players (or less) at a time.
-                            data = json.dumps(players)
-                            self.connection.send(str.encode(data))
-                            players.clear()
-                            data = self.connection.recv(1024)
-                            count = json.loads(data.decode("utf-8"))  # Wait for response before continuing.
-                elif command == Commands.CASUAL.value:
-                    pass
-                elif command == Commands.COMPETITIVE.value:
-                    # Notify the server that the queue isn't empty.
-                    with self.server.competitive_matchmaking.queue_condition:
-                        self.server.competitive_matchmaking.queue.append(self)
-                        self.server.competitive_matchmaking.queue_condition.notify()
-
-                    # Wait until the end of the match.
-                    with self.player_condition:
-                        self.player_condition.wait_for(self.player_in_game)
-                        self.match.wait()
-            except json.JSONDecodeError as e:
-                print(e)
-            except socket.error as e:
+                message_type, command = frame
+                if message_type != MessageType.COMMAND:
+                    continue
+                commands_count = self.server.commands_counts.get(command) if isinstance(command, str) else None
+                if commands_count is None:
+                    self.server.unknown_commands.inc()
+                    continue
+                commands_count.inc()
+                with self.server.profiler.span(command):
+                    try:
+                        self.handle(command)
+                    except FramingError:
+                        raise
+                    except (ProtocolError, json.JSONDecodeError) as e:
+                        # The frames of the command were read whole, so the session can go on.
+                        self.connection.send_data({"ERROR": str(e)})
+            except (ProtocolError, json.JSONDecodeError, socket.error) as e:
+                # The next frame can't be found once a frame couldn't be read: close the connection.
                 print(e)
-                if self.player:
-                    self.player.offline()
-                    print("{} has disconnected.".format(self.player.info[Info.USERNAME.value]))
-                self.connection.close()
-                del self
+                self.disconnect()
+                return
+            except Exception as e:
+                # Any other error leaves the session in an unknown state: close it rather than leak the connection.
+                print("Closing the connection after an unexpected error: {!r}".format(e))
+                self.disconnect()
                 return
 
+    # Respond to a command, along with the data that comes with it.
+    def handle(self, command):
+        if command == Commands.SIGN_UP.value:
+            account = {Info.USERNAME.value: None, Info.PASSWORD.value: None}
+            self.connection.send_data(account)
+            account = self.connection.recv_data()
+            username = account[Info.USERNAME.value]
+            password = account[Info.PASSWORD.value]
+            # Only a salted hash of the password is kept, computed before registering the account since hashing takes
+            # a while.
+            player = None
+            if isinstance(password, str) and not self.server.players.get(username):
+                player = self.server.register(username, hash_password(password))
+            if player is None:
+                self.connection.send_data(False)
+            else:
+                self.connection.send_data(True)
+                self.player = player
+                self.player.online()
+                print("{} has connected.".format(username))
+        elif command == Commands.SIGN_IN.value:
+            account = {Info.USERNAME.value: None, Info.PASSWORD.value: None}
+            self.connection.send_data(account)
+            account = self.connection.recv_data()
+            username = account[Info.USERNAME.value]
+            password = account[Info.PASSWORD.value]
+            if self.server.players.get(username):
+                if self.server.storage.check_password(self.server.players[username], self.server.accounts[username],
+                                                      password):
+                    self.connection.send_data(True)
+                    self.player = self.server.players[username]
+                    self.player.online()
+                    print("{} has connected.".format(username))
+                else:
+                    self.connection.send_data(False)
+            else:
+                self.connection.send_data(False)
+        elif command == Commands.PROFILE.value:
+            self.server.competitive_matchmaking.refresh_rank(self.player)
+            self.connection.send_frame(self.server.profile_frame(self.player, self.connection.codec))
+        elif command == Commands.LEADERBOARD.value:
+            request = self.connection.recv_data()
+            self.connection.send_data(self.server.competitive_matchmaking.leaderboard_page(request))
+        elif command == Commands.STATS.value:
+            self.connection.send_data(self.server.stats())
+        elif command == Commands.CASUAL.value or command == Commands.COMPETITIVE.value:
+            self.connection.send_data(self.queue_up(command))
+        elif command == Commands.CANCEL.value:
+            self.connection.send_data(self.cancel())
+        elif command == Commands.QUEUE_STATUS.value:
+            self.connection.send_data(self.queue_status())
+        elif command == Commands.PROFILER.value:
+            request = self.connection.recv_data()
+            self.connection.send_data(self.toggle_profiler(request))
 
-class SoloLobbyThread(Thread):
-    def __init__(self, matchmaking_system, capacity):
-        Thread.__init__(self)
+    # Start or stop the profiler, which writes files on the server, for the admins of the server only.
+    def toggle_profiler(self, request):
+        if self.player is None or self.player.username not in self.server.admins:
+            return {"ERROR": "Only the admins of the server can profile it."}
+        try:
+            mode = ProfilingMode(request["MODE"])
+        except (TypeError, KeyError, ValueError):
+            return {"ERROR": "Invalid profiling mode."}
+        return self.server.profiler.toggle(mode)
+
+
+# Lobby tracked as plain state: it doesn't own a thread, its match is started on the scheduler's workers as soon as it
+# is full and finished by a timer once the game is over.
+class ScheduledLobby:
+    def __init__(self, matchmaking_system, capacity, band=None):
         self.matchmaking_system = matchmaking_system
-        self.lobby = SoloLobby(capacity)
-        self.players_threads = []
-        self.lobby_condition = Condition()
-        self.match = Event()
+        self.band = band  # Rating band whose open lobbies hold the lobby.
+        self.scheduler = matchmaking_system.scheduler
+        self.lobby = SoloLobby(capacity, matchmaking_system.tolerance)
+        self.tickets = set()
+        self.lobby_lock = Lock()
+        self.before = None
+        self.predictions = None
+        self.placements = None
+        self.created_at = time.monotonic()
+        self.started_at = None
 
     def fill(self, entry):
-        with self.lobby_condition:
-            found_lobby = self.lobby.fill(entry.player)
+        with self.lobby_lock:
+            found_lobby = self.lobby.fill(entry.player, entry.queued_at)
             if found_lobby:
-                entry.match = self.match
-                self.players_threads.append(entry)
+                entry.lobby = self
+                self.tickets.add(entry)
                 if self.ready():
-                    self.lobby_condition.notify()
+                    for ticket in self.tickets:
+                        ticket.matched = True
+                    self.matchmaking_system.lobby_fill_time.observe(time.monotonic() - self.created_at)
+                    self.scheduler.submit(self.start)
             return found_lobby
 
+    # Take a player who cancelled out of the open lobby, and return the number of players left.
+    def remove(self, entry):
+        with self.lobby_lock:
+            self.lobby.remove(entry.player)
+            self.tickets.discard(entry)
+            entry.lobby = None
+            return len(self.lobby.players)
+
+    # Take the players of a lobby filled elsewhere, by the batch matchmaking or by a matchmaking shard along with their
+    # placement probabilities, and start the match.
+    def assign(self, entries, placements=None):
+        with self.lobby_lock:
+            self.lobby.assign([entry.player for entry in entries], [entry.queued_at for entry in entries])
+            for entry in entries:
+                entry.lobby = self
+                entry.matched = True
+            self.tickets = set(entries)
+            self.placements = placements
+        self.scheduler.submit(self.start)
+
     def ready(self):
         return self.lobby.ready()
 
-    def run(self):
-        with self.lobby_condition:
-            self.lobby_condition.wait_for(self.ready)
-            self.lobby.predict_outcome()
-            before = self.lobby.display_players()
-            predictions = self.lobby.display_predictions()
-            for player_thread in self.players_threads:
-                with player_thread.player_condition:
-                    player_thread.player.in_game()
-                    player_thread.player_condition.notify()
-            self.lobby.simulate_match(self.matchmaking_system.rated)
-            time.sleep(random.randint(2, 5))
+    def average_rating(self):
+        return self.lobby.average_rating()
+
+    def start(self):
+        with self.lobby_lock:
+            self.started_at = time.monotonic()
+            self.matchmaking_system.record_match(self.lobby.players,
+                                                 [self.started_at - ticket.queued_at for ticket in self.tickets])
+            profiler = self.matchmaking_system.server.profiler
+            with profiler.span("PREDICT"):
+                if self.matchmaking_system.rated:
+                    self.lobby.predict_outcome(self.placements)
+                    self.predictions = self.lobby.display_predictions()
+                else:
+                    self.lobby.predict_scores()
+            self.before = self.lobby.display_players()
+            ratings = {player.user_id: player.rating for player in self.lobby.players}
+            for ticket in self.tickets:
+                ticket.player.in_game()
+            with profiler.span("SIMULATE"):
+                self.lobby.simulate_match(self.matchmaking_system.rated,
+                                          engine=self.matchmaking_system.server.rating_engine)
+            # With a rating period, the results are saved and recorded in the history once the period has rated them.
+            engine = self.matchmaking_system.server.rating_engine
+            if self.matchmaking_system.rated and not (engine and engine.batched):
+                players = self.lobby.players
+                self.matchmaking_system.server.storage.record_results(players)
+                self.matchmaking_system.server.history.record([player.user_id for player in players],
+                                                              [ratings[player.user_id] for player in players],
+                                                              [player.rating for player in players])
+        self.scheduler.schedule(random.randint(2, 5), self.finish)
+
+    def finish(self):
+        with self.lobby_lock:
             after = self.lobby.display_players()
-            result = {"BEFORE": before, "PREDICTIONS": predictions, "AFTER": after}
-            for player_thread in self.players_threads:
-                data = json.dumps(result)
-                player_thread.connection.send(str.encode(data))
-                player_thread.player.online()
+            result = {"BEFORE": self.before}
+            if self.predictions is not None:
+                result["PREDICTIONS"] = self.predictions
+            result["AFTER"] = after
+            # Seconds each player waited in the queue before the match started.
+            result["QUEUE TIMES"] = {ticket.player.username: round(self.started_at - ticket.queued_at, 4)
+                                     for ticket in self.tickets}
+            result = SharedFrame(MessageType.EVENT, result)
+            with self.matchmaking_system.server.profiler.span("SEND RESULT"):
+                for ticket in self.tickets:
+                    try:
+                        ticket.connection.send_frame(result.frame(ticket.connection.codec))
+                    except socket.error as e:
+                        print(e)
+                    ticket.finished = True
+                    ticket.player.leave_game()
+        if self.matchmaking_system.rated:
             self.matchmaking_system.update_leaderboard(self.lobby.players)
-            self.matchmaking_system.lobbies.remove(self)
-            self.match.set()
-            del self
+        self.matchmaking_system.lobbies.discard(self)
+
 
+# One rating band of the queue. Players of different bands queue up and are placed without contending: each band has
+# its own lock for its queue, and a separate lock for its open lobbies, so that placing players doesn't hold up those
+# queueing up.
+class QueueBand:
+    def __init__(self, index, capacity, tolerance=DEFAULT_TOLERANCE):
+        self.index = index
+        self.queue = deque()
+        self.condition = Condition()
+        self.lobbies_lock = Lock()
+        self.open_lobbies = LobbyIndex(capacity, tolerance)
 
+
+# The queue can be split into rating bands, a single band by default, and each matchmaking worker serves a home band,
+# stealing players from the other bands when its own is empty. A player near the edge of their band is also matched
+# against the lobbies of the neighbouring band, whose lock is then taken as well, locks being always taken in the order
+# of the bands.
 class MatchmakingSystem(Thread):
-    def __init__(self, server, capacity, rated):
+    metrics_prefix = ""
+
+    def __init__(self, server, capacity, rated, tolerance=DEFAULT_TOLERANCE, tick=None, bands=1):
         Thread.__init__(self)
         self.server = server
         self.channels_count = 5
         self.capacity = capacity
         self.rated = rated
-        self.leaderboard = []
+        self.tolerance = tolerance
+        self.tick = tick
+        self.scheduler = server.scheduler
+        self.leaderboard = Leaderboard() if rated else None  # Unrated matches don't move anyone on a leaderboard.
         self.refresh_lock = Lock()
-        self.queue = []
-        self.lobbies = []
-        self.queue_condition = Condition()
+        self.lobbies = set()
+        self.stopped = False
+        ratings = [player.rating for player in server.players.values() if player.games]
+        self.boundaries = band_boundaries(ratings, bands) if bands > 1 else []
+        self.bands = [QueueBand(i, capacity, tolerance) for i in range(bands)]
+
+        # Metrics of the matchmaking, kept at hand for the hot path.
+        metrics = server.metrics
+        self.queue_depth = metrics.gauge(self.metrics_prefix + "QUEUE DEPTH")
+        self.open_lobbies_count = metrics.gauge(self.metrics_prefix + "OPEN LOBBIES")
+        self.queue_wait_time = metrics.histogram(self.metrics_prefix + "QUEUE WAIT TIME")
+        self.lobby_fill_time = metrics.histogram(self.metrics_prefix + "LOBBY FILL TIME")
+        self.rating_spread = metrics.histogram(self.metrics_prefix + "LOBBY RATING SPREAD", RATING_BUCKETS)
+        self.matches = metrics.counter(self.metrics_prefix + "MATCHES")
+        self.refresh_lock_time = None
+        if rated:
+            self.refresh_lock_time = metrics.histogram(self.metrics_prefix + "LEADERBOARD LOCK HOLD TIME")
+
+    def band(self, rating):
+        return self.bands[bisect.bisect_right(self.boundaries, rating)]
+
+    # The neighbouring band whose lobbies a player close to the edge of their band can also join, if any.
+    def neighbour(self, band, rating):
+        i = band.index
+        if i > 0 and rating - self.boundaries[i - 1] < EDGE_MARGIN:
+            return self.bands[i - 1]
+        if i < len(self.boundaries) and self.boundaries[i] - rating <= EDGE_MARGIN:
+            return self.bands[i + 1]
+        return None
+
+    # Hold the lobby locks of the given bands, taken in the order of the bands so that two workers can't deadlock.
+    @contextlib.contextmanager
+    def locked(self, bands):
+        with contextlib.ExitStack() as stack:
+            with self.server.profiler.span("LOCK WAIT"):
+                for band in sorted(set(bands), key=lambda band: band.index):
+                    stack.enter_context(band.lobbies_lock)
+            yield
+
+    # Notify the matchmaking that the band of the player isn't empty.
+    def enqueue(self, entry):
+        band = self.band(entry.player.rating)
+        entry.band = band
+        self.queue_depth.inc()
+        with band.condition:
+            band.queue.append(entry)
+            band.condition.notify()
+
+    # Pop the next player of the home band of a worker, or steal one from the other bands if it is empty. When every
+    # band is empty, wait for a player to queue up in the home band, looking at the others again after a while if there
+    # are any.
+    def take(self, home):
+        bands = self.bands[home:] + self.bands[:home]
+        while not self.stopped:
+            for band in bands:
+                with band.condition:
+                    if band.queue:
+                        return band.queue.popleft()
+            with bands[0].condition:
+                bands[0].condition.wait_for(lambda: bands[0].queue or self.stopped,
+                                            STEAL_INTERVAL if len(bands) > 1 else None)
+        return None
+
+    # Take a player out of the matchmaking, unless their lobby is already full. A player still in the queue is left
+    # there as a tombstone, and a player waiting in an open lobby is removed from it, both in constant time.
+    def cancel(self, entry):
+        band = entry.band
+        with self.locked(self.bands[max(band.index - 1, 0):band.index + 2]):
+            if entry.matched or entry.cancelled:
+                return False
+            entry.cancelled = True
+            if entry.lobby is None:
+                self.queue_depth.dec()
+            else:
+                self.leave_lobby(entry.lobby, entry)
+            return True
 
-    def players_in_queue(self):
-        return len(self.queue) > 0
+    # Remove a player from their open lobby, which moves according to its new average rating or closes if it is empty.
+    def leave_lobby(self, lobby, entry):
+        if lobby.remove(entry):
+            lobby.band.open_lobbies.update(lobby)
+        else:
+            lobby.band.open_lobbies.remove(lobby)
+            self.lobbies.discard(lobby)
+            self.open_lobbies_count.dec()
 
     def update_leaderboard(self, players):
-        self.refresh_lock.acquire()
-        for player in players:
-            if not player.info[Info.RANK.value]:
-                self.leaderboard.append(player)
-        self.leaderboard.sort(key=lambda x: x.info[Info.RATING.value], reverse=True)
-        for i in range(len(self.leaderboard)):
-            self.leaderboard[i].info[Info.RANK.value] = i + 1
-        self.refresh_lock.release()
-
-    def matchmaking(self):
-        while True:
-            # Wait for at least one player to queue up for a game.
-            with self.queue_condition:
-                self.queue_condition.wait_for(self.players_in_queue)
-                if len(self.lobbies) == 0:
-                    # Create a new lobby if there is none.
-                    lobby = SoloLobbyThread(self, self.capacity)
-                    lobby.daemon = True
-                    lobby.start()
-                    lobby.fill(self.queue.pop(0))
-                    self.lobbies.append(lobby)
-                else:
-                    # Search for an available lobby.
-                    found_lobby = False
-                    player = self.queue.pop(0)
-                    for lobby in self.lobbies:
-                        if not lobby.ready():
-                            found_lobby = lobby.fill(player)
-                        if found_lobby:
-                            break
-
-                    # Create a new lobby if all the existing lobbies are full.
-                    if not found_lobby:
-                        lobby = SoloLobbyThread(self, self.capacity)
-                        lobby.daemon = True
-                        lobby.start()
-                        lobby.fill(player)
-                        self.lobbies.append(lobby)
+        with self.server.profiler.span("UPDATE LEADERBOARD"), self.refresh_lock:
+            start = time.perf_counter()
+            for player in players:
+                self.leaderboard.update(player)
+            for player in players:
+                player.rank = self.leaderboard.rank(player)
+            hold_time = time.perf_counter() - start
+        self.refresh_lock_time.observe(hold_time)
+
+    # Record the start of a match, with the time each of its players spent in the queue.
+    def record_match(self, players, queue_times):
+        ratings = [player.rating for player in players]
+        self.matches.inc()
+        self.rating_spread.observe(max(ratings) - min(ratings))
+        for queue_time in queue_times:
+            self.queue_wait_time.observe(queue_time)
+
+    def refresh_rank(self, player):
+        with self.refresh_lock:
+            player.rank = self.leaderboard.rank(player)
+
+    # Read a page of the leaderboard from its latest snapshot, which is built without holding the refresh lock.
+    def leaderboard_page(self, request):
+        return self.leaderboard.read(request, self.server.players)
+
+    # Place a player popped from the queue of the given band in a lobby, holding the lobby locks of the band and of the
+    # neighbouring band when the player is close to its edge.
+    def place(self, player, band):
+        rating = player.player.rating
+        neighbour = self.neighbour(band, rating)
+        with self.locked([band, neighbour] if neighbour else [band]):
+            if player.cancelled:
+                return
+            self.queue_depth.dec()
+
+            # Search for an available lobby among those with a close enough average rating.
+            found_lobby = None
+            for lobby_band in [band, neighbour] if neighbour else [band]:
+                for lobby in lobby_band.open_lobbies.candidates(rating):
+                    if lobby.fill(player):
+                        found_lobby = lobby
+                        break
+                if found_lobby:
+                    break
+
+            # Create a new lobby if none of the existing lobbies can accept the player.
+            if not found_lobby:
+                found_lobby = ScheduledLobby(self, self.capacity, band)
+                found_lobby.fill(player)
+                self.lobbies.add(found_lobby)
+                found_lobby.band.open_lobbies.add(found_lobby)
+                self.open_lobbies_count.inc()
+
+            # Full lobbies no longer accept players, the others move according to their new average rating.
+            if found_lobby.ready():
+                found_lobby.band.open_lobbies.remove(found_lobby)
+                self.open_lobbies_count.dec()
+            else:
+                found_lobby.band.open_lobbies.update(found_lobby)
+
+    def matchmaking(self, home=0):
+        while not self.stopped:
+            player = self.take(home)
+            if player is not None:
+                with self.server.profiler.span("PLACE"):
+                    self.place(player, player.band)
+
+    # Every tick, drain the whole queue at once and form lobbies out of the players sorted by rating. Players who don't
+    # fit in a lobby are kept for the next tick, so no lobby is left half-filled.
+    def batch_matchmaking(self):
+        pending = []
+        while not self.stopped:
+            time.sleep(self.tick)
+            for band in self.bands:
+                with band.condition:
+                    pending += band.queue
+                    band.queue.clear()
+            pending = [entry for entry in pending if not entry.cancelled]
+            if not pending:
+                continue
+            with self.server.profiler.span("FORM LOBBIES"):
+                lobbies, left_out = form_lobbies([entry.player for entry in pending],
+                                                 [entry.queued_at for entry in pending], self.capacity,
+                                                 self.tolerance)
+
+            # Players may have cancelled while the lobbies were formed: their lobbies are dropped, and the other players
+            # of those lobbies wait for the next tick.
+            matched = []
+            with self.locked(self.bands):
+                for players in lobbies:
+                    if any(pending[i].cancelled for i in players):
+                        left_out += [i for i in players if not pending[i].cancelled]
+                        continue
+                    for i in players:
+                        pending[i].matched = True
+                    self.queue_depth.dec(len(players))
+                    matched.append([pending[i] for i in players])
+            for entries in matched:
+                lobby = ScheduledLobby(self, self.capacity)
+                self.lobbies.add(lobby)
+                lobby.assign(entries)
+            pending = [pending[i] for i in left_out]
+
+    # Stop the matchmaking, waking up the workers waiting for players.
+    def stop(self):
+        self.stopped = True
+        for band in self.bands:
+            with band.condition:
+                band.condition.notify_all()
 
     def run(self):
+        if self.tick:
+            self.batch_matchmaking()
+            return
         with concurrent.futures.ThreadPoolExecutor(max_workers=self.channels_count) as executor:
             for i in range(self.channels_count):
-                executor.submit(self.matchmaking)
+                executor.submit(self.matchmaking, i % len(self.bands))
+
+
+# Unrated matchmaking built for the time to match rather than for balanced matches: lobbies admit players whatever
+# their rating, each player joins the fullest open lobby, and matches are played without predicting the placements.
+# It has its own queue, lobbies, locks and workers, and its metrics are kept apart, so that a burst of casual players
+# doesn't hold up the competitive matchmaking.
+class CasualMatchmakingSystem(MatchmakingSystem):
+    metrics_prefix = "CASUAL "
+
+    def __init__(self, server, capacity):
+        MatchmakingSystem.__init__(self, server, capacity, False, UNCONSTRAINED, bands=1)
+        self.scheduler = server.casual_scheduler
+        # open_lobbies[k] holds the open lobbies with k players, as the keys of a dict so that any can be removed.
+        self.open_lobbies = [{} for _ in range(capacity)]
+
+    def place(self, entry, band=None):
+        count = next((k for k in range(self.capacity - 1, 0, -1) if self.open_lobbies[k]), 0)
+        if count:
+            lobby = self.open_lobbies[count].popitem()[0]
+        else:
+            lobby = ScheduledLobby(self, self.capacity)
+            self.lobbies.add(lobby)
+        lobby.fill(entry)
+        if not lobby.ready():
+            self.open_lobbies[count + 1][lobby] = None
+
+    def leave_lobby(self, lobby, entry):
+        count = len(lobby.lobby.players)
+        del self.open_lobbies[count][lobby]
+        if lobby.remove(entry):
+            self.open_lobbies[count - 1][lobby] = None
+        else:
+            self.lobbies.discard(lobby)
+        self.open_lobbies_count.set(sum(len(lobbies) for lobbies in self.open_lobbies))
+
+    # Place the players in a single thread, taking everything the queue holds at once, so that the queue is only
+    # locked to be emptied.
+    def matchmaking(self, home=0):
+        band = self.bands[0]
+        while not self.stopped:
+            with band.condition:
+                band.condition.wait_for(lambda: band.queue or self.stopped)
+                entries = list(band.queue)
+                band.queue.clear()
+            with self.server.profiler.span("PLACE"), band.lobbies_lock:
+                for entry in entries:
+                    if not entry.cancelled:
+                        self.queue_depth.dec()
+                        self.place(entry)
+                self.open_lobbies_count.set(sum(len(lobbies) for lobbies in self.open_lobbies))
+
+    def run(self):
+        self.matchmaking()
+
+
+# Matchmaking sharded across processes by rating band, each shard owning the queue and the lobbies of its band, so that
+# it scales with the cores instead of contending on a single queue. This thread only routes the players to the shards
+# and starts the matches of the lobbies they fill.
+class ShardedMatchmakingSystem(MatchmakingSystem):
+    def __init__(self, server, capacity, rated, shards, tolerance=DEFAULT_TOLERANCE):
+        MatchmakingSystem.__init__(self, server, capacity, rated, tolerance, bands=1)
+        ratings = [player.rating for player in server.players.values() if player.games]
+        self.router = ShardRouter(capacity, band_boundaries(ratings, shards), tolerance)
+        self.waiting = {}
+        self.waiting_lock = Lock()
+
+    def enqueue(self, entry):
+        with self.waiting_lock:
+            self.waiting[entry.ticket_id] = entry
+            self.queue_depth.set(len(self.waiting))
+        self.route([entry])
+
+    def route(self, entries):
+        self.router.route([QueueEntry(entry.player.user_id, entry.player.username, entry.player.rating,
+                                      entry.queued_at, ticket_id=entry.ticket_id) for entry in entries])
+
+    # A player who cancels is only forgotten here: if a shard puts them in a lobby anyway, the other players of the
+    # lobby are routed to the shards again.
+    def cancel(self, entry):
+        with self.waiting_lock:
+            if entry.matched or entry.cancelled:
+                return False
+            entry.cancelled = True
+            del self.waiting[entry.ticket_id]
+            self.queue_depth.set(len(self.waiting))
+            return True
+
+    def run(self):
+        self.router.start()
+        while True:
+            for ticket_ids, placements in self.router.receive():
+                with self.waiting_lock:
+                    entries = [self.waiting.get(ticket_id) for ticket_id in ticket_ids]
+                    if None not in entries:
+                        for entry in entries:
+                            entry.matched = True
+                            del self.waiting[entry.ticket_id]
+                        self.queue_depth.set(len(self.waiting))
+                if None in entries:
+                    self.route([entry for entry in entries if entry is not None])
+                    continue
+                lobby = ScheduledLobby(self, self.capacity)
+                self.lobbies.add(lobby)
+                lobby.assign(entries, placements)
 
 
 class Server:
-    def __init__(self, host="127.0.0.1", port=1233):
+    def __init__(self, host="127.0.0.1", port=1233, data_path="data", shards=0, tolerance=DEFAULT_TOLERANCE,
+                 tick=None, capacity=2, casual_capacity=2, rating_engine=None, rating_period=None, admins=(), bands=1):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.host = host
         self.port = port
-        self.accounts = {}
-        self.players = {}
+        self.store = PlayerStore()
+        self.storage = Storage(data_path)
+        self.accounts, self.players = self.storage.load(self.store)
+        self.accounts_lock = Lock()  # Held to check that a username is free and register it in one step.
+        self.metrics = Metrics()
+        self.metrics_dump = MetricsDump(self.metrics, os.path.join(data_path, "metrics.json"))
+        self.connections = self.metrics.gauge("CONNECTIONS")
+        # The commands are counted by metrics made up front, and any other command by a single one, so that clients
+        # can't add metrics of their own.
+        self.commands_counts = {command.value: self.metrics.counter("{} COMMANDS".format(command.value))
+                                for command in SERVER_COMMANDS}
+        self.unknown_commands = self.metrics.counter("UNKNOWN COMMANDS")
         self.threads = []
-        # self.casual_matchmaking = MatchmakingSystem(self, 2, False)
-        # self.casual_matchmaking.daemon = True
-        self.competitive_matchmaking = MatchmakingSystem(self, 2, True)
+        self.profiler = Profiler(data_path)
+        self.admins = set(admins)  # Usernames allowed to start and stop the profiler.
+        self.profiles = FrameCache()  # Encoded profiles of the players, sent as-is until they change.
+        self.history = MatchHistory(os.path.join(data_path, "history")).load()
+        # Without an engine nor a rating period, matches are rated with the elo formula by the lobbies themselves.
+        self.rating_engine = None
+        self.rating_periods = None
+        if rating_engine or rating_period:
+            self.rating_engine = ENGINES[rating_engine or "elo"](self.store, batched=bool(rating_period))
+        if rating_period:
+            self.rating_periods = RatingPeriods(self.rating_engine, rating_period, self.rated)
+        self.scheduler = LobbyScheduler()
+        self.casual_scheduler = LobbyScheduler()
+        self.casual_matchmaking = CasualMatchmakingSystem(self, casual_capacity)
+        self.casual_matchmaking.daemon = True
+        if shards:
+            self.competitive_matchmaking = ShardedMatchmakingSystem(self, capacity, True, shards, tolerance)
+        else:
+            self.competitive_matchmaking = MatchmakingSystem(self, capacity, True, tolerance, tick, bands)
         self.competitive_matchmaking.daemon = True
+        self.competitive_matchmaking.leaderboard.build(player for player in self.players.values() if player.games)
+
+    # Save the ratings of the players rated at the end of a rating period, record the matches of the period in the
+    # history with the ratings from before and after it, and move the players on the leaderboard.
+    def rated(self, matches, user_ids, ratings):
+        players = [Player.view(self.store, user_id) for user_id in user_ids.tolist()]
+        self.storage.record_results(players)
+        for orders in matches:
+            before = ratings[np.searchsorted(user_ids, orders)].tolist()
+            after = self.store.ratings[orders].tolist()
+            for i, order in enumerate(orders.tolist()):
+                self.history.record(order, before[i], after[i])
+        self.competitive_matchmaking.update_leaderboard(players)
+
+    # Register a new account and its player under the next free user id, or return None if the username is taken.
+    def register(self, username, password_hash):
+        with self.accounts_lock:
+            if self.players.get(username):
+                return None
+            account = {Info.USERNAME.value: username, Info.PASSWORD.value: password_hash}
+            player = Player.create(username, store=self.store)
+            self.players[username] = player
+            self.accounts[username] = account
+            self.storage.record_sign_up(player, account)
+            return player
+
+    def stats(self):
+        stats = self.metrics.snapshot()
+        stats["PLAYERS"] = self.store.stats()
+        return stats
+
+    # Encoded profile of a player along with the sparkline of their last ratings, cached until either changes.
+    def profile_frame(self, player, codec):
+        return self.profiles.frame(codec, MessageType.DATA, player.user_id,
+                                   (player.version, self.history.count(player.user_id)),
+                                   lambda: {**player.info,
+                                            Info.RATING_HISTORY.value: self.history.sparkline(player.user_id)})
+
+    # Toggle the profiler in the sampling mode on SIGUSR1, and in the spans mode on SIGUSR2.
+    def toggle_profiler(self, signum, frame):
+        print(self.profiler.toggle(ProfilingMode.SAMPLING if signum == signal.SIGUSR1 else ProfilingMode.SPANS))
 
     def populate(self, m):
         for x in range(m):
@@ -254,7 +749,17 @@ class Server:
         try:
             self.socket.bind((self.host, self.port))
             print("\nWaiting for a connection...")
+            if threading.current_thread() is threading.main_thread():
+                signal.signal(signal.SIGUSR1, self.toggle_profiler)
+                signal.signal(signal.SIGUSR2, self.toggle_profiler)
+            self.storage.start()
+            self.metrics_dump.start()
+            if self.rating_periods:
+                self.rating_periods.start()
+            self.scheduler.start()
+            self.casual_scheduler.start()
             self.competitive_matchmaking.start()
+            self.casual_matchmaking.start()
             populate_thread = Thread(target=self.populate, args=(200,))
             populate_thread.daemon = True
             populate_thread.start()
@@ -269,5 +774,28 @@ class Server:
 
 
 if __name__ == "__main__":
-    game_server = Server()
+    parser = argparse.ArgumentParser(description="Run the game server.")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="number of matchmaking processes, each serving a rating band (0 to match in threads)")
+    parser.add_argument("--tolerance-growth", type=float, default=DEFAULT_TOLERANCE.growth,
+                        help="rating points per second of waiting by which the allowed rating deviation widens")
+    parser.add_argument("--max-rating-deviation", type=float, default=DEFAULT_TOLERANCE.maximum)
+    parser.add_argument("--tick", type=float, default=None,
+                        help="form lobbies out of the whole queue every tick milliseconds instead of player by player")
+    parser.add_argument("--capacity", type=int, default=2, help="number of players of a competitive match")
+    parser.add_argument("--casual-capacity", type=int, default=2, help="number of players of a casual match")
+    parser.add_argument("--rating-engine", choices=list(ENGINES), default=None)
+    parser.add_argument("--rating-period", type=float, default=None,
+                        help="rate the matches together every rating period seconds instead of as they end")
+    parser.add_argument("--bands", type=int, default=1,
+                        help="experimental: split the competitive queue into this many rating bands")
+    parser.add_argument("--admin", action="append", default=[], metavar="USERNAME",
+                        help="allow the given player to start and stop the profiler, can be repeated")
+    arguments = parser.parse_args()
+    game_server = Server(shards=arguments.shards, tick=arguments.tick / 1000 if arguments.tick else None,
+                         capacity=arguments.capacity, casual_capacity=arguments.casual_capacity,
+                         rating_engine=arguments.rating_engine, rating_period=arguments.rating_period,
+                         admins=arguments.admin, bands=arguments.bands,
+                         tolerance=ToleranceCurve(growth=arguments.tolerance_growth,
+                                                  maximum=arguments.max_rating_deviation))
     game_server.execute()
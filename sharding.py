@@ -0,0 +1,165 @@
+import math
+import time
+import queue
+import bisect
+import multiprocessing
+import numpy as np
+from lobby import SoloLobby, LobbyIndex, MAX_RATING_DEVIATION, DEFAULT_TOLERANCE
+
+# Lobbies within this distance of the edge of their band can be handed off to the neighbouring shard.
+EDGE_MARGIN = MAX_RATING_DEVIATION
+# Number of seconds a lobby near the edge of its band waits for players before being handed off.
+HANDOFF_DELAY = 1
+# Maximum number of messages handled by a shard before it sends back the lobbies it has filled.
+BATCH_SIZE = 256
+
+
+# What a shard knows of a player in its queue. It can fill a SoloLobby like a player would. The ticket id tells apart
+# the times a player queued up, and defaults to the user id.
+class QueueEntry:
+    __slots__ = ("user_id", "username", "rating", "queued_at", "handed_off", "ticket_id")
+
+    def __init__(self, user_id, username, rating, queued_at, handed_off=False, ticket_id=None):
+        self.user_id = user_id
+        self.username = username
+        self.rating = rating
+        self.queued_at = queued_at
+        self.handed_off = handed_off
+        self.ticket_id = user_id if ticket_id is None else ticket_id
+
+    def __reduce__(self):
+        return QueueEntry, (self.user_id, self.username, self.rating, self.queued_at, self.handed_off, self.ticket_id)
+
+
+# Split the ratings into bands holding about as many players each, and return the ratings at which each band ends.
+# With too few distinct ratings to go by, the bands are spread evenly around the starting rating instead.
+def band_boundaries(ratings, shards, starting_rating=1200):
+    ratings = np.asarray(ratings)
+    if len(np.unique(ratings)) >= 100 * shards:
+        boundaries = np.unique(np.quantile(ratings, np.arange(1, shards) / shards).round().astype(int)).tolist()
+        if len(boundaries) == shards - 1:
+            return boundaries
+    width = 2 * MAX_RATING_DEVIATION
+    return [starting_rating + round((i - shards / 2) * width) for i in range(1, shards)]
+
+
+# Matchmaking of a single rating band, run in its own process. It receives lists of queue entries, places them in its
+# own lobbies, predicts the outcome of the lobbies that are full, and sends back the ticket ids of their players along
+# with their placement probabilities. Lobbies that stay open near the edge of the band are handed back so that they
+# can be placed by the neighbouring shard, which lets players on both sides of an edge be matched together.
+class MatchmakingShard(multiprocessing.Process):
+    def __init__(self, index, capacity, low, high, inbox, outbox, tolerance=DEFAULT_TOLERANCE):
+        multiprocessing.Process.__init__(self)
+        self.daemon = True
+        self.index = index
+        self.capacity = capacity
+        self.tolerance = tolerance
+        self.low = low
+        self.high = high
+        self.inbox = inbox
+        self.outbox = outbox
+
+    def place(self, open_lobbies, entry, matches):
+        # Search for an available lobby among those with a close enough average rating.
+        found_lobby = None
+        for lobby in open_lobbies.candidates(entry.rating):
+            if lobby.fill(entry, entry.queued_at):
+                found_lobby = lobby
+                break
+
+        # Create a new lobby if none of the existing lobbies can accept the player.
+        if not found_lobby:
+            found_lobby = SoloLobby(self.capacity, self.tolerance)
+            found_lobby.fill(entry, entry.queued_at)
+            open_lobbies.add(found_lobby)
+
+        # Full lobbies are sent back with their predictions, the others move according to their new average rating.
+        if found_lobby.ready():
+            open_lobbies.remove(found_lobby)
+            found_lobby.predict_outcome()
+            matches.append(([entry.ticket_id for entry in found_lobby.players], found_lobby.placements.tolist()))
+        else:
+            open_lobbies.update(found_lobby)
+
+    # Take out the lobbies that have waited too long near an edge, and return their entries by direction of the
+    # neighbouring shard. Entries are only handed off once, so that they can't go back and forth between two shards.
+    def handoffs(self, open_lobbies):
+        now = time.monotonic()
+        handoffs = []
+        for lobby in open_lobbies.outside(self.low + EDGE_MARGIN, self.high - EDGE_MARGIN):
+            if any(entry.handed_off for entry in lobby.players):
+                continue
+            if now - min(entry.queued_at for entry in lobby.players) < HANDOFF_DELAY:
+                continue
+            open_lobbies.remove(lobby)
+            for entry in lobby.players:
+                entry.handed_off = True
+            handoffs.append((-1 if lobby.average_rating() < (self.low + self.high) / 2 else 1, lobby.players))
+        return handoffs
+
+    def run(self):
+        open_lobbies = LobbyIndex(self.capacity, self.tolerance)
+        stopped = False
+        while not stopped:
+            messages = []
+            try:
+                messages.append(self.inbox.get(timeout=HANDOFF_DELAY / 2))
+                while len(messages) < BATCH_SIZE:
+                    messages.append(self.inbox.get_nowait())
+            except queue.Empty:
+                pass
+            matches = []
+            for entries in messages:
+                if entries is None:
+                    stopped = True
+                    break
+                for entry in entries:
+                    self.place(open_lobbies, entry, matches)
+            handoffs = self.handoffs(open_lobbies)
+            if matches or handoffs:
+                self.outbox.put((self.index, matches, handoffs))
+
+
+# Routes queue entries to the shard of their rating band and forwards the handoffs between neighbouring shards.
+class ShardRouter:
+    def __init__(self, capacity, boundaries, tolerance=DEFAULT_TOLERANCE):
+        context = multiprocessing.get_context("spawn")
+        self.boundaries = boundaries
+        self.outbox = context.Queue()
+        self.inboxes = []
+        self.shards = []
+        bounds = [-math.inf] + list(boundaries) + [math.inf]
+        for i in range(len(boundaries) + 1):
+            inbox = context.Queue()
+            self.inboxes.append(inbox)
+            self.shards.append(MatchmakingShard(i, capacity, bounds[i], bounds[i + 1], inbox, self.outbox, tolerance))
+
+    def start(self):
+        for shard in self.shards:
+            shard.start()
+
+    def stop(self):
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for shard in self.shards:
+            shard.join()
+
+    def shard(self, rating):
+        return bisect.bisect_right(self.boundaries, rating)
+
+    def route(self, entries):
+        if len(self.inboxes) == 1:
+            self.inboxes[0].put(entries)
+            return
+        shards = {}
+        for entry in entries:
+            shards.setdefault(self.shard(entry.rating), []).append(entry)
+        for i, shard_entries in shards.items():
+            self.inboxes[i].put(shard_entries)
+
+    # Wait for the next lobbies filled by a shard and return them, after forwarding its handoffs.
+    def receive(self, timeout=None):
+        index, matches, handoffs = self.outbox.get(timeout=timeout)
+        for direction, entries in handoffs:
+            self.inboxes[index + direction].put(entries)
+        return matches
@@ -0,0 +1,252 @@
+import math
+import time
+import random
+import argparse
+import numpy as np
+import elo
+from collections import deque
+from player import Player, PlayerStore
+from lobby import SoloLobby, LobbyIndex, ToleranceCurve, DEFAULT_TOLERANCE, form_lobbies
+from leaderboard import Leaderboard
+from rating import ENGINES
+
+
+# In-process matchmaking without sockets nor threads: a synthetic population goes through the queue, the lobbies,
+# the predictions, the matches and the leaderboard as fast as the CPU allows, and every random draw comes from
+# generators seeded once, so that a run can be reproduced. Players can be given a hidden skill that decides the outcome
+# of their matches, to see how well the ratings converge towards it.
+#
+# Time is simulated: the players queue up one after the other at the arrival rate, and each player is placed at the
+# time they queue up, so that the tolerance of the lobbies widens with the simulated wait of their players.
+#
+# The players are queued up in rounds. The lobbies that are full by the end of a round are played together, their
+# predictions and rating updates being computed for all of them at once, unless exact is set, in which case each lobby
+# is played on its own through SoloLobby.predict_outcome and SoloLobby.simulate_match as the servers do.
+#
+# With a tick, the players are placed in lobbies tick by tick of simulated time, as the batch matchmaking of the server
+# does, instead of one at a time.
+#
+# With a rating engine, the matches are rated by the engine instead of the elo formula, each round being a rating
+# period.
+class Simulation:
+    def __init__(self, players=10000, capacity=2, rated=True, seed=0, skill_deviation=None, round_size=4096,
+                 exact=False, tolerance=DEFAULT_TOLERANCE, arrival_rate=1000, rating_deviation=None, tick=None,
+                 engine=None):
+        self.rng = random.Random(seed)
+        self.numpy_rng = np.random.default_rng(seed)
+        self.capacity = capacity
+        self.rated = rated
+        self.round_size = round_size
+        self.exact = exact
+        self.tolerance = tolerance
+        self.arrival_rate = arrival_rate
+        self.tick = tick
+        self.store = PlayerStore(players)
+        self.engine = ENGINES[engine](self.store, batched=True) if engine else None
+        ratings = [1200] * players
+        if rating_deviation:
+            ratings = np.maximum(self.numpy_rng.normal(1200, rating_deviation, players).round(), 1).astype(int).tolist()
+        self.players = [Player(i, "Player-{}".format(i), ratings[i], self.store) for i in range(players)]
+        self.skills = None
+        if skill_deviation:
+            self.skills = self.numpy_rng.normal(1200, skill_deviation, players)
+        self.idle = list(self.players)
+        self.queue = deque()
+        self.pending = []  # Players left out of the lobbies formed at the previous tick.
+        self.open_lobbies = LobbyIndex(capacity, tolerance)
+        self.leaderboard = Leaderboard(seed)
+        self.clock = 0
+        self.queued_at = np.zeros(players)
+        self.matches = 0
+        self.spread = 0  # Sum of the differences between the highest and the lowest rating of each match.
+        self.waits = []  # Time each matched player spent in the queue.
+
+    # Queue up random idle players.
+    def enqueue(self, count):
+        for _ in range(min(count, len(self.idle))):
+            i = self.rng.randrange(len(self.idle))
+            self.idle[i], self.idle[-1] = self.idle[-1], self.idle[i]
+            player = self.idle.pop()
+            self.queued_at[player.user_id] = self.clock
+            self.queue.append((player, self.clock))
+            self.clock += 1 / self.arrival_rate
+
+    # Place every queued player in a lobby and return the lobbies that are full.
+    def matchmaking(self):
+        full_lobbies = []
+        while self.queue:
+            player, now = self.queue.popleft()
+
+            # Search for an available lobby among those with a close enough average rating.
+            found_lobby = None
+            for lobby in self.open_lobbies.candidates(player.rating):
+                if lobby.fill(player, now, now):
+                    found_lobby = lobby
+                    break
+
+            # Create a new lobby if none of the existing lobbies can accept the player.
+            if not found_lobby:
+                found_lobby = SoloLobby(self.capacity, self.tolerance)
+                found_lobby.fill(player, now, now)
+                self.open_lobbies.add(found_lobby)
+
+            # Full lobbies no longer accept players, the others move according to their new average rating.
+            if found_lobby.ready():
+                self.open_lobbies.remove(found_lobby)
+                full_lobbies.append(found_lobby)
+                self.waits += [now - self.queued_at[lobby_player.user_id] for lobby_player in found_lobby.players]
+            else:
+                self.open_lobbies.update(found_lobby)
+        return full_lobbies
+
+    # Place the queued players tick by tick: at the end of each tick, lobbies are formed out of the players who queued
+    # up during the tick and those left out at the previous ticks, all at once. Returns the lobbies formed.
+    def batch_matchmaking(self):
+        full_lobbies = []
+        while self.queue:
+            now = (math.floor(self.queue[0][1] / self.tick) + 1) * self.tick
+            while self.queue and self.queue[0][1] < now:
+                self.pending.append(self.queue.popleft())
+            players = [player for player, _ in self.pending]
+            lobbies, left_out = form_lobbies(players, [queued_at for _, queued_at in self.pending], self.capacity,
+                                             self.tolerance, now)
+            for indices in lobbies:
+                lobby = SoloLobby(self.capacity, self.tolerance)
+                lobby.assign([players[i] for i in indices])
+                full_lobbies.append(lobby)
+                self.waits += [now - self.pending[i][1] for i in indices]
+            self.pending = [self.pending[i] for i in left_out]
+        return full_lobbies
+
+    # Play a single lobby the way the servers do.
+    def play_lobby(self, lobby):
+        lobby.predict_outcome()
+        ratings = [player.rating for player in lobby.players]
+        self.spread += max(ratings) - min(ratings)
+        scores = None
+        if self.skills is not None:
+            scores = elo.expected_scores(self.skills[[player.user_id for player in lobby.players]])
+        lobby.simulate_match(self.rated, self.rng, scores, self.engine)
+
+    # Play full lobbies all at once, with the same predictions and rating updates as SoloLobby.simulate_match.
+    def play_lobbies(self, lobbies):
+        user_ids = np.array([[player.user_id for player in lobby.players] for lobby in lobbies])
+        ratings = self.store.ratings[user_ids]
+        self.spread += int((ratings.max(axis=1) - ratings.min(axis=1)).sum())
+        scores = elo.expected_scores(ratings)
+        expected = elo.expected_placements(elo.predict_placements(scores))
+        if self.skills is not None:
+            scores = elo.expected_scores(self.skills[user_ids])
+        order = elo.simulate_orders(scores, self.numpy_rng)
+        user_ids = np.take_along_axis(user_ids, order, axis=1)
+        if self.rated and self.engine:
+            self.engine.record(user_ids)
+            self.store.record_games(user_ids[:, 0], user_ids[:, 1:])
+        elif self.rated:
+            ratings = elo.updated_ratings(np.take_along_axis(ratings, order, axis=1), elo.K_FACTOR,
+                                          np.take_along_axis(expected, order, axis=1),
+                                          np.arange(1, self.capacity + 1))
+            self.store.ratings[user_ids] = ratings
+            self.store.refresh_classes(user_ids)
+            self.store.record_games(user_ids[:, 0], user_ids[:, 1:])
+
+    # Move the players of the round on the leaderboard, rebuilding it whole when that is cheaper.
+    def update_leaderboard(self, players):
+        if len(players) * 8 < len(self.leaderboard):
+            for player in players:
+                self.leaderboard.update(player)
+        else:
+            self.leaderboard.build(player for player in self.players if player.games)
+
+    # Play the given number of matches, or fewer if the players left can't be matched with each other.
+    def run(self, matches):
+        target = self.matches + matches
+        start = time.perf_counter()
+        while self.matches < target:
+            self.enqueue(min(self.round_size, (target - self.matches) * self.capacity))
+            lobbies = self.batch_matchmaking() if self.tick else self.matchmaking()
+            if not lobbies:
+                if self.idle:
+                    continue
+                break
+            if self.exact:
+                for lobby in lobbies:
+                    self.play_lobby(lobby)
+            else:
+                self.play_lobbies(lobbies)
+            if self.engine:
+                self.engine.apply()
+            players = [player for lobby in lobbies for player in lobby.players]
+            self.update_leaderboard(players)
+            self.idle += players
+            self.matches += len(lobbies)
+        return self.report(time.perf_counter() - start)
+
+    def report(self, elapsed):
+        ratings = self.store.ratings[:len(self.players)]
+        report = {"MATCHES": self.matches,
+                  "SECONDS": round(elapsed, 2),
+                  "MATCHES PER MINUTE": round(self.matches / elapsed * 60) if elapsed else 0,
+                  "AVERAGE RATING SPREAD": round(self.spread / self.matches, 2) if self.matches else 0,
+                  "RATING DEVIATION": round(float(ratings.std()), 2),
+                  "OPEN LOBBIES": len(self.open_lobbies),
+                  "WAITING PLAYERS": len(self.pending) + sum(len(lobby.players) for lobby in self.open_lobbies.lobbies)}
+        if self.waits:
+            waits = np.array(self.waits)
+            report["P50 WAIT (s)"] = round(float(np.percentile(waits, 50)), 3)
+            report["P99 WAIT (s)"] = round(float(np.percentile(waits, 99)), 3)
+        if self.skills is not None:
+            report["SKILL CORRELATION"] = round(float(np.corrcoef(ratings, self.skills)[0][1]), 4)
+        return report
+
+
+# Compare the quality of the matches with the time the players wait for them, for tolerance curves widening at
+# different rates. The players start from spread out ratings, so that some of them wait at the extremes.
+def tolerance_report(growths=(0, 5, 10, 20, 50, 100), matches=100000, players=10000, capacity=2, arrival_rate=1000,
+                     rating_deviation=400, maximum=3 * DEFAULT_TOLERANCE.base, seed=0):
+    print("%-16s%-16s%-16s%-16s%-16s" % ("GROWTH (/s)", "RATING SPREAD", "P50 WAIT (s)", "P99 WAIT (s)",
+                                         "STILL WAITING"))
+    for growth in growths:
+        tolerance = ToleranceCurve(growth=growth, maximum=maximum)
+        simulation = Simulation(players, capacity, seed=seed, tolerance=tolerance, arrival_rate=arrival_rate,
+                                rating_deviation=rating_deviation)
+        report = simulation.run(matches)
+        print("%-16s%-16s%-16s%-16s%-16s" % (growth, report["AVERAGE RATING SPREAD"], report["P50 WAIT (s)"],
+                                             report["P99 WAIT (s)"], report["WAITING PLAYERS"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run matchmaking on a synthetic population without a server.")
+    parser.add_argument("--players", type=int, default=10000)
+    parser.add_argument("--matches", type=int, default=1000000)
+    parser.add_argument("--capacity", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skill-deviation", type=float, default=None)
+    parser.add_argument("--round-size", type=int, default=4096)
+    parser.add_argument("--unrated", action="store_true")
+    parser.add_argument("--exact", action="store_true", help="play each lobby on its own, as the servers do")
+    parser.add_argument("--arrival-rate", type=float, default=1000, help="players queueing up per simulated second")
+    parser.add_argument("--rating-deviation", type=float, default=None, help="spread of the starting ratings")
+    parser.add_argument("--tolerance-growth", type=float, default=DEFAULT_TOLERANCE.growth,
+                        help="rating points per second of waiting by which the allowed rating deviation widens")
+    parser.add_argument("--max-rating-deviation", type=float, default=DEFAULT_TOLERANCE.maximum)
+    parser.add_argument("--tick", type=float, default=None,
+                        help="form lobbies out of the whole queue every tick simulated seconds")
+    parser.add_argument("--rating-engine", choices=list(ENGINES), default=None,
+                        help="rate the matches of each round together with this engine instead of the elo formula")
+    parser.add_argument("--tolerance-report", action="store_true",
+                        help="compare the rating spread and the wait times for several tolerance growths")
+    arguments = parser.parse_args()
+    if arguments.tolerance_report:
+        tolerance_report(matches=arguments.matches, players=arguments.players, capacity=arguments.capacity,
+                         arrival_rate=arguments.arrival_rate, rating_deviation=arguments.rating_deviation or 400,
+                         maximum=arguments.max_rating_deviation, seed=arguments.seed)
+    else:
+        simulation = Simulation(arguments.players, arguments.capacity, not arguments.unrated, arguments.seed,
+                                arguments.skill_deviation, arguments.round_size, arguments.exact,
+                                ToleranceCurve(growth=arguments.tolerance_growth,
+                                               maximum=arguments.max_rating_deviation),
+                                arguments.arrival_rate, arguments.rating_deviation, arguments.tick,
+                                arguments.rating_engine)
+        for key, value in simulation.run(arguments.matches).items():
+            print("{}: {}".format(key, value))
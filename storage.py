@@ -0,0 +1,281 @@
+import os
+import gc
+import hmac
+import json
+import time
+import queue
+import shutil
+import hashlib
+import numpy as np
+from threading import Thread
+from player import Player, Info
+
+# Every rating update is logged with the records of the player after the match, so that replaying a record twice
+# leaves the player unchanged.
+RATING_RECORD = np.dtype([("user_id", "<i4"), ("rating", "<i4"), ("games", "<i4"), ("wins", "<i4"),
+                          ("losses", "<i4"), ("win_ratio", "<f8")])
+SNAPSHOT_ARRAYS = ("ratings", "games", "wins", "losses", "win_ratios")
+# Cost of the scrypt hashes of the passwords, about 16 MB and a few dozen milliseconds per hash.
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_SIZE = 16
+HASH_PREFIX = "scrypt$"
+
+
+# Hash a password with a random salt, into a string holding the cost of the hash, the salt and the hash itself.
+def hash_password(password):
+    salt = os.urandom(SALT_SIZE)
+    digest = hashlib.scrypt(password.encode("utf-8"), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
+    return "{}{}${}${}${}${}".format(HASH_PREFIX, SCRYPT_N, SCRYPT_R, SCRYPT_P, salt.hex(), digest.hex())
+
+
+# Check a password against the hash stored for it. Accounts saved before passwords were hashed hold the password itself.
+def verify_password(password, stored):
+    if not isinstance(password, str) or not isinstance(stored, str):
+        return False
+    if not stored.startswith(HASH_PREFIX):
+        return hmac.compare_digest(password.encode("utf-8"), stored.encode("utf-8"))
+    n, r, p, salt, digest = stored[len(HASH_PREFIX):].split("$")
+    computed = hashlib.scrypt(password.encode("utf-8"), salt=bytes.fromhex(salt), n=int(n), r=int(r), p=int(p))
+    return hmac.compare_digest(computed, bytes.fromhex(digest))
+
+
+# Durable accounts and ratings, kept as an append-only log of sign-ups and rating updates along with periodic compact
+# snapshots of the player store. The logs are split into generations: a snapshot holds every record of the previous
+# generations, so that a restart only loads the snapshot and replays the logs written since. Records are written
+# behind by a background thread, so the server never blocks on disk I/O.
+class Storage(Thread):
+    def __init__(self, path="data", snapshot_interval=60, batch_size=4096, sync=False):
+        Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self.batch_size = batch_size
+        self.sync = sync
+        self.records = queue.SimpleQueue()
+        self.store = None
+        # Username and password hash of each user id that has been written to the logs, None for the others.
+        self.usernames = []
+        self.passwords = []
+        self.generation = 0
+        self.accounts_log = None
+        self.ratings_log = None
+
+    def log_path(self, name, generation):
+        return os.path.join(self.path, "{}-{}.log".format(name, generation))
+
+    def snapshot_path(self, generation):
+        return os.path.join(self.path, "snapshot-{}".format(generation))
+
+    def generations(self, name):
+        generations = []
+        for file_name in os.listdir(self.path):
+            if file_name.startswith(name + "-") and file_name.endswith(".log"):
+                generations.append(int(file_name[len(name) + 1:-len(".log")]))
+        return sorted(generations)
+
+    def current_snapshot(self):
+        try:
+            with open(os.path.join(self.path, "CURRENT")) as file:
+                return int(file.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    # Load the snapshot and replay the logs into the store, then return the accounts and the players by username.
+    def load(self, store):
+        os.makedirs(self.path, exist_ok=True)
+        self.store = store
+        snapshot = self.current_snapshot()
+        first_generation = 0
+        if snapshot is not None:
+            self.load_snapshot(store, self.snapshot_path(snapshot))
+            first_generation = snapshot
+        for generation in self.generations("accounts"):
+            if generation >= first_generation:
+                self.replay_accounts(store, self.log_path("accounts", generation))
+        for generation in self.generations("ratings"):
+            if generation >= first_generation:
+                self.replay_ratings(store, self.log_path("ratings", generation))
+        store.refresh_classes()
+
+        # Start a new generation, so that nothing is ever appended to a log that might have been cut short.
+        self.generation = max([first_generation] + self.generations("accounts") + self.generations("ratings")) + 1
+        self.open_logs()
+        collecting = gc.isenabled()
+        gc.disable()  # Only acyclic objects are created below, collecting them along the way would only slow this down.
+        try:
+            username_key = Info.USERNAME.value
+            password_key = Info.PASSWORD.value
+            accounts = {username: {username_key: username, password_key: password}
+                        for username, password in zip(self.usernames, self.passwords) if username is not None}
+            players = {username: Player.view(store, user_id)
+                       for user_id, username in enumerate(self.usernames) if username is not None}
+        finally:
+            if collecting:
+                gc.enable()
+        return accounts, players
+
+    def load_snapshot(self, store, path):
+        with open(os.path.join(path, "meta.json")) as file:
+            size = json.load(file)["SIZE"]
+        if size == 0:
+            return
+        store.reserve(size - 1)
+        for name in SNAPSHOT_ARRAYS:
+            getattr(store, name)[:size] = np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+        with open(os.path.join(path, "accounts.json"), encoding="utf-8") as file:
+            accounts = json.load(file)
+        self.usernames = accounts[Info.USERNAME.value]
+        self.passwords = accounts[Info.PASSWORD.value]
+        store.usernames = list(self.usernames)
+        store.size = size
+
+    def replay_accounts(self, store, path):
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                try:
+                    account = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # The last line was cut short.
+                user_id = account[Info.USER_ID.value]
+                if Info.USERNAME.value not in account:
+                    self.passwords[user_id] = account[Info.PASSWORD.value]  # The password of the account was hashed.
+                    continue
+                store.add(user_id, account[Info.USERNAME.value], account[Info.RATING.value])
+                self.add_account(user_id, account[Info.USERNAME.value], account[Info.PASSWORD.value])
+
+    def replay_ratings(self, store, path):
+        records = np.fromfile(path, dtype=np.uint8)
+        records = records[:len(records) - len(records) % RATING_RECORD.itemsize].view(RATING_RECORD)
+        records = records[records["user_id"] < store.size]
+        if len(records) == 0:
+            return
+
+        # Only the last record of each player matters.
+        user_ids, last = np.unique(records["user_id"][::-1], return_index=True)
+        records = records[::-1][last]
+        store.ratings[user_ids] = records["rating"]
+        store.games[user_ids] = records["games"]
+        store.wins[user_ids] = records["wins"]
+        store.losses[user_ids] = records["losses"]
+        store.win_ratios[user_ids] = records["win_ratio"]
+
+    def add_account(self, user_id, username, password):
+        if user_id >= len(self.usernames):
+            self.usernames.extend([None] * (user_id + 1 - len(self.usernames)))
+            self.passwords.extend([None] * (user_id + 1 - len(self.passwords)))
+        self.usernames[user_id] = username
+        self.passwords[user_id] = password
+
+    def open_logs(self):
+        self.accounts_log = open(self.log_path("accounts", self.generation), "a", encoding="utf-8")
+        self.ratings_log = open(self.log_path("ratings", self.generation), "ab")
+
+    # Log a new account, whose password has been hashed.
+    def record_sign_up(self, player, account):
+        self.records.put((Info.USERNAME, player.user_id, player.username, account[Info.PASSWORD.value],
+                          player.rating))
+
+    # Check the password of an account on sign in. The password of an account saved before passwords were hashed is
+    # hashed then, and the hash logged in place of the password.
+    def check_password(self, player, account, password):
+        stored = account[Info.PASSWORD.value]
+        if not verify_password(password, stored):
+            return False
+        if not stored.startswith(HASH_PREFIX):
+            account[Info.PASSWORD.value] = hash_password(password)
+            self.records.put((Info.PASSWORD, player.user_id, account[Info.PASSWORD.value]))
+        return True
+
+    # Log the records of the players after a match. Only the values are captured here, the writing is left to the
+    # background thread.
+    def record_results(self, players):
+        self.records.put((Info.RATING, [(player.user_id, player.rating, player.games, player.wins, player.losses,
+                                         player.win_ratio) for player in players]))
+
+    def write(self, batch):
+        ratings = []
+        for record in batch:
+            if record[0] == Info.USERNAME:
+                _, user_id, username, password, rating = record
+                self.accounts_log.write(json.dumps({Info.USER_ID.value: user_id, Info.USERNAME.value: username,
+                                                    Info.PASSWORD.value: password, Info.RATING.value: rating}) + "\n")
+                self.add_account(user_id, username, password)
+            elif record[0] == Info.PASSWORD:
+                _, user_id, password = record
+                self.accounts_log.write(json.dumps({Info.USER_ID.value: user_id, Info.PASSWORD.value: password}) + "\n")
+                self.passwords[user_id] = password
+            else:
+                ratings += record[1]
+        self.accounts_log.flush()
+        if ratings:
+            self.ratings_log.write(np.array(ratings, dtype=RATING_RECORD).tobytes())
+        self.ratings_log.flush()
+        if self.sync:
+            os.fsync(self.accounts_log.fileno())
+            os.fsync(self.ratings_log.fileno())
+
+    # Write a snapshot of the store holding every record logged so far, then drop the logs and snapshots it replaces.
+    def snapshot(self):
+        self.accounts_log.close()
+        self.ratings_log.close()
+        previous_generation = self.generation
+        self.generation += 1
+        self.open_logs()
+
+        size = len(self.usernames)
+        path = self.snapshot_path(self.generation)
+        os.makedirs(path, exist_ok=True)
+        for name in SNAPSHOT_ARRAYS:
+            np.save(os.path.join(path, name + ".npy"), getattr(self.store, name)[:size])
+        with open(os.path.join(path, "accounts.json"), "w", encoding="utf-8") as file:
+            json.dump({Info.USERNAME.value: self.usernames, Info.PASSWORD.value: self.passwords}, file)
+        with open(os.path.join(path, "meta.json"), "w") as file:
+            json.dump({"SIZE": size}, file)
+
+        # Switch to the new snapshot atomically.
+        current = os.path.join(self.path, "CURRENT")
+        with open(current + ".tmp", "w") as file:
+            file.write(str(self.generation))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(current + ".tmp", current)
+
+        for name in ("accounts", "ratings"):
+            for generation in self.generations(name):
+                if generation <= previous_generation:
+                    os.remove(self.log_path(name, generation))
+        for file_name in os.listdir(self.path):
+            if file_name.startswith("snapshot-") and file_name != os.path.basename(path):
+                shutil.rmtree(os.path.join(self.path, file_name), ignore_errors=True)
+
+    # Write the pending records, take a last snapshot and stop the background thread.
+    def stop(self):
+        self.records.put(None)
+        self.join()
+
+    def run(self):
+        last_snapshot = time.monotonic()
+        written = False
+        stopped = False
+        while not stopped:
+            batch = []
+            try:
+                batch.append(self.records.get(timeout=self.snapshot_interval))
+                while len(batch) < self.batch_size:
+                    batch.append(self.records.get_nowait())
+            except queue.Empty:
+                pass
+            if None in batch:
+                batch.remove(None)
+                stopped = True
+            if batch:
+                self.write(batch)
+                written = True
+            if written and (stopped or time.monotonic() - last_snapshot >= self.snapshot_interval):
+                self.snapshot()
+                last_snapshot = time.monotonic()
+                written = False
+        self.accounts_log.close()
+        self.ratings_log.close()
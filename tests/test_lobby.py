@@ -0,0 +1,35 @@
+from lobby import SoloLobby
+from player import Player, PlayerStore
+
+
+def players(*ratings):
+    store = PlayerStore()
+    return [Player(i, "Player-{}".format(i), rating, store) for i, rating in enumerate(ratings)]
+
+
+# A player whose rating changes while they wait in the lobby, e.g. at the end of a rating period, takes the rating they
+# joined with out of the sums when they leave.
+def test_remove_takes_out_the_rating_a_player_joined_with():
+    waiting, leaving, other = players(1200, 1250, 1300)
+    lobby = SoloLobby(4)
+    for player in (waiting, leaving, other):
+        assert lobby.fill(player)
+    leaving.set_rating(1400)
+    lobby.remove(leaving)
+    assert lobby.rating_sum == 1200 + 1300
+    assert lobby.rating_squares == 1200 * 1200 + 1300 * 1300
+    assert lobby.average_rating() == 1250
+    lobby.remove(waiting)
+    lobby.remove(other)
+    assert (lobby.rating_sum, lobby.rating_squares) == (0, 0)
+
+
+def test_remove_keeps_the_ratings_in_the_order_of_the_players():
+    lobby = SoloLobby(4)
+    members = players(1000, 1100, 1200, 1300)
+    for player in members:
+        lobby.add(player)
+    lobby.swap(0, 3)
+    lobby.remove(members[1])
+    assert lobby.ratings == [player.rating for player in lobby.players]
+    assert lobby.rating_sum == 1000 + 1200 + 1300
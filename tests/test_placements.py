@@ -0,0 +1,57 @@
+import itertools
+import numpy as np
+import pytest
+import elo
+
+
+def random_ratings(n, seed):
+    return np.random.default_rng(seed).integers(800, 2600, n)
+
+
+# Chance of each player of getting 1st, ..., nth place, by going through every outcome of their games against the
+# others: a player who beats w of the n - 1 others gets (n - w)th place.
+def exhaustive_placements(scores):
+    n = len(scores)
+    placements = np.zeros((n, n))
+    for i in range(n):
+        opponents = [j for j in range(n) if j != i]
+        for outcome in itertools.product((True, False), repeat=n - 1):
+            p = np.prod([scores[i][j] if won else scores[j][i] for j, won in zip(opponents, outcome)])
+            placements[i][n - 1 - sum(outcome)] += p
+    return placements
+
+
+@pytest.mark.parametrize("n", range(2, 9))
+def test_matches_exhaustive_enumeration(n):
+    scores = elo.expected_scores(random_ratings(n, seed=n))
+    np.testing.assert_allclose(elo.predict_placements(scores), exhaustive_placements(scores), rtol=1e-9, atol=1e-12)
+
+
+def test_matches_exhaustive_enumeration_for_a_player():
+    scores = elo.expected_scores(random_ratings(6, seed=0))
+    wins = scores[0][1:]
+    losses = scores[1:, 0]
+    np.testing.assert_allclose(elo.placement_probabilities(wins, losses)[0], exhaustive_placements(scores)[0],
+                               rtol=1e-9, atol=1e-12)
+
+
+def test_lobbies_at_once_match_one_by_one():
+    ratings = np.stack([random_ratings(5, seed) for seed in range(10)])
+    placements = elo.predict_placements(elo.expected_scores(ratings))
+    for lobby_ratings, lobby_placements in zip(ratings, placements):
+        np.testing.assert_allclose(lobby_placements, elo.predict_placements(elo.expected_scores(lobby_ratings)))
+
+
+# Every player gets exactly one place, and since each game has exactly one winner, the players beat n(n - 1)/2
+# opponents between them on average. The number of players expected at each place doesn't have to be 1: the games of
+# a player are independent of those of the others, so that three even players all get 2nd place with a chance of 1/2.
+@pytest.mark.parametrize("n", [16, 64, 100, 256])
+def test_large_lobbies_sum_up(n):
+    placements = elo.predict_placements(elo.expected_scores(random_ratings(n, seed=n)))
+    assert placements.shape == (n, n)
+    assert (placements >= 0).all()
+    np.testing.assert_allclose(placements.sum(axis=1), 1)
+    np.testing.assert_allclose(placements.sum(axis=0).sum(), n)
+    opponents_beaten = n - np.arange(1, n + 1)
+    np.testing.assert_allclose((placements.sum(axis=0) * opponents_beaten).sum(), n * (n - 1) / 2)
+    np.testing.assert_allclose(elo.expected_placements(placements).sum(), n * (n + 1) / 2)
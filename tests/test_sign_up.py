@@ -0,0 +1,66 @@
+import sys
+import threading
+import pytest
+from player import PlayerStore
+from server import Server
+
+THREADS = 50
+ROUNDS = 20
+
+
+# Run the given function in many threads started at the same time, switching between them as often as possible.
+def run_concurrently(function):
+    barrier = threading.Barrier(THREADS)
+    results = [None] * THREADS
+
+    def run(i):
+        barrier.wait()
+        results[i] = function(i)
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    return results
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = Server(data_path=str(tmp_path))
+    yield server
+    server.socket.close()
+
+
+def test_allocated_user_ids_are_distinct():
+    store = PlayerStore(capacity=4)
+    results = run_concurrently(lambda i: [store.allocate("Player-{}-{}".format(i, j), 1200) for j in range(ROUNDS)])
+    user_ids = sorted(user_id for user_ids in results for user_id in user_ids)
+    assert user_ids == list(range(THREADS * ROUNDS))
+    assert len(store) == THREADS * ROUNDS
+    for i, user_ids in enumerate(results):
+        for j, user_id in enumerate(user_ids):
+            assert store.usernames[user_id] == "Player-{}-{}".format(i, j)
+
+
+def test_concurrent_sign_ups_get_their_own_players(server):
+    results = run_concurrently(lambda i: [server.register("Player-{}-{}".format(i, j), "hash") for j in range(ROUNDS)])
+    players = [player for players in results for player in players]
+    assert len({player.user_id for player in players}) == THREADS * ROUNDS
+    for player in players:
+        assert server.players[player.username].user_id == player.user_id
+
+
+def test_a_username_is_only_registered_once(server):
+    for round_number in range(ROUNDS):
+        username = "Player-{}".format(round_number)
+        results = run_concurrently(lambda i: server.register(username, "hash-{}".format(i)))
+        registered = [player for player in results if player is not None]
+        assert len(registered) == 1
+        assert server.players[username].user_id == registered[0].user_id
+    assert len(server.store) == ROUNDS